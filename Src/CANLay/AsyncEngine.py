@@ -0,0 +1,157 @@
+from __future__ import annotations
+
+import asyncio
+import logging
+import selectors as sel
+import threading as th
+from typing import Callable, Union
+
+Interval = Union[float, Callable[[], float]]
+
+
+class AsyncEngine:
+    def __init__(self, name="CANLayAsyncEngine") -> None:
+        """Single thread asyncio event loop that drives CANLay's periodic work.
+
+        Periodic callbacks are scheduled with loop timers against absolute
+        deadlines so they do not drift, and selector traffic is dispatched
+        from a reader on the selector's own file descriptor so no thread ever
+        blocks in select while holding the selector lock.
+
+        Args:
+            name (str, optional): Name of the thread running the loop.
+            Defaults to "CANLayAsyncEngine".
+        """
+        self.loop = asyncio.new_event_loop()
+        self.__thread = th.Thread(target=self.__run, name=name, daemon=True)
+        self.__timers: list[asyncio.TimerHandle] = []
+        self.__selector: sel.BaseSelector | None = None
+        self.__selector_lock = None
+        self.__dispatch: Callable[[], None] | None = None
+        self.__poll_interval = 0.0
+        self.__watching = False
+        self.__poll_handle: asyncio.TimerHandle | None = None
+
+    def __run(self) -> None:
+        asyncio.set_event_loop(self.loop)
+        try:
+            self.loop.run_forever()
+        finally:
+            self.__cancel_all()
+            self.loop.close()
+
+    def start(self) -> None:
+        self.__thread.start()
+
+    def stop(self, timeout=2.0) -> None:
+        if self.loop.is_closed():
+            return
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        if self.__thread.is_alive() and th.current_thread() is not self.__thread:
+            self.__thread.join(timeout)
+
+    def is_alive(self) -> bool:
+        return self.__thread.is_alive()
+
+    def call_soon(self, callback: Callable, *args) -> None:
+        """Thread-safe way to run callback on the event loop."""
+        if not self.loop.is_closed():
+            self.loop.call_soon_threadsafe(callback, *args)
+
+    def call_every(self, interval: Interval, callback: Callable[[], None], delay=0.0) -> None:
+        """Runs callback every interval seconds, starting after delay seconds.
+        interval may be a function returning the time until the next call so
+        that callers can change the period, e.g. to burst at startup."""
+        self.call_soon(self.__schedule, interval, callback, delay)
+
+    def __schedule(self, interval: Interval, callback: Callable[[], None], delay: float) -> None:
+        index = len(self.__timers)
+        self.__timers.append(None)  # type: ignore
+        deadline = self.loop.time() + delay
+
+        def tick(deadline: float) -> None:
+            try:
+                callback()
+            except Exception as e:
+                logging.error(e, exc_info=True)
+            period = interval() if callable(interval) else interval
+            # Schedule from the previous deadline rather than from now so the
+            # timer does not accumulate the time spent in callbacks.
+            deadline = max(deadline + period, self.loop.time())
+            self.__timers[index] = self.loop.call_at(deadline, tick, deadline)
+
+        self.__timers[index] = self.loop.call_at(deadline, tick, deadline)
+
+    def watch_selector(self, selector: sel.BaseSelector, lock, dispatch: Callable[[], None], poll_interval: float) -> None:
+        """Calls dispatch whenever a file object registered with selector is
+        ready. dispatch is called with lock held and should run a zero timeout
+        select. If the selector cannot be waited on by the event loop (e.g. the
+        select based selector on Windows) it is polled every poll_interval
+        seconds instead."""
+        self.__selector = selector
+        self.__selector_lock = lock
+        self.__dispatch = dispatch
+        self.__poll_interval = poll_interval
+        self.call_soon(self.__watch)
+
+    def unwatch_selector(self) -> None:
+        self.call_soon(self.__unwatch)
+
+    def __selector_fd(self) -> int | None:
+        try:
+            return self.__selector.fileno()  # type: ignore
+        except (AttributeError, NotImplementedError):
+            return None
+
+    def __watch(self) -> None:
+        if self.__watching or self.__selector is None:
+            return
+        fd = self.__selector_fd()
+        try:
+            if fd is None:
+                raise NotImplementedError
+            self.loop.add_reader(fd, self.__on_ready)
+        except NotImplementedError:
+            self.__poll_handle = self.loop.call_later(
+                self.__poll_interval, self.__on_poll)
+        self.__watching = True
+
+    def __unwatch(self) -> None:
+        if not self.__watching:
+            return
+        fd = self.__selector_fd()
+        if fd is not None:
+            self.loop.remove_reader(fd)
+        if self.__poll_handle is not None:
+            self.__poll_handle.cancel()
+            self.__poll_handle = None
+        self.__watching = False
+
+    def __on_ready(self) -> None:
+        if not self.__selector_lock.acquire(blocking=False):  # type: ignore
+            # Another thread is using the selector (e.g. waiting on an HTTP
+            # response). Back off briefly instead of spinning on the ready fd.
+            self.__unwatch()
+            self.loop.call_later(self.__poll_interval, self.__watch)
+            return
+        try:
+            self.__dispatch()  # type: ignore
+        except Exception as e:
+            logging.error(e, exc_info=True)
+        finally:
+            self.__selector_lock.release()  # type: ignore
+
+    def __on_poll(self) -> None:
+        self.__poll_handle = None
+        self.__watching = False
+        self.__on_ready()
+        if self.__selector is not None and not self.__watching:
+            self.__watch()
+
+    def __cancel_all(self) -> None:
+        for timer in self.__timers:
+            if timer is not None:
+                timer.cancel()
+        self.__timers.clear()
+        if self.__poll_handle is not None:
+            self.__poll_handle.cancel()
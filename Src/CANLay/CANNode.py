@@ -6,7 +6,7 @@ import re
 import selectors as sel
 import socket as soc
 import subprocess
-from ctypes import Structure, Union, c_bool, c_uint8, c_uint32, memmove
+from ctypes import Structure, Union, c_bool, c_uint8, c_uint32
 from enum import Enum, auto
 from ipaddress import IPv4Address
 from multiprocessing import RLock
@@ -16,6 +16,9 @@ from typing import Tuple
 
 from getmac import get_mac_address as gma
 
+from . import Codec
+from .ReceiveRing import ReceiveRing
+
 
 class CANFD_message(Structure):
     _pack_ = 4
@@ -94,6 +97,7 @@ class CANNode(object):
         self.__can_port = 0
         self._sel = sel.DefaultSelector()
         self._sel_lock = RLock()
+        self.__rx_ring = ReceiveRing()
         self.__inital_time = time_ns()
 
         self._mac = gma()
@@ -201,59 +205,22 @@ class CANNode(object):
                 self.__can_rsock, sel.EVENT_READ, can_data)
         self.session_status = self.SessionStatus.Active
 
-    def read(self) -> bytes:
+    def read(self) -> list[memoryview]:
+        """Drains every pending datagram from the CAN socket. The returned
+        views point into the receive ring and must be decoded before the ring
+        wraps around."""
         try:
-            return self.__can_rsock.recv(1024)
+            return self.__rx_ring.drain(self.__can_rsock)
         except OSError as oe:
             logging.debug("Occured in read")
             logging.error(oe)
-            return bytes()
-
-    def unpack_canblock(self, frame: WCANBlock, buffer: bytes, offset: int) -> None:
-        frame.sequence_number = int.from_bytes(
-            buffer[offset:offset + 4], "little")
-        offset += 4
-        frame.need_response = bool.from_bytes(
-            buffer[offset:offset + 1], "little")
-        offset += 1
-        frame.fd = bool.from_bytes(buffer[offset:offset + 1], "little")
-        offset += 1
-        if frame.fd == True:
-            frame.can_fd.can_id = int.from_bytes(
-                buffer[offset:offset + 4], "little")
-            offset += 4
-            frame.can_fd.len = int.from_bytes(
-                buffer[offset:offset + 1], "little")
-            offset += 1
-            frame.can_fd.flags = int.from_bytes(
-                buffer[offset:offset + 1], "little")
-            offset += 1
-            memmove(frame.can_fd.buf,
-                    buffer[offset:offset + frame.can_fd.len], frame.can_fd.len)
-        else:
-            frame.can.can_id = int.from_bytes(
-                buffer[offset:offset + 4], "little")
-            offset += 4
-            frame.can.len = int.from_bytes(buffer[offset:offset + 1], "little")
-            offset += 1
-            memmove(frame.can.buf,
-                    buffer[offset:offset + frame.can.len], frame.can.len)
-
-    def pack_canblock(self, frame: WCANBlock, buffer: bytearray) -> None:
-        buffer.extend(frame.sequence_number.to_bytes(4, "little"))
-        buffer.extend(frame.need_response.to_bytes(1, "little"))
-        buffer.extend(frame.fd.to_bytes(1, "little"))
-        if frame.fd:
-            buffer.extend(frame.can_fd.can_id.to_bytes(4, "little"))
-            buffer.extend(frame.can_fd.len.to_bytes(1, "little"))
-            buffer.extend(frame.can_fd.flags.to_bytes(1, "little"))
-            for i in range(frame.can_fd.len):
-                buffer.extend(frame.can_fd.buf[i].to_bytes(1, "little"))
-        else:
-            buffer.extend(frame.can.can_id.to_bytes(4, "little"))
-            buffer.extend(frame.can.len.to_bytes(1, "little"))
-            for i in range(frame.can.len):
-                buffer.extend(frame.can.buf[i].to_bytes(1, "little"))
+            return []
+
+    def unpack_canblock(self, frame: WCANBlock, buffer: bytes, offset: int) -> int:
+        return Codec.unpack_canblock(frame, buffer, offset)
+
+    def pack_canblock(self, frame: WCANBlock, buffer: bytearray, offset=0) -> int:
+        return Codec.pack_canblock(frame, buffer, offset)
 
     def write(self, message: bytes) -> int:
         try:
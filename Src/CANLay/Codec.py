@@ -0,0 +1,205 @@
+from __future__ import annotations
+
+import ctypes as ct
+from struct import Struct
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from .CANNode import WCANBlock
+    from .NetworkManager import COMMBlock
+    from .SensorNode import WSenseBlock
+
+# Largest datagram the controller will send or accept. Matches the size of the
+# receive buffer CANNode has always used.
+MAX_DATAGRAM_SIZE = 1024
+MAX_SIGNALS = 16
+CAN_MAX_LEN = 8
+CANFD_MAX_LEN = 64
+
+# Wire layout (little endian, no padding):
+#   header: index u8, type u8, frame_number u32, timestamp u64
+#   CAN:    sequence_number u32, need_response u8, fd u8, can_id u32, len u8
+#   CAN-FD: CAN fields followed by flags u8
+#   sensor: num_signals u8 followed by num_signals f32
+#   time:   u64
+#   health: raw NodeReport array, followed by one LatencyHistogram per member
+#           when the sender has them and they fit in MAX_DATAGRAM_SIZE
+#   batch:  count u16 followed by count CAN/CAN-FD blocks (type 9)
+HEADER = Struct("<BBIQ")
+CAN_BLOCK = Struct("<I??IB")
+CANFD_BLOCK = Struct("<I??IBB")
+SENSOR_BLOCK = Struct("<B")
+TIME_BLOCK = Struct("<Q")
+BATCH_BLOCK = Struct("<H")
+SIGNAL_BLOCKS = tuple(Struct(f"<{n}f") for n in range(MAX_SIGNALS + 1))
+
+COM_PACKED_HEAD_SIZE = HEADER.size
+# Largest single CAN block: CAN-FD header plus a full 64 byte payload.
+CAN_BLOCK_MAX_SIZE = CANFD_BLOCK.size + CANFD_MAX_LEN
+
+# One precompiled struct per payload length so a whole CAN datagram is
+# written with a single pack_into call.
+_CAN_FRAMES = tuple(Struct(f"<BBIQI??IB{n}s") for n in range(CAN_MAX_LEN + 1))
+_CANFD_FRAMES = tuple(
+    Struct(f"<BBIQI??IBB{n}s") for n in range(CANFD_MAX_LEN + 1))
+
+
+def pack_header(msg: COMMBlock, buffer, offset=0) -> int:
+    HEADER.pack_into(buffer, offset, msg.index & 0xFF, msg.type,
+                     msg.frame_number, msg.timestamp)
+    return offset + HEADER.size
+
+
+def unpack_header(msg: COMMBlock, buffer, offset=0) -> int:
+    msg.index, msg.type, msg.frame_number, msg.timestamp = \
+        HEADER.unpack_from(buffer, offset)
+    return offset + HEADER.size
+
+
+def pack_canblock(frame: WCANBlock, buffer, offset=0) -> int:
+    if frame.fd:
+        n = min(frame.can_fd.len, CANFD_MAX_LEN)
+        CANFD_BLOCK.pack_into(buffer, offset, frame.sequence_number,
+                              frame.need_response, True, frame.can_fd.can_id,
+                              n, frame.can_fd.flags)
+        offset += CANFD_BLOCK.size
+        buffer[offset:offset + n] = bytes(frame.can_fd.buf)[:n]
+    else:
+        n = min(frame.can.len, CAN_MAX_LEN)
+        CAN_BLOCK.pack_into(buffer, offset, frame.sequence_number,
+                            frame.need_response, False, frame.can.can_id, n)
+        offset += CAN_BLOCK.size
+        buffer[offset:offset + n] = bytes(frame.can.buf)[:n]
+    return offset + n
+
+
+def unpack_canblock(frame: WCANBlock, buffer, offset=0, end=None) -> int:
+    end = len(buffer) if end is None else end
+    (frame.sequence_number, frame.need_response, frame.fd, can_id,
+     n) = CAN_BLOCK.unpack_from(buffer, offset)
+    if frame.fd:
+        frame.can_fd.can_id = can_id
+        if end - offset < CANFD_BLOCK.size:
+            frame.can_fd.len = 0
+            return end
+        frame.can_fd.flags = buffer[offset + CAN_BLOCK.size]
+        offset += CANFD_BLOCK.size
+        frame.can_fd.len = n = max(min(n, CANFD_MAX_LEN, end - offset), 0)
+        memoryview(frame.can_fd.buf).cast("B")[:n] = buffer[offset:offset + n]
+    else:
+        frame.can.can_id = can_id
+        offset += CAN_BLOCK.size
+        frame.can.len = n = max(min(n, CAN_MAX_LEN, end - offset), 0)
+        memoryview(frame.can.buf).cast("B")[:n] = buffer[offset:offset + n]
+    return offset + n
+
+
+def pack_batch_count(count: int, buffer, offset=0) -> int:
+    BATCH_BLOCK.pack_into(buffer, offset, count)
+    return offset + BATCH_BLOCK.size
+
+
+def unpack_batch_count(buffer, offset=0) -> int:
+    return BATCH_BLOCK.unpack_from(buffer, offset)[0]
+
+
+def pack_sensorblock(block: WSenseBlock, signals, buffer, offset=0) -> int:
+    n = min(block.num_signals, MAX_SIGNALS)
+    SENSOR_BLOCK.pack_into(buffer, offset, n)
+    offset += SENSOR_BLOCK.size
+    SIGNAL_BLOCKS[n].pack_into(buffer, offset, *signals[:n])
+    return offset + SIGNAL_BLOCKS[n].size
+
+
+def unpack_sensorblock(block: WSenseBlock, signals, buffer, offset=0,
+                       end=None) -> int:
+    end = len(buffer) if end is None else end
+    n = min(buffer[offset], MAX_SIGNALS, (end - offset - 1) // 4)
+    block.num_signals = n
+    offset += SENSOR_BLOCK.size
+    signals[:n] = SIGNAL_BLOCKS[n].unpack_from(buffer, offset)
+    block.signals = signals
+    return offset + SIGNAL_BLOCKS[n].size
+
+
+def pack_time(value: int, buffer, offset=0) -> int:
+    TIME_BLOCK.pack_into(buffer, offset, value)
+    return offset + TIME_BLOCK.size
+
+
+def unpack_time(buffer, offset=0) -> int:
+    return TIME_BLOCK.unpack_from(buffer, offset)[0]
+
+
+def pack_health(report: ct.Array, buffer, offset=0) -> int:
+    size = ct.sizeof(report)
+    buffer[offset:offset + size] = bytes(report)
+    return offset + size
+
+
+def unpack_health(report: ct.Array, buffer, offset=0, end=None) -> int:
+    end = len(buffer) if end is None else end
+    size = max(min(ct.sizeof(report), end - offset), 0)
+    memoryview(report).cast("B")[:size] = buffer[offset:offset + size]
+    return offset + size
+
+
+def pack_into(msg: COMMBlock, buffer, offset=0, signals=None) -> int:
+    """Packs msg into buffer starting at offset and returns the offset just
+    past the packed datagram. signals is the c_float array backing a sensor
+    frame and is only needed for type 2 messages."""
+    if msg.type == 1:
+        frame = msg.frame.canFrame
+        if frame.fd:
+            n = min(frame.can_fd.len, CANFD_MAX_LEN)
+            s = _CANFD_FRAMES[n]
+            s.pack_into(buffer, offset, msg.index & 0xFF, 1,
+                        msg.frame_number, msg.timestamp,
+                        frame.sequence_number, frame.need_response, True,
+                        frame.can_fd.can_id, n, frame.can_fd.flags,
+                        bytes(frame.can_fd.buf))
+        else:
+            n = min(frame.can.len, CAN_MAX_LEN)
+            s = _CAN_FRAMES[n]
+            s.pack_into(buffer, offset, msg.index & 0xFF, 1,
+                        msg.frame_number, msg.timestamp,
+                        frame.sequence_number, frame.need_response, False,
+                        frame.can.can_id, n, bytes(frame.can.buf))
+        return offset + s.size
+    offset = pack_header(msg, buffer, offset)
+    if msg.type == 2:
+        if signals is None:
+            signals = msg.frame.sensorFrame.signals
+        return pack_sensorblock(msg.frame.sensorFrame, signals, buffer, offset)
+    elif msg.type == 6 or msg.type == 8:
+        return pack_time(msg.frame.timeFrame, buffer, offset)
+    return offset
+
+
+def unpack_from(msg: COMMBlock, buffer, msg_len: int, offset=0,
+                signals=None, report=None, histograms=None) -> int:
+    """Unpacks the datagram in buffer[offset:msg_len] into msg and returns the
+    offset just past the decoded data. Received sensor signals are written to
+    signals and type 4 health replies are copied into report, and their latency
+    histograms into histograms if the reply has them."""
+    offset = unpack_header(msg, buffer, offset)
+    remaining = msg_len - offset
+    if msg.type == 1 and remaining >= CAN_BLOCK.size:
+        return unpack_canblock(msg.frame.canFrame, buffer, offset, msg_len)
+    elif msg.type == 2 and remaining > 1:
+        return unpack_sensorblock(
+            msg.frame.sensorFrame, signals, buffer, offset, msg_len)
+    elif msg.type == 4 and report is not None:
+        offset = unpack_health(report, buffer, offset, msg_len)
+        if histograms is not None and msg_len - offset >= ct.sizeof(histograms):
+            offset = unpack_health(histograms, buffer, offset, msg_len)
+        return offset
+    elif msg.type == 9 and remaining >= BATCH_BLOCK.size:
+        # The contained CAN blocks are left for the caller to walk with
+        # unpack_canblock, starting at the returned offset.
+        msg.frame.batchFrame.count = unpack_batch_count(buffer, offset)
+        return offset + BATCH_BLOCK.size
+    elif (msg.type == 6 or msg.type == 8) and remaining >= TIME_BLOCK.size:
+        msg.frame.timeFrame = unpack_time(buffer, offset)
+        return offset + TIME_BLOCK.size
+    return offset
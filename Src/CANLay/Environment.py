@@ -1,5 +1,4 @@
 import copy
-import json
 import logging
 import multiprocessing as mp
 import os
@@ -9,7 +8,12 @@ from enum import Enum
 from logging.handlers import QueueHandler, TimedRotatingFileHandler
 from pathlib import Path
 
-from jsonschema import Draft7Validator, RefResolver, Validator
+from jsonschema import Validator
+
+# The SchemaRegistry lives with the schemas, it is shared with the broker.
+SCHEMA_DIR = os.path.join(str(Path(__file__).parent.parent.absolute()), "Schemas")
+sys.path.append(SCHEMA_DIR)
+from SchemaRegistry import SchemaRegistry  # noqa: E402
 
 LOGTYPE_OFF = 0
 LOGTYPE_FILE = 1
@@ -23,24 +27,24 @@ class OutputType(Enum):
     NOTIFY = 2
     ERROR = 3
     DEVICES = 4
-    CAN_MSG = 5
-    SIM_MSG = 6
     TOTAL_STATS = 7
     START_SESSION = 8
     STOP_SESSION = 9
     EXIT = 10
-    BUFFERED_CAN_SIM = 11
 
 
 class Schema:
+    DIR = SCHEMA_DIR
+
     @staticmethod
     def compile_schema(schema_name) -> Validator:
-        dir = os.path.join(str(Path(__file__).parent.parent.absolute()), "Schemas")
-        schema_path = os.path.join(dir, schema_name)
-        with open(schema_path, 'rb') as schema_file:
-            schema = json.load(schema_file)
-        r = RefResolver('file:///' + dir.replace("\\", "/") + '/', schema)
-        return Draft7Validator(schema, resolver=r)  # type: ignore
+        """The validator of schema_name, compiled on first use by the
+        SchemaRegistry of DIR, which the broker uses as well."""
+        return SchemaRegistry.of(Schema.DIR).validator(schema_name)
+
+    @staticmethod
+    def load_schema(schema_name) -> dict:
+        return SchemaRegistry.of(Schema.DIR).schema(schema_name)
 
 # COPIED FROM: https://stackoverflow.com/questions/384076/how-can-i-color-python-logging-output?page=1&tab=votes#tab-top
 
@@ -2,14 +2,16 @@ from __future__ import annotations
 
 import json
 import logging
+import select
 import selectors as sel
 import socket as soc
-from http.client import HTTPConnection, HTTPException
+from http import HTTPStatus
+from http.client import HTTPConnection, HTTPException, HTTPResponse
 from http.server import BaseHTTPRequestHandler
 from io import BytesIO
 from ipaddress import AddressValueError, IPv4Address
 from json.decoder import JSONDecodeError
-from time import sleep
+from time import monotonic, sleep
 
 from jsonschema import ValidationError, Validator
 
@@ -17,6 +19,14 @@ from .CANNode import CANNode
 from .Environment import Schema
 
 
+class ExactHTTPResponse(HTTPResponse):
+    def __init__(self, sock, *args, **kwargs) -> None:
+        """An HTTPResponse that reads no further than its own message, so
+        messages the broker pushes right after it stay on the socket."""
+        super().__init__(sock, *args, **kwargs)
+        self.fp = sock.makefile("rb", buffering=1)
+
+
 class HTTPClient(CANNode, BaseHTTPRequestHandler):
     def __init__(self, *args,
                  broker_host=soc.gethostname(),
@@ -44,6 +54,14 @@ class HTTPClient(CANNode, BaseHTTPRequestHandler):
 
         self.request_schema = Validator
         self.sessions_schema = Validator
+        # Last device list and its ETag, reused while the broker answers
+        # 304 Not Modified.
+        self._devices_etag = None
+        self._devices: list = []
+        # Devices pushed by the broker while subscribed, by ID.
+        self.subscribed = False
+        self._live_devices: dict = {}
+        self._live_changed = False
 
     # Overrides for the parent functions
 
@@ -57,13 +75,17 @@ class HTTPClient(CANNode, BaseHTTPRequestHandler):
 
     def connect(self, retry=True) -> bool:
         # Cannot put these schema lines in init due to file sharing issues that
-        # occur between the jsonschema library and multiprocess library
+        # occur between the jsonschema library and multiprocess library.
+        # Validators are cached, so reconnecting does not compile them again.
         self.request_schema = Schema.compile_schema("RequestDevices.json")
         self.session_schema = Schema.compile_schema("SessionInformation.json")
+        self._devices_etag = None
+        self.subscribed = False
         try:
             logging.info("Connecting to the server.")
             self.ctrl = HTTPConnection(
                 self.__server_ip, self.__server_port, timeout=1.0)
+            self.ctrl.response_class = ExactHTTPResponse
             self.ctrl.connect()
             with self._sel_lock:
                 self._sel.register(self.ctrl.sock, sel.EVENT_READ)
@@ -93,7 +115,7 @@ class HTTPClient(CANNode, BaseHTTPRequestHandler):
         try:
             with self._sel_lock:
                 self._sel.modify(self.ctrl.sock, sel.EVENT_READ)
-                if self._sel.select(timeout=timeout):
+                if self.__wait_for_response(timeout):
                     self.response = self.ctrl.getresponse()
                     length = self.response.length
                     self.response_data = self.response.read(length)
@@ -110,6 +132,24 @@ class HTTPClient(CANNode, BaseHTTPRequestHandler):
             logging.error(e)
             return False
 
+    def __wait_for_response(self, timeout: float) -> bool:
+        """Waits for the next response on the connection, handling the
+        messages the broker pushed ahead of it."""
+        sock = self.ctrl.sock
+        deadline = monotonic() + timeout
+        while True:
+            remaining = deadline - monotonic()
+            if remaining <= 0 or not select.select([sock], [], [], remaining)[0]:
+                return False
+            # Responses start with "HTTP/", pushed requests with a method.
+            if sock.recv(1, soc.MSG_PEEK) in (b"H", b""):
+                return True
+            self.__handle_pushed()
+
+    def __handle_pushed(self) -> None:
+        with BytesIO() as self.wfile, self.ctrl.sock.makefile("rb", buffering=1) as self.rfile:
+            self.handle_one_request()
+
     def __submit_registration(self, retry=True) -> bool:
         registration = json.dumps({"MAC": self._mac})
         try:
@@ -162,13 +202,21 @@ class HTTPClient(CANNode, BaseHTTPRequestHandler):
         msg = "request available devices from the server"
         try:
             logging.info(f"Requesting {msg[8:]}.")
-            self.ctrl.request("GET", "/sssf")
+            headers = {}
+            if self._devices_etag is not None:
+                headers["If-None-Match"] = self._devices_etag
+            self.ctrl.request("GET", "/sssf", headers=headers)
         except HTTPException as httpe:
             logging.error(f"Failed to {msg}.")
             logging.error(httpe)
         else:
             if self.__getresponse() and self.__successful(msg, 400):
-                return self.__deserialize_device_list(self.response_data)
+                if self.response.status == HTTPStatus.NOT_MODIFIED:
+                    logging.info("Device list has not changed.")
+                    return list(self._devices)
+                self._devices = self.__deserialize_device_list(self.response_data)
+                self._devices_etag = self.response.getheader("ETag")
+                return list(self._devices)
         return []
 
     def request_devices(self, _req: list, _devices: list) -> bool:
@@ -185,8 +233,90 @@ class HTTPClient(CANNode, BaseHTTPRequestHandler):
             logging.error(f"Failed to {msg}.")
             logging.error(httpe)
             return False
-        else:
-            return self.__getresponse() and self.__successful(msg, 300)
+        if self.__getresponse() and self.__successful(msg, 300):
+            # The broker ended the subscription with the session.
+            self.subscribed = False
+            return True
+        return False
+
+    def subscribe_devices(self) -> bool:
+        """Asks the broker to push changes in the available devices and
+        starts the live view of them returned by live_devices. The broker
+        ends the subscription when a session starts."""
+        msg = "subscribe to available devices"
+        try:
+            logging.info(f"Requesting to {msg}.")
+            self.ctrl.request("POST", "/sssf/subscribe")
+        except HTTPException as httpe:
+            logging.error(f"Failed to {msg}.")
+            logging.error(httpe)
+            return False
+        if not (self.__getresponse() and self.__successful(msg, 300)):
+            return False
+        try:
+            devices = json.loads(self.response_data)["Devices"]
+            if len(devices) > 0:
+                self.request_schema.validate(devices)  # type: ignore
+        except (ValidationError, JSONDecodeError, KeyError) as e:
+            logging.error("Device list failed validation.")
+            logging.error(e)
+            return False
+        self._live_devices = {device["ID"]: device for device in devices}
+        self.subscribed = True
+        return True
+
+    def unsubscribe_devices(self) -> bool:
+        msg = "unsubscribe from available devices"
+        self.subscribed = False
+        try:
+            self.ctrl.request("DELETE", "/sssf/subscribe")
+        except HTTPException as httpe:
+            logging.error(f"Failed to {msg}.")
+            logging.error(httpe)
+            return False
+        return self.__getresponse() and self.__successful(msg, 300)
+
+    def live_devices(self) -> list:
+        """The available devices as last pushed by the broker."""
+        return list(self._live_devices.values())
+
+    def refresh_devices(self, timeout=0.0) -> bool:
+        """Applies the changes the broker pushed, waiting up to timeout for
+        the first. Returns True if the live view changed."""
+        if not self.subscribed:
+            return False
+        self._live_changed = False
+        sock = self.ctrl.sock
+        with self._sel_lock:
+            while select.select([sock], [], [], timeout)[0]:
+                timeout = 0
+                if sock.recv(1, soc.MSG_PEEK) == b"H":
+                    # A response is for whoever sent the request.
+                    break
+                self.__handle_pushed()
+                if self.close_connection:
+                    logging.error("Server closed the connection.")
+                    self.subscribed = False
+                    break
+        return self._live_changed
+
+    def do_PATCH(self) -> None:
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+            changes = json.loads(self.rfile.read(length))
+            if len(changes["Available"]) > 0:
+                self.request_schema.validate(changes["Available"])  # type: ignore
+        except (ValidationError, JSONDecodeError, KeyError, ValueError) as e:
+            logging.error("Device availability update failed validation.")
+            logging.error(e)
+            return
+        if changes["Snapshot"]:
+            self._live_devices.clear()
+        for device_id in changes["Unavailable"]:
+            self._live_devices.pop(device_id, None)
+        for device in changes["Available"]:
+            self._live_devices[device["ID"]] = device
+        self._live_changed = True
 
     def receive_SSE(self, key: sel.SelectorKey):
         logging.debug("Received an SSE.")
@@ -4,21 +4,17 @@ import ctypes as ct
 import logging
 import multiprocessing as mp
 import queue
-from dataclasses import dataclass
+import threading as th
+from contextlib import contextmanager
 from multiprocessing.sharedctypes import RawArray, RawValue
 from multiprocessing.synchronize import Event
 from time import sleep
+from types import SimpleNamespace
+from typing import Callable, Iterator, TypeVar
 
 import numpy as np
 
 from .CANNode import Member_Node
-from .NetworkMatrix import NetworkMatrix
-
-
-@dataclass
-class HealthBasics:
-    last_message_time: int = 0
-    last_sequence_number: int = 0
 
 
 class HealthCore(ct.Structure):
@@ -58,60 +54,257 @@ class NodeReport(ct.Structure):
         )
 
 
+HEALTH_CORE_DTYPE = np.dtype([
+    ("count", "<u4"),
+    ("min", "<f4"),
+    ("max", "<f4"),
+    ("mean", "<f4"),
+    ("variance", "<f4"),
+    ("sumOfSquaredDifferences", "<f4")
+])
+NODE_REPORT_DTYPE = np.dtype([
+    ("packetLoss", "<u4"),
+    ("goodput", "<u4"),
+    ("latency", HEALTH_CORE_DTYPE),
+    ("jitter", HEALTH_CORE_DTYPE)
+])
+assert NODE_REPORT_DTYPE.itemsize == ct.sizeof(NodeReport)
+
+# Log bucketed latency histogram of one member, in microseconds. Bucket 0
+# holds latencies below 2**LATENCY_MIN_EXPONENT, then every power of two is
+# split into 2**LATENCY_SUB_BUCKET_BITS buckets and the last bucket holds the
+# rest. Type 4 health replies carry one per member after the NodeReport array
+# when they fit, see Codec.
+LATENCY_MIN_EXPONENT = 7
+LATENCY_SUB_BUCKET_BITS = 1
+LATENCY_BUCKETS = 32
+LatencyHistogram = ct.c_uint16 * LATENCY_BUCKETS
+
+
+def _bucket_upper_bound(bucket: int) -> float:
+    if bucket == LATENCY_BUCKETS - 1:
+        return float("inf")
+    if bucket == 0:
+        return float(1 << LATENCY_MIN_EXPONENT)
+    exponent, sub = divmod(bucket - 1, 1 << LATENCY_SUB_BUCKET_BITS)
+    return float((1 << (LATENCY_MIN_EXPONENT + exponent))
+                 * (1 + (sub + 1) / (1 << LATENCY_SUB_BUCKET_BITS)))
+
+
+# Exclusive upper bound of each bucket in microseconds.
+LATENCY_BUCKET_BOUNDS = np.array([_bucket_upper_bound(b) for b in range(LATENCY_BUCKETS)])
+
+
+def latency_buckets(latency: np.ndarray) -> np.ndarray:
+    """The histogram bucket of each latency in microseconds."""
+    latency = np.maximum(latency, 1).astype(np.int64)
+    exponent = np.frexp(latency)[1].astype(np.int64) - 1
+    sub = (latency >> np.maximum(exponent - LATENCY_SUB_BUCKET_BITS, 0)) \
+        & ((1 << LATENCY_SUB_BUCKET_BITS) - 1)
+    bucket = 1 + ((exponent - LATENCY_MIN_EXPONENT) << LATENCY_SUB_BUCKET_BITS) + sub
+    return np.clip(bucket, 0, LATENCY_BUCKETS - 1)
+
+
+def histogram_percentiles(histograms: np.ndarray, percentiles) -> np.ndarray:
+    """The percentiles of latency histograms, which are along the last axis.
+
+    Like HdrHistogram, each percentile is the upper bound of the bucket it
+    falls into, so it is never below the true value.
+
+    Args:
+        histograms (np.ndarray): Bucket counts, LATENCY_BUCKETS along the last
+        axis.
+        percentiles: Percentiles between 0 and 100.
+
+    Returns:
+        np.ndarray: Milliseconds, with a last axis of one value per
+        percentile. NaN for empty histograms, inf for percentiles past the
+        last finite bucket.
+    """
+    cumulative = np.cumsum(histograms, axis=-1)
+    total = cumulative[..., -1:]
+    ranks = np.maximum(np.ceil(np.asarray(percentiles, float) / 100 * total), 1)
+    index = (cumulative[..., None, :] < ranks[..., None]).sum(axis=-1)
+    values = LATENCY_BUCKET_BOUNDS[np.minimum(index, LATENCY_BUCKETS - 1)] / 1000
+    return np.where(total > 0, values, np.nan)
+
+
+class _Moments:
+    """Running count/min/max/mean/M2 for every member in contiguous arrays."""
+
+    def __init__(self, size: int) -> None:
+        self.count = np.zeros(size, np.int64)
+        self.min = np.zeros(size)
+        self.max = np.zeros(size)
+        self.mean = np.zeros(size)
+        self.m2 = np.zeros(size)
+
+    def reset(self) -> None:
+        for a in (self.count, self.min, self.max, self.mean, self.m2):
+            a.fill(0)
+
+    def merge(self, members: np.ndarray, starts: np.ndarray, x: np.ndarray) -> None:
+        """Folds the samples x, grouped by member with group i starting at
+        starts[i], into the running moments using Chan's parallel merge."""
+        n_b = np.diff(np.append(starts, len(x)))
+        mean_b = np.add.reduceat(x, starts) / n_b
+        m2_b = np.add.reduceat((x - np.repeat(mean_b, n_b)) ** 2, starts)
+        n_a = self.count[members]
+        n = n_a + n_b
+        delta = mean_b - self.mean[members]
+        self.mean[members] += delta * n_b / n
+        self.m2[members] += m2_b + delta ** 2 * n_a * n_b / n
+        self.count[members] = n
+        # Like the SSSF firmware, min and max start from the zeroed report.
+        self.min[members] = np.minimum(
+            self.min[members], np.minimum.reduceat(x, starts))
+        self.max[members] = np.maximum(
+            self.max[members], np.maximum.reduceat(x, starts))
+
+    def prefix_variance(self, members: np.ndarray, starts: np.ndarray, x: np.ndarray) -> np.ndarray:
+        """Returns the variance a sample by sample Welford update would have
+        after each sample in x, without changing the running moments."""
+        n_b = np.diff(np.append(starts, len(x)))
+        group_start = np.repeat(starts, n_b)
+        shift = np.repeat(self.mean[members], n_b)
+        d = x - shift
+        c1 = np.cumsum(d)
+        c2 = np.cumsum(d * d)
+        # Turn the running sums into per member running sums.
+        before = group_start - 1
+        c1 -= np.where(before >= 0, c1[before], 0.0)
+        c2 -= np.where(before >= 0, c2[before], 0.0)
+        k = np.arange(len(x)) - group_start + 1
+        n_a = np.repeat(self.count[members], n_b)
+        mean_d = c1 / k
+        m2_k = c2 - c1 * mean_d
+        n = n_a + k
+        m2 = np.repeat(self.m2[members], n_b) + m2_k + mean_d ** 2 * n_a * k / n
+        return m2 / n
+
+
 class NetworkStats:
-    def __init__(self, _num_members: int) -> None:
-        try:
-            self.__size = _num_members
-            self.__basics = [HealthBasics() for _ in range(_num_members)]
-            self.health_report = (NodeReport * _num_members)()
-            for i in range(_num_members):
-                self.health_report[i].packetLoss = 0
-                self.health_report[i].goodput = 0
-                ct.memset(ct.pointer(
-                    self.health_report[i].latency), 0, ct.sizeof(HealthCore))
-                ct.memset(ct.pointer(
-                    self.health_report[i].jitter), 0, ct.sizeof(HealthCore))
-        except Exception as e:
-            logging.error(f'NetworkStats: {e}', exc_info=True)
+    def __init__(self, _num_members: int, batch_size=256) -> None:
+        """Per member latency, jitter, packet loss and goodput of the frames
+        received from the other session members.
+
+        Samples are queued by update and folded into NumPy arrays a batch at
+        a time, so the per frame cost is a few array stores. The statistics
+        are the same as the sample by sample Welford updates done by the SSSF
+        firmware: latency is the absolute one way delay in milliseconds and
+        jitter the running variance of the latency. The latency of each
+        frame, in microseconds, is also counted in a log bucketed histogram
+        per member for its percentiles.
+
+        Args:
+            _num_members (int): Number of members in the session.
+            batch_size (int, optional): Samples queued before they are folded
+            in. Defaults to 256.
+        """
+        self.__size = _num_members
+        self.__lock = th.Lock()
+        self.__last_message_time = np.zeros(_num_members, np.int64)
+        self.__last_sequence_number = np.zeros(_num_members, np.int64)
+        self.__packet_loss = np.zeros(_num_members, np.int64)
+        self.__goodput = np.zeros(_num_members, np.int64)
+        self.__latency = _Moments(_num_members)
+        self.__jitter = _Moments(_num_members)
+        self.__latency_histogram = np.zeros((_num_members, LATENCY_BUCKETS), np.int64)
+        self.__batch_size = batch_size
+        self.__batch: list[tuple[int, int, int, int, int]] = []
+        self.__report = (NodeReport * _num_members)()
+        self.__report_view = np.frombuffer(self.__report, NODE_REPORT_DTYPE)
+        self.__histogram_report = (LatencyHistogram * _num_members)()
+        self.__histogram_view = np.frombuffer(self.__histogram_report, np.uint16).reshape(
+            _num_members, LATENCY_BUCKETS)
+
+    @property
+    def health_report(self) -> ct.Array[NodeReport]:
+        """NodeReport array in the wire layout of type 4 health replies."""
+        with self.__lock:
+            self.__flush()
+            view = self.__report_view
+            view["packetLoss"] = self.__packet_loss.astype(np.uint32)
+            view["goodput"] = self.__goodput.astype(np.uint32)
+            for name, moments in (("latency", self.__latency), ("jitter", self.__jitter)):
+                core = view[name]
+                core["count"] = moments.count
+                core["min"] = moments.min
+                core["max"] = moments.max
+                core["mean"] = moments.mean
+                core["sumOfSquaredDifferences"] = moments.m2
+                core["variance"] = np.divide(
+                    moments.m2, moments.count,
+                    out=np.zeros(self.__size), where=moments.count > 0)
+        return self.__report
+
+    @property
+    def latency_histogram(self) -> ct.Array[LatencyHistogram]:
+        """LatencyHistogram array in the wire layout of type 4 health
+        replies. Counts saturate at 65535."""
+        with self.__lock:
+            self.__flush()
+            np.minimum(self.__latency_histogram, 0xFFFF, out=self.__histogram_view,
+                       casting="unsafe")
+        return self.__histogram_report
 
     def update(self, i: int, packet_size: int, timestamp: int, sequence_number: int, now: int) -> None:
-        delay = (now - timestamp) // 1000
-        # if these numbers are zero then this is the first messages we've received
-        if (self.__basics[i].last_message_time != 0) and (self.__basics[i].last_sequence_number != 0):
-            # logging.debug(f'Controller Recv: {now} SSSF Send: {timestamp} Diff: {delay}')
-            self.calculate(self.health_report[i].latency, abs(delay))
-            self.calculate(
-                self.health_report[i].jitter, self.health_report[i].latency.variance)
-            # If no packet loss then sequence number = last sequence number + 1
-            packetsLost = sequence_number - \
-                (self.__basics[i].last_sequence_number + 1)
-            # If packetsLost is negative then this usually indicates duplicate or
-            # out of order frame.
-            self.health_report[i].packetLoss += packetsLost if packetsLost > 0 else 0
-            self.health_report[i].goodput += packet_size
-
-        self.__basics[i].last_message_time = now
-        self.__basics[i].last_sequence_number = sequence_number
+        with self.__lock:
+            self.__batch.append((i, packet_size, timestamp, sequence_number, now))
+            if len(self.__batch) >= self.__batch_size:
+                self.__flush()
 
     def reset(self) -> None:
-        for i in range(self.__size):
-            self.health_report[i].packetLoss = 0
-            self.health_report[i].goodput = 0
-            ct.memset(ct.pointer(
-                self.health_report[i].latency), 0, ct.sizeof(HealthCore))
-            ct.memset(ct.pointer(
-                self.health_report[i].jitter), 0, ct.sizeof(HealthCore))
-
-    def calculate(self, edge: HealthCore, n: float):
-        # From: https://en.wikipedia.org/wiki/Algorithms_for_calculating_variance#Welford's_online_algorithm
-        edge.min = min(edge.min, n)
-        edge.max = max(edge.max, n)
-        edge.count += 1
-        delta = n - edge.mean
-        edge.mean += delta / edge.count
-        delta2 = n - edge.mean
-        edge.sumOfSquaredDifferences += delta * delta2
-        edge.variance = edge.sumOfSquaredDifferences / edge.count
+        with self.__lock:
+            self.__flush()
+            self.__packet_loss.fill(0)
+            self.__goodput.fill(0)
+            self.__latency.reset()
+            self.__jitter.reset()
+            self.__latency_histogram.fill(0)
+
+    def __flush(self) -> None:
+        if not self.__batch:
+            return
+        batch = np.array(self.__batch, np.int64)
+        self.__batch.clear()
+        n = len(batch)
+        # Group the batch by member, keeping arrival order within a member.
+        batch = batch[np.argsort(batch[:, 0], kind="stable")]
+        member, size, timestamp, sequence, now = batch.T
+        delay = (now - timestamp) // 1000
+        first = np.ones(n, bool)
+        first[1:] = member[1:] != member[:-1]
+        # Each sample is compared with the previous frame from the same member.
+        prev_time = np.empty(n, np.int64)
+        prev_sequence = np.empty(n, np.int64)
+        prev_time[1:] = now[:-1]
+        prev_sequence[1:] = sequence[:-1]
+        prev_time[first] = self.__last_message_time[member[first]]
+        prev_sequence[first] = self.__last_sequence_number[member[first]]
+        last = np.append(first[1:], True)
+        self.__last_message_time[member[last]] = now[last]
+        self.__last_sequence_number[member[last]] = sequence[last]
+        # If these numbers are zero then this is the first message received.
+        valid = (prev_time != 0) & (prev_sequence != 0)
+        if not valid.any():
+            return
+        member = member[valid]
+        # If packets lost is negative then this usually indicates duplicate or
+        # out of order frame.
+        lost = np.maximum(sequence[valid] - (prev_sequence[valid] + 1), 0)
+        self.__packet_loss += np.bincount(member, lost, self.__size).astype(np.int64)
+        self.__goodput += np.bincount(member, size[valid], self.__size).astype(np.int64)
+        latency = np.abs(delay[valid]).astype(np.float64)
+        buckets = latency_buckets(np.abs(now - timestamp)[valid])
+        self.__latency_histogram += np.bincount(
+            member * LATENCY_BUCKETS + buckets,
+            minlength=self.__size * LATENCY_BUCKETS).reshape(self.__size, LATENCY_BUCKETS)
+        starts = np.flatnonzero(np.append(True, member[1:] != member[:-1]))
+        members = member[starts]
+        jitter = self.__latency.prefix_variance(members, starts, latency)
+        self.__latency.merge(members, starts, latency)
+        self.__jitter.merge(members, starts, jitter)
 
 
 class HealthCounts(ct.Structure):
@@ -133,10 +326,68 @@ class HealthCounts(ct.Structure):
         )
 
 
+T = TypeVar("T")
+
+
+class SeqLock:
+    def __init__(self, size: int) -> None:
+        """Sequence numbers guarding size slots of shared memory.
+
+        A writer makes the sequence of a slot odd, writes the slot and makes
+        it even again. Readers copy the slot without waiting and try again if
+        the sequence was odd or changed while they copied, so writers are
+        never held up by readers, even ones in other processes. Writers of a
+        slot must be serialized by the caller.
+
+        Args:
+            size (int): Number of slots.
+        """
+        self.sequences = RawArray(ct.c_uint32, size)
+
+    @contextmanager
+    def write(self, slot: int) -> Iterator[None]:
+        self.sequences[slot] += 1
+        try:
+            yield
+        finally:
+            self.sequences[slot] += 1
+
+    def read(self, slot: int, copy: Callable[[], T]) -> tuple[int, T]:
+        """Returns how many times slot was written and what copy returned
+        while nothing was writing it."""
+        sequences = self.sequences
+        while True:
+            before = sequences[slot]
+            if not before & 1:
+                value = copy()
+                if sequences[slot] == before:
+                    return before // 2, value
+            # Let the writer finish.
+            sleep(0)
+
+
 class HealthReport:
     def __init__(self, members: list[Member_Node], report_offset=14) -> None:
+        """The latest health reports of every session member, shared with the
+        network matrix process when it is displayed.
+
+        Nothing of the display is imported or started until start_display,
+        so a headless client only pays for the shared arrays, which metrics
+        reads.
+
+        The reports and counts are published through a SeqLock, whose slot
+        i guards report[i] and latency_histograms[i] and whose last slot
+        guards counts. The network threads only wait on each other, never on
+        the display or other readers.
+
+        Args:
+            members (list[Member_Node]): Members of the session.
+        """
         _num_members = len(members)
-        self.lock = mp.Lock()
+        # Serializes the writers of this process.
+        self.__write_lock = th.Lock()
+        self.seqlock = SeqLock(_num_members + 1)
+        self.counts_slot = _num_members
         self.__members = members
         self.__rx_report_size = ct.sizeof(NodeReport) * _num_members
         self.report = [RawArray(NodeReport, _num_members)
@@ -144,9 +395,17 @@ class HealthReport:
         for i in range(_num_members):
             ct.memset(ct.addressof(
                 self.report[i]), 0, ct.sizeof(self.report[i]))
+        self.__report_views = [np.frombuffer(r, NODE_REPORT_DTYPE) for r in self.report]
+        # Row i is zero when member i did not send latency histograms.
+        self.latency_histograms = [RawArray(LatencyHistogram, _num_members)
+                                   for _ in range(_num_members)]
+        self.__histogram_views = [
+            np.frombuffer(h, np.uint16).reshape(_num_members, LATENCY_BUCKETS)
+            for h in self.latency_histograms]
         self.counts = RawValue(HealthCounts, 0)
         self.__can_frames_per_device = RawArray(ct.c_uint32, [0] * _num_members)
-        self._matrix = NetworkMatrix(_num_members, self.__create_axis_names())
+        self.labels = self.__create_axis_names()
+        self.__matrix_proc = None
 
     # From:
     # https://stackoverflow.com/questions/2837409/how-to-append-count-numbers-to-duplicates-in-a-list-in-python
@@ -176,15 +435,40 @@ class HealthReport:
         axis_names = list(self.__rename_duplicates(axis_names))
         return axis_names
 
-    def update(self, index: int, report_buff: ct.Array[NodeReport], last_msg_num: int) -> None:
-        with self.lock:
-            if index == 0:
-                self.counts.sim_frames = last_msg_num
-            else:
-                self.counts.can_frames -= self.__can_frames_per_device[index]
-                self.counts.can_frames += last_msg_num
-                self.__can_frames_per_device[index] = last_msg_num
-            ct.memmove(self.report[index], report_buff, self.__rx_report_size)
+    def update(
+        self,
+        index: int,
+        report_buff: ct.Array[NodeReport],
+        last_msg_num: int,
+        histogram_buff: ct.Array[LatencyHistogram] | None = None
+    ) -> None:
+        """Publishes the health reported by member index.
+
+        Args:
+            index (int): Index of the member that reported.
+            report_buff (ct.Array[NodeReport]): What it measured of each
+            member.
+            last_msg_num (int): Frames received from it, or sent for the
+            local member.
+            histogram_buff (ct.Array[LatencyHistogram], optional): Its latency
+            histogram of each member. Defaults to None, for members that do
+            not send them.
+        """
+        with self.__write_lock:
+            with self.seqlock.write(self.counts_slot):
+                if index == 0:
+                    self.counts.sim_frames = last_msg_num
+                else:
+                    self.counts.can_frames -= self.__can_frames_per_device[index]
+                    self.counts.can_frames += last_msg_num
+                    self.__can_frames_per_device[index] = last_msg_num
+            with self.seqlock.write(index):
+                ct.memmove(self.report[index], report_buff, self.__rx_report_size)
+                histograms = self.latency_histograms[index]
+                if histogram_buff is None:
+                    ct.memset(histograms, 0, ct.sizeof(histograms))
+                else:
+                    ct.memmove(histograms, histogram_buff, ct.sizeof(histograms))
             # for i in range(len(self._members)):
             #     for j in range(len(self._members)):
             #         logging.debug(
@@ -195,6 +479,57 @@ class HealthReport:
             #             f"jitter: {self.report[i][j].jitter.mean}\n"
             #             f"goodput: {self.report[i][j].goodput.mean}")
 
+    def update_retransmissions(self, retransmissions: int, dropped: int) -> None:
+        with self.__write_lock, self.seqlock.write(self.counts_slot):
+            self.counts.sim_retrans = retransmissions
+            self.counts.dropped_sim_frames = dropped
+
+    def metrics(self) -> SimpleNamespace:
+        """A copy of the latest health of the session, taken without
+        blocking the network threads. Each row and the totals are consistent,
+        but rows may be from different health requests.
+
+        Returns:
+            SimpleNamespace: labels, the name of each member. generations,
+            the number of reports received from each member. reports, an
+            array of NODE_REPORT_DTYPE where reports[i][j] is what member i
+            measured of the frames from member j. latency_histograms, where
+            latency_histograms[i][j] is the LATENCY_BUCKETS counts of the
+            latencies member i measured of member j, all zero if member i did
+            not send them. totals, the HealthCounts fields by name.
+        """
+        size = len(self.report)
+        generations = np.zeros(size, np.uint32)
+        reports = np.empty((size, size), NODE_REPORT_DTYPE)
+        histograms = np.empty((size, size, LATENCY_BUCKETS), np.uint16)
+        for i, (view, histogram) in enumerate(zip(self.__report_views, self.__histogram_views)):
+            generations[i], (reports[i], histograms[i]) = self.seqlock.read(
+                i, lambda: (view.copy(), histogram.copy()))
+        _, counts = self.seqlock.read(
+            self.counts_slot, lambda: HealthCounts.from_buffer_copy(self.counts))
+        return SimpleNamespace(
+            labels=self.labels,
+            generations=generations,
+            reports=reports,
+            latency_histograms=histograms,
+            totals={name: getattr(counts, name)
+                    for name, _ in HealthCounts._fields_})
+
+    def latency_percentiles(self, percentiles=(50, 99, 99.9)) -> np.ndarray:
+        """Latency percentiles of every edge in the latest reports, see
+        histogram_percentiles.
+
+        Args:
+            percentiles (optional): Percentiles between 0 and 100. Defaults
+            to (50, 99, 99.9).
+
+        Returns:
+            np.ndarray: Milliseconds, where [i][j][k] is percentile k of the
+            latencies member i measured of member j. NaN where member i sent
+            no histogram or received nothing from member j.
+        """
+        return histogram_percentiles(self.metrics().latency_histograms, percentiles)
+
     def start_display(
         self,
         stop_event: Event,
@@ -202,10 +537,13 @@ class HealthReport:
         log_queue: mp.Queue,
         log_level: int
     ) -> None:
+        # matplotlib and seaborn are only imported when displayed.
+        from .NetworkMatrix import NetworkMatrix
         try:
+            self._matrix = NetworkMatrix(len(self.__members), self.labels)
             self.__matrix_proc = mp.Process(
                 target=self._matrix.animate,
-                args=(self.lock, stop_event, self.report, self.counts,
+                args=(self.seqlock, stop_event, self.report, self.counts,
                       output, log_queue, log_level),
                 daemon=True)
             self.__matrix_proc.start()
@@ -214,10 +552,11 @@ class HealthReport:
 
     def stop_display(self) -> None:
         try:
-            if hasattr(self, "matrix_proc") and self.__matrix_proc is not None:
+            if self.__matrix_proc is not None:
                 self.__matrix_proc.terminate()
                 self.__matrix_proc.join(1)
                 self.__matrix_proc.close()
+                self.__matrix_proc = None
         except Exception as e:
             logging.error(e, exc_info=True)
 
@@ -0,0 +1,233 @@
+from __future__ import annotations
+
+import logging
+import threading as th
+from http import HTTPStatus
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable
+
+import numpy as np
+
+from .HealthReport import HealthCounts, HealthReport
+
+CONTENT_TYPE = "application/openmetrics-text; version=1.0.0; charset=utf-8"
+LATENCY_BUCKETS = (0.5, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+PACKET_LOSS_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200, 500)
+# HealthCounts field -> metric family and help.
+TOTALS = {
+    "sim_frames": ("canlay_sim_frames", "Simulator frames sent in the session."),
+    "can_frames": ("canlay_can_frames", "CAN frames received in the session."),
+    "dropped_sim_frames": ("canlay_dropped_sim_frames",
+                           "Simulator frames given up on after every retransmission."),
+    "dropped_can_frames": ("canlay_dropped_can_frames", "CAN frames dropped in the session."),
+    "sim_retrans": ("canlay_sim_retransmissions", "Simulator frames retransmitted in the session."),
+}
+assert set(TOTALS) == {name for name, _ in HealthCounts._fields_}
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", r"\\").replace('"', r'\"').replace("\n", r"\n")
+
+
+def _labels(**labels: str) -> str:
+    pairs = ",".join(f'{k}="{_escape(v)}"' for k, v in labels.items() if v is not None)
+    return "{" + pairs + "}" if pairs else ""
+
+
+class _EdgeHistogram:
+    def __init__(self, size: int, buckets) -> None:
+        """Histogram of one statistic for every (reporter, source) pair of
+        session members."""
+        self.bounds = np.array(buckets, float)
+        # The last bucket is +Inf.
+        self.buckets = np.zeros((size, size, len(buckets) + 1), np.int64)
+        self.sum = np.zeros((size, size))
+        self.count = np.zeros((size, size), np.int64)
+
+    def observe(self, reporter: int, values: np.ndarray) -> None:
+        """Adds the values reporter measured of every source."""
+        bucket = np.searchsorted(self.bounds, values)
+        self.buckets[reporter, np.arange(len(values)), bucket] += 1
+        self.sum[reporter] += values
+        self.count[reporter] += 1
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self) -> None:
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(HTTPStatus.NOT_FOUND)
+            return
+        body = self.server.exporter.render()  # type: ignore
+        self.send_response(HTTPStatus.OK)
+        self.send_header("Content-Type", CONTENT_TYPE)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format: str, *args) -> None:
+        logging.debug(f"Metrics: {format % args}")
+
+
+class MetricsExporter:
+    def __init__(self, port=9464, host="127.0.0.1", poll_interval=0.25,
+                 bench: str | None = None) -> None:
+        """Serves the health of the session at http://host:port/metrics in
+        the OpenMetrics text format.
+
+        A thread polls the shared reports of the attached HealthReport,
+        which never holds up the network threads. Each new report is added to
+        per edge histograms of packet loss, latency and jitter and to the
+        packet loss and goodput counters, so nothing is missed between
+        scrapes. A member that reports more than once between polls only has
+        its latest report added, the others are counted as skipped.
+
+        Args:
+            port (int, optional): Port to listen on. Defaults to 9464.
+            host (str, optional): Address to listen on. Defaults to
+            127.0.0.1.
+            poll_interval (float, optional): Seconds between polls of the
+            reports, which arrive about once a second per member. Defaults to
+            0.25.
+            bench (str, optional): Added as the bench label of every metric,
+            to tell benches scraped into one Prometheus apart. Defaults to
+            None.
+        """
+        self.port = port
+        self.host = host
+        self.poll_interval = poll_interval
+        self.bench = bench
+        self.__lock = th.Lock()
+        self.__stop = th.Event()
+        self.__server: ThreadingHTTPServer | None = None
+        self.__threads: list[th.Thread] = []
+        # (type, family, help, read)
+        self.__sources: list[tuple[str, str, str, Callable[[], float]]] = []
+        self.__health_report: HealthReport | None = None
+
+    def add_counter(self, family: str, help_text: str, read: Callable[[], float]) -> None:
+        """Exports read() as the counter family_total."""
+        self.__sources.append(("counter", family, help_text, read))
+
+    def add_gauge(self, family: str, help_text: str, read: Callable[[], float]) -> None:
+        self.__sources.append(("gauge", family, help_text, read))
+
+    def attach(self, health_report: HealthReport) -> None:
+        """Exports the health of a new session. The per edge metrics start
+        over."""
+        size = len(health_report.labels)
+        with self.__lock:
+            self.__health_report = health_report
+            self.__seen = np.zeros(size, np.uint32)
+            self.__skipped = np.zeros(size, np.int64)
+            self.__packet_loss = _EdgeHistogram(size, PACKET_LOSS_BUCKETS)
+            self.__latency = _EdgeHistogram(size, LATENCY_BUCKETS)
+            self.__jitter = _EdgeHistogram(size, LATENCY_BUCKETS)
+            self.__lost = np.zeros((size, size), np.int64)
+            self.__goodput = np.zeros((size, size), np.int64)
+            self.__totals = {name: 0 for name in TOTALS}
+
+    def start(self) -> None:
+        self.__server = ThreadingHTTPServer((self.host, self.port), _MetricsHandler)
+        self.__server.daemon_threads = True
+        self.__server.exporter = self  # type: ignore
+        self.__stop.clear()
+        self.__threads = [
+            th.Thread(target=self.__server.serve_forever, daemon=True),
+            th.Thread(target=self.__poll, daemon=True)
+        ]
+        for thread in self.__threads:
+            thread.start()
+        logging.info(f"Serving metrics on http://{self.host}:{self.port}/metrics")
+
+    def stop(self) -> None:
+        self.__stop.set()
+        if self.__server is not None:
+            self.__server.shutdown()
+            self.__server.server_close()
+            self.__server = None
+        for thread in self.__threads:
+            thread.join(1)
+        self.__threads = []
+
+    def __poll(self) -> None:
+        while not self.__stop.wait(self.poll_interval):
+            try:
+                self.observe()
+            except Exception as e:
+                logging.error(e, exc_info=True)
+
+    def observe(self) -> None:
+        """Adds the reports received since the last call."""
+        with self.__lock:
+            if self.__health_report is None:
+                return
+            metrics = self.__health_report.metrics()
+            # Generations count the reports received, wrapping at 2^32.
+            received = (metrics.generations - self.__seen).astype(np.int64)
+            self.__skipped += np.maximum(received - 1, 0)
+            for reporter in np.flatnonzero(metrics.generations != self.__seen):
+                report = metrics.reports[reporter]
+                self.__packet_loss.observe(reporter, report["packetLoss"])
+                self.__latency.observe(reporter, report["latency"]["mean"])
+                self.__jitter.observe(reporter, report["jitter"]["mean"])
+                self.__lost[reporter] += report["packetLoss"]
+                self.__goodput[reporter] += report["goodput"]
+            self.__seen = metrics.generations
+            self.__totals = metrics.totals
+
+    def render(self) -> bytes:
+        lines: list[str] = []
+        bench = self.bench
+        for kind, family, help_text, read in self.__sources:
+            try:
+                value = read()
+            except Exception as e:
+                # Such as Queue.qsize on platforms without sem_getvalue.
+                logging.debug(f"Metrics: {family}: {e}")
+                continue
+            suffix = "_total" if kind == "counter" else ""
+            lines += [f"# TYPE {family} {kind}", f"# HELP {family} {help_text}",
+                      f"{family}{suffix}{_labels(bench=bench)} {value}"]
+        with self.__lock:
+            if self.__health_report is not None:
+                self.__render_health(lines)
+        lines.append("# EOF\n")
+        return "\n".join(lines).encode()
+
+    def __render_health(self, lines: list[str]) -> None:
+        bench = self.bench
+        for name, (family, help_text) in TOTALS.items():
+            lines += [f"# TYPE {family} counter", f"# HELP {family} {help_text}",
+                      f"{family}_total{_labels(bench=bench)} {self.__totals[name]}"]
+        names = self.__health_report.labels  # type: ignore
+        family = "canlay_health_reports_skipped"
+        lines += [f"# TYPE {family} counter",
+                  f"# HELP {family} Reports replaced by a newer one before they were polled."]
+        lines += [f"{family}_total{_labels(bench=bench, reporter=name)} {skipped}"
+                  for name, skipped in zip(names, self.__skipped)]
+        # A member does not report on itself.
+        edges = [(r, s) for r in range(len(names)) for s in range(len(names)) if r != s]
+        for family, help_text, totals in (
+                ("canlay_edge_packets_lost", "Packets reporter found missing from source.",
+                 self.__lost),
+                ("canlay_edge_goodput_bytes", "Payload bytes reporter received from source.",
+                 self.__goodput)):
+            lines += [f"# TYPE {family} counter", f"# HELP {family} {help_text}"]
+            lines += [f"{family}_total{_labels(bench=bench, reporter=names[r], source=names[s])} "
+                      f"{totals[r, s]}" for r, s in edges]
+        for family, help_text, histogram in (
+                ("canlay_edge_packet_loss", "Packets lost per health report.",
+                 self.__packet_loss),
+                ("canlay_edge_latency_milliseconds", "Mean latency per health report.",
+                 self.__latency),
+                ("canlay_edge_jitter_milliseconds", "Jitter per health report.",
+                 self.__jitter)):
+            lines += [f"# TYPE {family} histogram", f"# HELP {family} {help_text}"]
+            bounds = [repr(float(b)) for b in histogram.bounds] + ["+Inf"]
+            cumulative = np.cumsum(histogram.buckets, axis=2)
+            for r, s in edges:
+                labels = dict(bench=bench, reporter=names[r], source=names[s])
+                lines += [f"{family}_bucket{_labels(**labels, le=le)} {n}"
+                          for le, n in zip(bounds, cumulative[r, s])]
+                lines += [f"{family}_count{_labels(**labels)} {histogram.count[r, s]}",
+                          f"{family}_sum{_labels(**labels)} {float(histogram.sum[r, s])!r}"]
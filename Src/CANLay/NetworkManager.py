@@ -8,19 +8,32 @@ import threading as th
 from ipaddress import IPv4Address
 from queue import Full
 from time import sleep
+from typing import Sequence
 
+from . import Codec
 from .CANNode import CAN_message, Member_Node, WCANBlock
 from .Environment import OutputType as OT
-from .HealthReport import HealthReport, NetworkStats, NodeReport
+from .HealthReport import HealthReport, LatencyHistogram, NetworkStats, NodeReport
 from .HTTPClient import HTTPClient
+from .OutputRing import OutputRing
+from .Recorder import FD_FLAGS_MASK, FLAG_FD, FLAG_NEED_RESPONSE, Direction
+from .Retransmission import InFlightFrame, RetransmissionScheduler
 from .SensorNode import SensorNode, WSenseBlock
 
-COM_PACKED_HEAD_SIZE = 14
+COM_PACKED_HEAD_SIZE = Codec.COM_PACKED_HEAD_SIZE
+
+
+class WCANBatch(ct.Structure):
+    _pack_ = 4
+    _fields_ = [
+        ("count", ct.c_uint16)
+    ]
 
 
 class WCOMMFrame(ct.Union):
     _fields_ = [
         ("canFrame", WCANBlock),
+        ("batchFrame", WCANBatch),
         ("sensorFrame", WSenseBlock),
         ("healthFrame", ct.POINTER(NodeReport)),
         ("timeFrame", ct.c_uint64)
@@ -47,6 +60,8 @@ class COMMBlock(ct.Structure):
             s += f'Frame:\n{self.frame.canFrame}\n'
         elif self.type == 2:
             s += f'Frame:\n{self.frame.sensorFrame}\n'
+        elif self.type == 9:
+            s += f'Batched CAN Frames: {self.frame.batchFrame.count}\n'
         return s
 
 
@@ -73,22 +88,39 @@ class NetworkManager(SensorNode, HTTPClient):
         # Parameters for efficient communication
         self.__node_report: ct.Array[NodeReport]
         self.__report_size = 0
+        # Latency histograms that SSSFs append to their health replies.
+        self.__latency_histograms: ct.Array[LatencyHistogram]
+        self.__histograms_size = 0
         self.__msg_in: COMMBlock
         self.__msg_out: COMMBlock
-        self._output_buffer = []
-        self._output_buffer_lock = th.Lock()
+        # One reusable transmit buffer per message type. Each type is only
+        # ever written from one thread so the buffers are never shared.
+        self.__tx_buffers = {
+            t: bytearray(Codec.MAX_DATAGRAM_SIZE) for t in (1, 2, 3, 5, 6, 8)}
+        # Batched CAN transmissions are packed back to back into this buffer,
+        # which grows to fit the largest batch seen so far.
+        self.__batch_buffer = bytearray(Codec.MAX_DATAGRAM_SIZE)
+        self.__batch_block = WCANBlock()
+        # CAN and simulator frames for the TUI, recorder and other consumers,
+        # and the consumer slot handed out with OT.START_SESSION
+        self._output_ring: OutputRing
+        self._output_consumer: int
         # Paramters for retransmissions
-        self.__sensor_msg_buffer = None
         self.__max_retransmissions = retransmissions
-        self.__max_retrans_notified = False
-        self.__attempts = 0
-        self.__timeout = None
         self._timeout_additive = round((1/60), 3)
         if retransmissions > 0:
             self._timeout_additive = round(
                 (self._timeout_additive / retransmissions), 3)
         logging.debug(f"Timeout additive: {self._timeout_additive}")
-        self.__times_retrans = 0
+        # Sensor frames stay in flight until every member has acknowledged
+        # them. _timeout_additive is only the initial timeout, after that it
+        # adapts to the round trip time measured for each member.
+        self._retransmitter = RetransmissionScheduler(
+            retransmissions, self._timeout_additive)
+        self.__unresponsive: set[int] = set()
+        # Received datagrams, or CAN blocks of batches, that were too short
+        # to decode and were dropped.
+        self.decode_errors = 0
         # Events and Queues for threads
         self.stop_event: th.Event
         self.in_session: th.Event
@@ -105,12 +137,14 @@ class NetworkManager(SensorNode, HTTPClient):
                 member["ID"], member["Devices"])
         self.__msg_in = COMMBlock()
         self.__msg_out = COMMBlock()
-        with self._output_buffer_lock:
-            self._output_buffer.clear()
         self.network_stats = NetworkStats(len(self.members))
         self.__report_size = ct.sizeof(NodeReport) * len(self.members)
         self.__node_report = (NodeReport * len(self.members))()
-        self.output.put((OT.START_SESSION, ""))
+        self.__latency_histograms = (LatencyHistogram * len(self.members))()
+        self.__histograms_size = ct.sizeof(self.__latency_histograms)
+        self._retransmitter.reset()
+        self.__unresponsive.clear()
+        self.output.put((OT.START_SESSION, (self._output_ring.name, self._output_consumer)))
         self._initial_health_report_wait = True  # wait for clocks to sync
 
     def stop_session(self) -> None:
@@ -134,14 +168,21 @@ class NetworkManager(SensorNode, HTTPClient):
             if self._initial_health_report_wait:
                 sleep(3.5)  # Wait for clocks to sync
                 self._initial_health_report_wait = False
-            self.health_report.update(
-                self._index,
-                self.network_stats.health_report,
-                self._frame_number)
-            with self.health_report.lock:
-                self.health_report.counts.sim_retrans = self.__times_retrans
-            self.network_stats.reset()
-            self.write_health_request()
+            self.publish_health()
+
+    def publish_health(self) -> None:
+        """Publishes the local network stats and asks the session members
+        for theirs. request_health wraps this with the blocking waits used by
+        the threaded engine."""
+        self.health_report.update(
+            self._index,
+            self.network_stats.health_report,
+            self._frame_number,
+            self.network_stats.latency_histogram)
+        self.health_report.update_retransmissions(
+            self._retransmitter.retransmissions, self._retransmitter.dropped)
+        self.network_stats.reset()
+        self.write_health_request()
 
     def write_sync(self) -> None:
         self.__msg_out.index = self._index
@@ -150,9 +191,7 @@ class NetworkManager(SensorNode, HTTPClient):
         self.sending_sync = True
         self.sync_timestamp = self.time_us()
         self.__msg_out.timestamp = self.sync_timestamp
-        buffer = bytearray()
-        self.pack_commblock(self.__msg_out, buffer)
-        self.write(buffer, 5)
+        self.write(self.pack_commblock(self.__msg_out), 5)
 
     def write_follow_up(self) -> None:
         self.__msg_out.index = self._index
@@ -160,9 +199,7 @@ class NetworkManager(SensorNode, HTTPClient):
         self.__msg_out.frame_number = self._frame_number
         self.__msg_out.timestamp = self._sync_sent_timestamp
         self.__msg_out.frame.timeFrame = self.sync_timestamp
-        buffer = bytearray()
-        self.pack_commblock(self.__msg_out, buffer)
-        self.write(buffer, 6)
+        self.write(self.pack_commblock(self.__msg_out), 6)
 
     def write_delay_resp(self, index: int, delay_req_time: int) -> None:
         self.__msg_out.index = index
@@ -170,18 +207,14 @@ class NetworkManager(SensorNode, HTTPClient):
         self.__msg_out.frame_number = self._frame_number
         self.__msg_out.timestamp = self.__recv_timestamp
         self.__msg_out.frame.timeFrame = delay_req_time
-        buffer = bytearray()
-        self.pack_commblock(self.__msg_out, buffer)
-        self.write(buffer, 8)
+        self.write(self.pack_commblock(self.__msg_out), 8)
 
     def write_health_request(self) -> None:
         self.__msg_out.index = self._index
         self.__msg_out.type = 3
         self.__msg_out.frame_number = self._frame_number
         self.__msg_out.timestamp = self.time_us()
-        buffer = bytearray()
-        self.pack_commblock(self.__msg_out, buffer)
-        self.write(buffer, 3)
+        self.write(self.pack_commblock(self.__msg_out), 3)
 
     def read_signals(self, key: sel.SelectorKey) -> None:
         try:
@@ -202,8 +235,6 @@ class NetworkManager(SensorNode, HTTPClient):
         if l > 16:
             l = 16
             logging.warning("Too many signals to send, truncating to 16.")
-        self.__attempts = 0
-        self.__max_retrans_notified = False
         for i in range(l):
             self._signals_tx[i] = signals[i]
         self.__msg_out.index = self._index
@@ -213,10 +244,15 @@ class NetworkManager(SensorNode, HTTPClient):
         self.__msg_out.timestamp = self.time_us()
         self.__msg_out.frame.sensorFrame.num_signals = l
         self.__msg_out.frame.sensorFrame.signals = self._signals_tx
-        self.__sensor_msg_buffer = bytearray()
-        self.pack_commblock(self.__msg_out, self.__sensor_msg_buffer)
-        self._output_buffer.append((OT.SIM_MSG, (self.time_us(), *signals)))
-        self.write(self.__sensor_msg_buffer, 2)
+        sensor_msg = self.pack_commblock(self.__msg_out)
+        self._output_ring.write_sim(self.time_us(), signals)
+        self.write(sensor_msg, 2)
+        # The transmit buffer is reused for the next frame so the scheduler
+        # keeps its own copy of the datagram.
+        given_up = self._retransmitter.track(
+            self.__msg_out.frame_number, sensor_msg,
+            range(1, len(self.members)), self.__msg_out.timestamp / 1000000)
+        self.__report_given_up(given_up)
 
     def write_can(self, need_response: bool, fd: bool, msg: CAN_message) -> None:
         with self._sel_lock:
@@ -237,82 +273,165 @@ class NetworkManager(SensorNode, HTTPClient):
                 self.__msg_out.frame.canFrame.frame.can.can_id = msg.can_id
                 self.__msg_out.frame.canFrame.frame.can.len = msg.len
                 self.__msg_out.frame.canFrame.frame.can.buf = msg.buf
-            buffer = bytearray()
-            self.pack_commblock(self.__msg_out, buffer)
-            with self._output_buffer_lock:
-                self._output_buffer.append((OT.CAN_MSG, (
-                    self.__msg_out.timestamp,
-                    f"{self.__msg_out.frame.canFrame.frame.can.can_id:08X}",
-                    self.__msg_out.frame.canFrame.frame.can.len,
-                    bytes(self.__msg_out.frame.canFrame.frame.can.buf).hex().upper())))
+            buffer = self.pack_commblock(self.__msg_out)
+            self.__output_can(self.__msg_out.timestamp, self.__msg_out.frame.canFrame,
+                              Direction.TX, self._index)
             self.write(buffer, 1)
             self.output.put((OT.NOTIFY, "CAN frame sent."))
 
+    def write_can_batch(self,
+                        need_response: bool,
+                        fd: bool,
+                        msgs: Sequence[CAN_message],
+                        container=False,
+                        notify=True) -> None:
+        """Sends many CAN frames while taking the selector lock once.
+
+        Args:
+            need_response (bool): Whether the frames need a response.
+            fd (bool): Whether the frames are CAN-FD frames.
+            msgs (Sequence[CAN_message]): The frames to send, in order.
+            container (bool, optional): Pack as many frames as fit into each
+            type 9 datagram instead of sending one type 1 datagram per frame.
+            Only CANLay receivers understand type 9 so leave this off when SSSFs
+            are session members. Defaults to False.
+            notify (bool, optional): Put a notice on the output queue once the
+            frames are sent. Defaults to True.
+        """
+        if len(msgs) == 0:
+            return
+        with self._sel_lock:
+            max_size = len(msgs) * (COM_PACKED_HEAD_SIZE + Codec.CAN_BLOCK_MAX_SIZE)
+            if len(self.__batch_buffer) < max_size:
+                self.__batch_buffer = bytearray(max_size)
+            buffer = self.__batch_buffer
+            view = memoryview(buffer)
+            block = self.__batch_block
+            block.need_response = need_response
+            block.fd = fd
+            self.__msg_out.index = self._index
+            self.__msg_out.type = 9 if container else 1
+            self.__msg_out.frame_number = self._frame_number
+            self.__msg_out.timestamp = self.time_us()
+            datagrams = []
+            start = offset = count_offset = count = 0
+            for msg in msgs:
+                block.sequence_number = self._sequence_number
+                self._sequence_number += 1
+                if fd:
+                    block.can_fd.can_id = msg.can_id
+                    block.can_fd.len = msg.len
+                    block.can_fd.flags = msg.flags
+                    block.can_fd.buf = msg.buf
+                else:
+                    block.can.can_id = msg.can_id
+                    block.can.len = msg.len
+                    block.can.buf = msg.buf
+                if not container:
+                    start = offset
+                    offset = Codec.pack_header(self.__msg_out, buffer, offset)
+                    offset = Codec.pack_canblock(block, buffer, offset)
+                    datagrams.append(view[start:offset])
+                else:
+                    # Start a new container when this frame would push the
+                    # current one past the receive slot size.
+                    full = (offset + Codec.CAN_BLOCK_MAX_SIZE - start
+                            > Codec.MAX_DATAGRAM_SIZE)
+                    if count and full:
+                        Codec.pack_batch_count(count, buffer, count_offset)
+                        datagrams.append(view[start:offset])
+                        count = 0
+                    if count == 0:
+                        start = offset
+                        count_offset = Codec.pack_header(
+                            self.__msg_out, buffer, offset)
+                        offset = count_offset + Codec.BATCH_BLOCK.size
+                    offset = Codec.pack_canblock(block, buffer, offset)
+                    count += 1
+                self.__output_can(
+                    self.__msg_out.timestamp, block, Direction.TX, self._index)
+            if count:
+                Codec.pack_batch_count(count, buffer, count_offset)
+                datagrams.append(view[start:offset])
+            for datagram in datagrams:
+                super().write(datagram)
+            if notify:
+                self.output.put((OT.NOTIFY, f"{len(msgs)} CAN frames sent."))
+
     def write(self, msg: bytes, type: int) -> None:
         if type == 5:
             super().write(msg)
             self.write_follow_up()
-        if type != 2:
-            super().write(msg)
-        else:
-            if self.__max_retransmissions == 0:
-                super().write(msg)
-            elif self.__attempts <= self.__max_retransmissions:
-                self.__attempts += 1
-                self.__timeout = self.time_us() + self._timeout_additive
-                super().write(msg)
-
-    def pack_commblock(self, msg: COMMBlock, buffer: bytearray) -> None:
-        # Oddly enough this is 2x faster than using a static ctypes array and memmoves
-        buffer.extend(msg.index.to_bytes(1, "little"))
-        buffer.extend(msg.type.to_bytes(1, "little"))
-        buffer.extend(msg.frame_number.to_bytes(4, "little"))
-        buffer.extend(msg.timestamp.to_bytes(8, "little"))
-        if msg.type == 1:
-            self.pack_canblock(msg.frame.canFrame, buffer)
-        elif msg.type == 2:
-            self.pack_sensorblock(msg.frame.sensorFrame, buffer)
-        elif msg.type == 6 or msg.type == 8:
-            buffer.extend(msg.frame.timeFrame.to_bytes(8, "little"))
+        super().write(msg)
+
+    def pack_commblock(self, msg: COMMBlock) -> memoryview:
+        buffer = self.__tx_buffers[msg.type]
+        length = Codec.pack_into(msg, buffer, signals=self._signals_tx)
+        return memoryview(buffer)[:length]
 
     def read(self, key: sel.SelectorKey) -> None:
-        buffer = super().read()
+        datagrams = super().read()
         self.__recv_timestamp = self.time_us()
-        msg_len = len(buffer)
-        if msg_len >= COM_PACKED_HEAD_SIZE:
-            self.unpack_commblock(self.__msg_in, buffer, msg_len)
-            self.__process_commblock(self.__msg_in, msg_len)
-
-    def unpack_commblock(self, msg: COMMBlock, buffer: bytes, msg_len: int) -> None:
-        offset = 0
-        msg.index = int.from_bytes(buffer[offset:offset + 1], "little")
-        offset += 1
-        msg.type = int.from_bytes(buffer[offset:offset + 1], "little")
-        offset += 1
-        msg.frame_number = int.from_bytes(buffer[offset:offset + 4], "little")
-        offset += 4
-        msg.timestamp = int.from_bytes(buffer[offset:offset + 8], "little")
-        offset += 8
-        if msg.type == 1 and (msg_len - offset) > 6:
-            self.unpack_canblock(msg.frame.canFrame, buffer, offset)
-        elif msg.type == 2 and (msg_len - offset) > 1:
-            self.unpack_sensorblock(msg.frame.sensorFrame, buffer, offset)
-        elif msg.type == 4:
-            ct.memmove(self.__node_report,
-                       buffer[offset:], self.__report_size)
+        for buffer in datagrams:
+            msg_len = len(buffer)
+            if msg_len < COM_PACKED_HEAD_SIZE:
+                self.decode_errors += 1
+                continue
+            offset = self.unpack_commblock(self.__msg_in, buffer, msg_len)
+            if self.__msg_in.type in (1, 9) and offset == COM_PACKED_HEAD_SIZE:
+                # The frame did not fit, the block still holds the last one.
+                self.decode_errors += 1
+            elif self.__msg_in.type == 9:
+                self.__process_can_batch(self.__msg_in, buffer, offset, msg_len)
+            else:
+                self.__process_commblock(self.__msg_in, msg_len)
+
+    def unpack_commblock(self, msg: COMMBlock, buffer: memoryview, msg_len: int) -> int:
+        """Decodes the datagram in buffer into msg and returns the offset just
+        past what was decoded. For type 9 batches this is the offset of the
+        first contained CAN block."""
+        return Codec.unpack_from(msg, buffer, msg_len, signals=self._signals_rx,
+                                 report=self.__node_report,
+                                 histograms=self.__latency_histograms)
+
+    def __process_can_batch(self, msg: COMMBlock, buffer: memoryview, offset: int, msg_len: int) -> None:
+        self.members[msg.index].last_received_frame = msg.frame_number
+        self.__ack(msg.index, msg.frame_number)
+        count = msg.frame.batchFrame.count
+        for _ in range(count):
+            if msg_len - offset < Codec.CAN_BLOCK.size:
+                logging.warning(
+                    f"Truncated CAN batch from device with index {msg.index}.")
+                self.decode_errors += 1
+                break
+            start = offset
+            offset = Codec.unpack_canblock(
+                msg.frame.canFrame, buffer, offset, msg_len)
+            self.__process_can(msg, offset - start)
+
+    def __process_can(self, msg: COMMBlock, msg_len: int) -> None:
+        self.members[msg.index].last_seq_num = msg.frame.canFrame.sequence_number
+        self.network_stats.update(msg.index, msg_len, msg.timestamp,
+                                  msg.frame.canFrame.sequence_number, self.__recv_timestamp)
+        self.__output_can(msg.timestamp, msg.frame.canFrame, Direction.RX, msg.index)
+
+    def __output_can(self, timestamp: int, block: WCANBlock, direction: Direction, index: int) -> None:
+        # The payload is kept raw, consumers format it if they need text.
+        flags = FLAG_NEED_RESPONSE if block.need_response else 0
+        if block.fd:
+            frame = block.can_fd
+            flags |= FLAG_FD | (frame.flags & FD_FLAGS_MASK)
+        else:
+            frame = block.can
+        length = frame.len
+        self._output_ring.write_can(timestamp, frame.can_id, length,
+                                    bytes(frame.buf[:length]), flags, direction, index)
 
     def __process_commblock(self, msg: COMMBlock, msg_len: int) -> None:
         if msg:
             self.members[msg.index].last_received_frame = msg.frame_number
             if msg.type == 1:
-                self.members[msg.index].last_seq_num = msg.frame.canFrame.sequence_number
-                self.network_stats.update(msg.index, msg_len, msg.timestamp,
-                                          msg.frame.canFrame.sequence_number, self.__recv_timestamp)
-                with self._output_buffer_lock:
-                    self._output_buffer.append((OT.CAN_MSG, (msg.timestamp,
-                                                f"{msg.frame.canFrame.frame.can.can_id:08X}",
-                                                msg.frame.canFrame.frame.can.len,
-                                                bytes(msg.frame.canFrame.frame.can.buf).hex().upper())))
+                self.__process_can(msg, msg_len)
             elif msg.type == 4:
                 # count = 0
                 # for i in self._node_report:
@@ -324,33 +443,43 @@ class NetworkManager(SensorNode, HTTPClient):
                 #         f"latency: {i.latency.mean}\n"
                 #         f"jitter: {i.jitter.mean}\n")
                 #     count += 1
+                # Older firmware, and sessions too large for the histograms
+                # to fit in a datagram, send the reports alone.
+                has_histograms = (msg_len >= COM_PACKED_HEAD_SIZE + self.__report_size
+                                  + self.__histograms_size)
                 self.health_report.update(
-                    msg.index, self.__node_report, self.members[msg.index].last_seq_num)
+                    msg.index, self.__node_report, self.members[msg.index].last_seq_num,
+                    self.__latency_histograms if has_histograms else None)
             elif msg.type == 7:  # This is a delay request we need to respond immediately
                 self.write_delay_resp(msg.index, msg.timestamp)
-            if msg.frame_number == self._frame_number:
-                self.__timeout = None
+            self.__ack(msg.index, msg.frame_number)
+
+    def __ack(self, index: int, frame_number: int) -> None:
+        # Every message from a member carries the number of the last sensor
+        # frame it received, which acknowledges all frames up to it.
+        self._retransmitter.ack(
+            index, frame_number, self.__recv_timestamp / 1000000)
+        self.__unresponsive.discard(index)
+
+    def retransmit_timeout(self) -> float:
+        """Seconds until the next in flight sensor frame times out, at most
+        _timeout_additive. Used as the select timeout so retransmissions are
+        not delayed by an idle socket."""
+        return self._retransmitter.next_timeout(
+            self.time_us() / 1000000, self._timeout_additive)
 
     def check_members(self, now: float) -> None:
-        if self.__timeout and (now >= self.__timeout):
-            for member in self.members[1:]:
-                if self.__recvd_frame(member, now):
-                    break
-
-    def __recvd_frame(self, member: Member_Node, now: float) -> bool:
-        if member.last_received_frame != self._frame_number:
-            if self.__attempts <= self.__max_retransmissions:
-                self.__times_retrans += 1
-                self.__timeout = now + self._timeout_additive
-                if self.__sensor_msg_buffer:
-                    self.write(self.__sensor_msg_buffer, 2)
-            elif not self.__max_retrans_notified:
+        resend, given_up = self._retransmitter.expire(now)
+        for frame in resend:
+            self.write(frame.datagram, 2)
+        self.__report_given_up(given_up)
+
+    def __report_given_up(self, frames: list[InFlightFrame]) -> None:
+        for frame in frames:
+            for index in frame.pending - self.__unresponsive:
                 logging.error(
-                    f"Have not received frame {self._frame_number} "
-                    f"from device with index number {member.id} after "
+                    f"Have not received frame {frame.frame_number} "
+                    f"from device with index number {index} after "
                     f"{self.__max_retransmissions} attempts."
                 )
-                self.__max_retrans_notified = True
-            return False
-        else:
-            return True
+            self.__unresponsive.update(frame.pending)
@@ -1,44 +1,44 @@
 from __future__ import annotations
 
-import copy
 import logging
 import multiprocessing as mp
 from multiprocessing.synchronize import Event
 from time import sleep, time
-from types import SimpleNamespace
 from typing import Tuple
 
 import matplotlib.pyplot as plt
+import numpy as np
 import seaborn as sns
 from matplotlib import animation
 from matplotlib.widgets import Button
 from mpl_toolkits.axes_grid1 import make_axes_locatable
-from pandas import DataFrame
 
 from .Environment import CANLayLogger
 from .Environment import OutputType as OT
+from .HealthReport import HealthCounts, SeqLock
+
+# Index of each statistic in the history and predictions.
+PACKET_LOSS, LATENCY, JITTER, GOODPUT = range(4)
+# Samples of each statistic the predictions are the EMA of.
+HISTORY = 8
+ALPHA = 2 / (HISTORY + 1)
+# Sliding the EMA window by one sample moves this much weight from the
+# evicted sample to the new oldest one.
+EVICTED_WEIGHT = (1 - ALPHA) ** HISTORY
 
 
 class NetworkMatrix:
     def __init__(self, num_members: int, labels: list[str]) -> None:
         self.__current_stat = "packetLoss"
         self.__num_members = num_members
-        zero_matrix = [[0.0] * num_members] * num_members
-        historical_matrix = [[[0.0] * 8] * num_members] * num_members
-        # self._base_frame = DataFrame(zero_matrix, columns=list(reversed(labels)), index=labels)
-        self.__base_frame = DataFrame(zero_matrix, columns=labels, index=labels)
-        self.__reports = SimpleNamespace(
-            packetLoss=copy.deepcopy(historical_matrix),
-            latency=copy.deepcopy(historical_matrix),
-            jitter=copy.deepcopy(historical_matrix),
-            goodput=copy.deepcopy(historical_matrix)
-        )
-        self.__predict = SimpleNamespace(
-            packetLoss=self.__base_frame.copy(deep=True),
-            latency=self.__base_frame.copy(deep=True),
-            jitter=self.__base_frame.copy(deep=True),
-            goodput=self.__base_frame.copy(deep=True)
-        )
+        self.__labels = labels
+        # Ring of the last HISTORY samples of each statistic per member pair,
+        # slot rotation % HISTORY holding the oldest.
+        self.__history = np.zeros((4, num_members, num_members, HISTORY))
+        # EMA over the history, oldest sample first.
+        self.__predict = np.zeros((4, num_members, num_members))
+        self.__samples = np.zeros((4, num_members))
+        self.__counts = HealthCounts()
         self.__current_rotation = 0
         self.__current_member = 0
 
@@ -50,25 +50,25 @@ class NetworkMatrix:
         ax.set(xlim=(0, 1), ylim=(0, 1), xticklabels=[],
                yticklabels=[], xlabel=None, ylabel=None, aspect=1)
         ax.set_axis_off()
-        with self._lock:
-            ax.text(0, .9, "Simulator", fontsize=fs, fontweight="bold")
-            ax.text(.1, .79, "Count:", fontsize=fs)
-            ax.text(1, .79, f"{self._counts.sim_frames}",
-                    ha='right', fontsize=fs)
-            ax.text(.1, .68, "Dropped:", fontsize=fs)
-            ax.text(1, .68, f"{self._counts.dropped_sim_frames}",
-                    ha='right', fontsize=fs)
-            ax.text(.1, .57, "Retrans:", fontsize=fs)
-            ax.text(1, .57, f"{self._counts.sim_retrans}",
-                    ha='right', fontsize=fs)
-
-            ax.text(0, .35, "CAN", fontsize=fs, fontweight="bold")
-            ax.text(.1, .24, "Count:", fontsize=fs)
-            ax.text(1, .24, f"{self._counts.can_frames}",
-                    ha='right', fontsize=fs)
-            ax.text(.1, .13, "Dropped:", fontsize=fs)
-            ax.text(1, .13, f"{self._counts.dropped_can_frames}",
-                    ha='right', fontsize=fs)
+        counts = self.__counts
+        ax.text(0, .9, "Simulator", fontsize=fs, fontweight="bold")
+        ax.text(.1, .79, "Count:", fontsize=fs)
+        ax.text(1, .79, f"{counts.sim_frames}",
+                ha='right', fontsize=fs)
+        ax.text(.1, .68, "Dropped:", fontsize=fs)
+        ax.text(1, .68, f"{counts.dropped_sim_frames}",
+                ha='right', fontsize=fs)
+        ax.text(.1, .57, "Retrans:", fontsize=fs)
+        ax.text(1, .57, f"{counts.sim_retrans}",
+                ha='right', fontsize=fs)
+
+        ax.text(0, .35, "CAN", fontsize=fs, fontweight="bold")
+        ax.text(.1, .24, "Count:", fontsize=fs)
+        ax.text(1, .24, f"{counts.can_frames}",
+                ha='right', fontsize=fs)
+        ax.text(.1, .13, "Dropped:", fontsize=fs)
+        ax.text(1, .13, f"{counts.dropped_can_frames}",
+                ha='right', fontsize=fs)
         return ax
 
     def __update_matrix(self, data, axes, cmap: str, title: str, vmin, vmax):
@@ -82,8 +82,8 @@ class NetworkMatrix:
             annot=True,
             # robust=True,
             square=True,
-            xticklabels="auto",
-            yticklabels="auto",
+            xticklabels=self.__labels,
+            yticklabels=self.__labels,
             cbar=True,
             cbar_ax=axes[1],
             ax=axes[0],
@@ -93,29 +93,29 @@ class NetworkMatrix:
     def __update_individual(self):
         axes = (self.ax, self.cbar_ax)
         if self.__current_stat == "packetLoss":
-            return (self.__update_matrix(self.__predict.packetLoss,
+            return (self.__update_matrix(self.__predict[PACKET_LOSS],
                                          axes, "rocket_r", "Packet Loss", 0, 10),)
         elif self.__current_stat == "latency":
-            return (self.__update_matrix(self.__predict.latency,
+            return (self.__update_matrix(self.__predict[LATENCY],
                                          axes, "rocket_r", "Latency (msec)", 0, 10),)
         elif self.__current_stat == "jitter":
-            return (self.__update_matrix(self.__predict.jitter,
+            return (self.__update_matrix(self.__predict[JITTER],
                                          axes, "rocket_r", "Jitter (msec)", 0, 10),)
         elif self.__current_stat == "goodput":
-            return (self.__update_matrix((self.__predict.goodput * 8)/1000.0,
+            return (self.__update_matrix((self.__predict[GOODPUT] * 8)/1000.0,
                                          axes, "rocket", "Goodput (Kb/s)", 0, 10),)
         elif self.__current_stat == "totals":
             self.cbar_ax.cla()
             return (self.__update_totals(self.ax),)
 
     def __update_other(self):
-        ax = self.__update_matrix(self.__predict.packetLoss,
+        ax = self.__update_matrix(self.__predict[PACKET_LOSS],
                                   (self.ax, self.cbar_ax), "rocket_r", "Packet Loss", 0, 10)
-        ax1 = self.__update_matrix(self.__predict.latency,
+        ax1 = self.__update_matrix(self.__predict[LATENCY],
                                    (self.ax1, self.cbar_ax1), "rocket_r", "Latency (msec)", 0, 10)
-        ax2 = self.__update_matrix(self.__predict.jitter,
+        ax2 = self.__update_matrix(self.__predict[JITTER],
                                    (self.ax2, self.cbar_ax2), "rocket_r", "Jitter (msec)", 0, 10)
-        ax3 = self.__update_matrix((self.__predict.goodput * 8)/1000.0,
+        ax3 = self.__update_matrix((self.__predict[GOODPUT] * 8)/1000.0,
                                    (self.ax3, self.cbar_ax3), "rocket", "Goodput (Kb/s)", 0, 10)
         if self.display_totals:
             ax4 = self.__update_totals(self.ax4)
@@ -229,62 +229,59 @@ class NetworkMatrix:
             axes[1][2].set_axis_off()
         plt.subplots_adjust(left=lb, right=rt, bottom=lb, top=rt)
 
-    def __rotate(self, l, n):
-        return l[n:] + l[:n]
-
-    def __ema(self, points):
-        alpha = 2 / (len(points) + 1)
-        # initialize the exponential moving average
-        moving_average = [points[0]]
-
-        # loop through the points and calculate the moving average
-        for i in range(1, len(points)):
-            moving_average.append(
-                alpha * points[i] + (1 - alpha) * moving_average[i - 1])
-
-        return moving_average[-1]
+    def __add_samples(self, index: int, k: int) -> None:
+        """Replaces the oldest sample of member index's row with its latest
+        report and slides the EMA of the row over by it.
+
+        The EMA seeded with the oldest of the last HISTORY samples is slid in
+        O(1) per sample: decaying it and adding the new sample as usual, then
+        handing the evicted sample's share of the seed to the new oldest one.
+        """
+        _, row = self._seqlock.read(index, self.__rows[index].copy)
+        samples = self.__samples
+        samples[PACKET_LOSS] = row["packetLoss"]
+        samples[LATENCY] = row["latency"]["mean"]
+        samples[JITTER] = row["jitter"]["mean"]
+        samples[GOODPUT] = row["goodput"]
+        history = self.__history[:, index]
+        predict = self.__predict[:, index]
+        predict *= 1 - ALPHA
+        predict += ALPHA * samples
+        predict += EVICTED_WEIGHT * (history[..., (k + 1) % HISTORY] - history[..., k])
+        history[..., k] = samples
 
     def __update(self, frame):
         if self._stop_event.is_set():
             self.anim.event_source.stop()  # type: ignore
             return
-        with self._lock:
-            index = self.__current_member % self.__num_members
-            k = self.__current_rotation % 8
-            for i in range(self.__num_members):
-                self.__reports.packetLoss[index][i][k] = self._report[index][i].packetLoss
-                self.__predict.packetLoss.iloc[index, i] = self.__ema(
-                    self.__rotate(self.__reports.packetLoss[index][i], k))
-                self.__reports.goodput[index][i][k] = self._report[index][i].goodput
-                self.__predict.goodput.iloc[index, i] = self.__ema(
-                    self.__rotate(self.__reports.goodput[index][i], k))
-                self.__reports.latency[index][i][k] = self._report[index][i].latency.mean
-                self.__predict.latency.iloc[index, i] = self.__ema(
-                    self.__rotate(self.__reports.latency[index][i], k))
-                self.__reports.jitter[index][i][k] = self._report[index][i].jitter.mean
-                self.__predict.jitter.iloc[index, i] = self.__ema(
-                    self.__rotate(self.__reports.jitter[index][i], k))
-            self.__current_member += 1
-            if self.__current_member % self.__num_members == 0:
-                self.__current_member = 0
-                self.__current_rotation += 1
-            # for i in range(self.num_members):
-            #     for j in range(self.num_members):
-            #         logging.info(
-            #             f"Node {i} Member{j}: \n"
-            #             f"packetLoss: {self._report[i][j].packetLoss}\n"
-            #             f"latency: {self._report[i][j].latency.mean}\n"
-            #             f"jitter: {self._report[i][j].jitter.mean}\n"
-            #             f"goodput: {self._report[i][j].goodput.mean}")
-            try:
-                self._output.put((OT.TOTAL_STATS,
-                                  (self._counts.sim_frames, self._counts.dropped_sim_frames,
-                                   self._counts.sim_retrans,
-                                   self._counts.can_frames,
-                                   self._counts.dropped_can_frames)))
-            except EOFError:
-                self.anim.event_source.stop()  # type: ignore
-                return
+        # The shared reports are only read through the seqlock, so the
+        # network threads never wait on the redraw.
+        index = self.__current_member % self.__num_members
+        self.__add_samples(index, self.__current_rotation % HISTORY)
+        self.__current_member += 1
+        if self.__current_member % self.__num_members == 0:
+            self.__current_member = 0
+            self.__current_rotation += 1
+        # for i in range(self.num_members):
+        #     for j in range(self.num_members):
+        #         logging.info(
+        #             f"Node {i} Member{j}: \n"
+        #             f"packetLoss: {self._report[i][j].packetLoss}\n"
+        #             f"latency: {self._report[i][j].latency.mean}\n"
+        #             f"jitter: {self._report[i][j].jitter.mean}\n"
+        #             f"goodput: {self._report[i][j].goodput.mean}")
+        _, counts = self._seqlock.read(
+            self.__num_members, lambda: HealthCounts.from_buffer_copy(self._counts))
+        self.__counts = counts
+        try:
+            self._output.put((OT.TOTAL_STATS,
+                              (counts.sim_frames, counts.dropped_sim_frames,
+                               counts.sim_retrans,
+                               counts.can_frames,
+                               counts.dropped_can_frames)))
+        except EOFError:
+            self.anim.event_source.stop()  # type: ignore
+            return
         if self.display_mode == "individual":
             return self.__update_individual()
         else:
@@ -321,7 +318,7 @@ class NetworkMatrix:
 
     def animate(
         self,
-        lock,
+        seqlock: SeqLock,
         stop_event: Event,
         report,
         counts,
@@ -336,9 +333,12 @@ class NetworkMatrix:
             log_level = logging.INFO
         CANLayLogger.worker_configure(log_queue, log_level)
         try:
-            self._lock = lock
+            # Slot i guards report[i], the last slot guards counts.
+            self._seqlock = seqlock
             self._stop_event = stop_event
             self._report = report
+            # Views of the shared reports, copied under the seqlock.
+            self.__rows = [np.frombuffer(r, np.dtype(r._type_)) for r in report]
             self._counts = counts
             self._output = output
             self.display_mode = display_mode
@@ -0,0 +1,205 @@
+from __future__ import annotations
+
+import struct
+import threading as th
+from multiprocessing import resource_tracker, shared_memory
+
+import numpy as np
+
+from .Recorder import (PAYLOAD_SIZE, RECORD, RECORD_DTYPE, Direction)
+
+# Shared memory layout:
+#   header  | magic, capacity, record size, max consumers, write sequence
+#   cursors | one (read sequence, active) slot per consumer
+#   records | capacity RECORD.size slots, indexed by sequence % capacity
+# The write sequence counts every record ever published. A record is written
+# into its slot before the sequence is advanced past it, so readers never see
+# a sequence whose record is not there yet.
+RING_MAGIC = b"CLRING\x00\x00"
+RING_HEADER = struct.Struct("<8sIII4x")
+SEQUENCE = struct.Struct("<Q")
+SEQUENCE_OFFSET = RING_HEADER.size
+HEADER_SIZE = 64
+CURSOR_DTYPE = np.dtype([("sequence", "<u8"), ("active", "u1"), ("_pad", "V7")])
+
+
+class OutputRing:
+    def __init__(self, name: str | None = None, capacity=65536, max_consumers=8, create=True) -> None:
+        """Single producer, multiple consumer ring of CAN and simulator
+        records in shared memory.
+
+        The producer (the controller process) packs each record straight into
+        the ring; every consumer (TUI, recorder, exporters) keeps its own read
+        sequence and copies out what is new, so nothing is pickled and the
+        producer never waits for a consumer. A consumer that falls capacity
+        records behind loses the oldest records, since the slot being written
+        may be one of them, and counts them.
+
+        Args:
+            name (str | None, optional): Shared memory name. Defaults to None
+            (a new unique name when creating).
+            capacity (int, optional): Records held. Defaults to 65536.
+            max_consumers (int, optional): Read cursors available. Defaults
+            to 8.
+            create (bool, optional): Create the ring, otherwise attach to the
+            existing ring called name. Defaults to True.
+        """
+        if create:
+            self.capacity = capacity
+            self.max_consumers = max_consumers
+            size = self.__records_offset(max_consumers) + capacity * RECORD.size
+            self.__shm = shared_memory.SharedMemory(name=name, create=True, size=size)
+            RING_HEADER.pack_into(self.__shm.buf, 0, RING_MAGIC, capacity,
+                                  RECORD.size, max_consumers)
+            SEQUENCE.pack_into(self.__shm.buf, SEQUENCE_OFFSET, 0)
+        else:
+            self.__shm = _attach(name)  # type: ignore
+            magic, self.capacity, record_size, self.max_consumers = \
+                RING_HEADER.unpack_from(self.__shm.buf, 0)
+            if magic != RING_MAGIC or record_size != RECORD.size:
+                self.__shm.close()
+                raise ValueError(f"{name} is not a CANLay output ring.")
+        self.name = self.__shm.name
+        self.__owner = create
+        self.__buf = self.__shm.buf
+        self.__records_at = self.__records_offset(self.max_consumers)
+        self.cursors = np.ndarray((self.max_consumers,), CURSOR_DTYPE,
+                                  buffer=self.__buf, offset=HEADER_SIZE)
+        self.records = np.ndarray((self.capacity,), RECORD_DTYPE,
+                                  buffer=self.__buf, offset=self.__records_at)
+        if create:
+            self.cursors["active"] = 0
+        self.__sequence = SEQUENCE.unpack_from(self.__buf, SEQUENCE_OFFSET)[0]
+        # Several threads of the controller produce records.
+        self.__lock = th.Lock()
+
+    @staticmethod
+    def __records_offset(max_consumers: int) -> int:
+        return HEADER_SIZE + max_consumers * CURSOR_DTYPE.itemsize
+
+    @classmethod
+    def attach(cls, name: str) -> OutputRing:
+        return cls(name, create=False)
+
+    @property
+    def sequence(self) -> int:
+        return SEQUENCE.unpack_from(self.__buf, SEQUENCE_OFFSET)[0]
+
+    def write_can(self, timestamp: int, can_id: int, length: int, data: bytes,
+                  flags: int, direction: int, index: int) -> None:
+        with self.__lock:
+            seq = self.__sequence
+            RECORD.pack_into(
+                self.__buf, self.__records_at + (seq % self.capacity) * RECORD.size,
+                timestamp, can_id, length, flags, direction, index, data)
+            self.__sequence = seq + 1
+            SEQUENCE.pack_into(self.__buf, SEQUENCE_OFFSET, seq + 1)
+
+    def write_sim(self, timestamp: int, signals) -> None:
+        n = min(len(signals), PAYLOAD_SIZE // 4)
+        data = struct.pack(f"<{n}f", *signals[:n])
+        self.write_can(timestamp, 0, n, data, 0, Direction.SIM, 0)
+
+    def add_consumer(self) -> int:
+        """Claims a read cursor starting at the next record written. Called
+        by the producer, which hands the id to the consumer process."""
+        with self.__lock:
+            free = np.flatnonzero(self.cursors["active"] == 0)
+            if len(free) == 0:
+                raise RuntimeError("No free output ring consumer slots.")
+            consumer = int(free[0])
+            self.cursors["sequence"][consumer] = self.__sequence
+            self.cursors["active"][consumer] = 1
+            return consumer
+
+    def remove_consumer(self, consumer: int) -> None:
+        self.cursors["active"][consumer] = 0
+
+    def backlog(self) -> int:
+        """Records the slowest consumer has yet to read, at most capacity."""
+        active = self.cursors["active"] == 1
+        if not active.any():
+            return 0
+        behind = self.sequence - int(self.cursors["sequence"][active].min())
+        return min(behind, self.capacity)
+
+    def reader(self, consumer: int) -> OutputRingReader:
+        return OutputRingReader(self, consumer)
+
+    def close(self) -> None:
+        # numpy views keep the buffer exported, drop them first.
+        del self.cursors, self.records
+        self.__buf = None  # type: ignore
+        self.__shm.close()
+        if self.__owner:
+            try:
+                self.__shm.unlink()
+            except FileNotFoundError:
+                pass
+
+
+class OutputRingReader:
+    def __init__(self, ring: OutputRing, consumer: int) -> None:
+        self.ring = ring
+        self.consumer = consumer
+        self.lost = 0
+
+    def read(self, max_records: int | None = None) -> np.ndarray:
+        """Returns a copy of the records published since the last read, in
+        RECORD_DTYPE."""
+        ring = self.ring
+        capacity = ring.capacity
+        cursor = int(ring.cursors["sequence"][self.consumer])
+        seq = ring.sequence
+        if seq - cursor > capacity:
+            self.lost += seq - cursor - capacity
+            cursor = seq - capacity
+        n = seq - cursor
+        if max_records is not None:
+            n = min(n, max_records)
+        start = cursor % capacity
+        end = start + n
+        if end <= capacity:
+            out = ring.records[start:end].copy()
+        else:
+            out = np.concatenate(
+                (ring.records[start:], ring.records[:end - capacity]))
+        # The producer may have lapped the reader while copying; drop the
+        # records whose slots were overwritten. The producer writes record
+        # sequence into its slot before advancing sequence, so the slot of
+        # record sequence - capacity may be torn as well.
+        overwritten = ring.sequence + 1 - capacity - cursor
+        if overwritten > 0:
+            overwritten = min(overwritten, n)
+            self.lost += overwritten
+            out = out[overwritten:]
+        ring.cursors["sequence"][self.consumer] = cursor + n
+        return out
+
+    def close(self) -> None:
+        self.ring.remove_consumer(self.consumer)
+
+
+def _attach(name: str) -> shared_memory.SharedMemory:
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)  # type: ignore
+    except TypeError:
+        pass
+    # Before Python 3.13 attaching registers the segment with the resource
+    # tracker, which unlinks it when the consumer exits (or, with a tracker
+    # shared with the producer, trips over the producer's own unregister).
+    # Only the producer owns the segment, so skip the registration.
+    with _attach_lock:
+        register = resource_tracker.register
+        resource_tracker.register = _skip_register
+        try:
+            return shared_memory.SharedMemory(name=name)
+        finally:
+            resource_tracker.register = register
+
+
+def _skip_register(name: str, rtype: str) -> None:
+    pass
+
+
+_attach_lock = th.Lock()
@@ -0,0 +1,138 @@
+from __future__ import annotations
+
+import ctypes as ct
+import ctypes.util
+import errno
+import logging
+import platform
+import socket as soc
+
+from .Codec import MAX_DATAGRAM_SIZE
+
+
+class iovec(ct.Structure):
+    _fields_ = [
+        ("iov_base", ct.c_void_p),
+        ("iov_len", ct.c_size_t)
+    ]
+
+
+class msghdr(ct.Structure):
+    _fields_ = [
+        ("msg_name", ct.c_void_p),
+        ("msg_namelen", ct.c_uint32),
+        ("msg_iov", ct.POINTER(iovec)),
+        ("msg_iovlen", ct.c_size_t),
+        ("msg_control", ct.c_void_p),
+        ("msg_controllen", ct.c_size_t),
+        ("msg_flags", ct.c_int)
+    ]
+
+
+class mmsghdr(ct.Structure):
+    _fields_ = [
+        ("msg_hdr", msghdr),
+        ("msg_len", ct.c_uint)
+    ]
+
+
+def _load_recvmmsg():
+    if platform.system() != "Linux":
+        return None
+    try:
+        libc = ct.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        recvmmsg = libc.recvmmsg
+    except (OSError, AttributeError):
+        return None
+    recvmmsg.argtypes = [ct.c_int, ct.c_void_p, ct.c_uint, ct.c_int, ct.c_void_p]
+    recvmmsg.restype = ct.c_int
+    return recvmmsg
+
+
+class ReceiveRing:
+    def __init__(self, slots=64, slot_size=MAX_DATAGRAM_SIZE, use_recvmmsg=True) -> None:
+        """Preallocated ring of datagram buffers for draining a UDP socket.
+
+        Every call to drain reads all pending datagrams (up to the number of
+        slots) straight into the ring and returns memoryviews over them, so no
+        per-datagram bytes objects are created. A view stays valid until the
+        ring wraps around to its slot again, i.e. for the next slots - 1
+        datagrams.
+
+        Args:
+            slots (int, optional): Number of datagrams the ring can hold.
+            Defaults to 64.
+            slot_size (int, optional): Largest datagram accepted. Defaults to
+            MAX_DATAGRAM_SIZE.
+            use_recvmmsg (bool, optional): Use the Linux recvmmsg syscall to
+            read a batch of datagrams at once when it is available, otherwise
+            fall back to one recv_into per datagram. Defaults to True.
+        """
+        self.slots = slots
+        self.slot_size = slot_size
+        self.buffer = bytearray(slots * slot_size)
+        self.view = memoryview(self.buffer)
+        self.__slot_views = [
+            self.view[i * slot_size:(i + 1) * slot_size] for i in range(slots)]
+        self.__head = 0
+        self.__recvmmsg = _load_recvmmsg() if use_recvmmsg else None
+        if self.__recvmmsg is not None:
+            self.__init_msgvec()
+        logging.debug(
+            f"ReceiveRing using {'recvmmsg' if self.__recvmmsg else 'recv_into'}.")
+
+    def __init_msgvec(self) -> None:
+        self.__c_buffer = (ct.c_char * len(self.buffer)).from_buffer(self.buffer)
+        base = ct.addressof(self.__c_buffer)
+        self.__iovecs = (iovec * self.slots)()
+        self.__msgvec = (mmsghdr * self.slots)()
+        self.__msgvec_addr = ct.addressof(self.__msgvec)
+        for i in range(self.slots):
+            self.__iovecs[i].iov_base = base + i * self.slot_size
+            self.__iovecs[i].iov_len = self.slot_size
+            self.__msgvec[i].msg_hdr.msg_iov = ct.pointer(self.__iovecs[i])
+            self.__msgvec[i].msg_hdr.msg_iovlen = 1
+
+    @property
+    def uses_recvmmsg(self) -> bool:
+        return self.__recvmmsg is not None
+
+    def drain(self, sock: soc.socket) -> list[memoryview]:
+        """Reads every datagram currently queued on the non-blocking socket
+        sock and returns a view for each one in arrival order."""
+        if self.__recvmmsg is not None:
+            return self.__drain_recvmmsg(sock)
+        return self.__drain_recv_into(sock)
+
+    def __drain_recv_into(self, sock: soc.socket) -> list[memoryview]:
+        views = []
+        for _ in range(self.slots):
+            slot = self.__slot_views[self.__head]
+            try:
+                n = sock.recv_into(slot, self.slot_size)
+            except (BlockingIOError, InterruptedError):
+                break
+            views.append(slot[:n])
+            self.__head = (self.__head + 1) % self.slots
+        return views
+
+    def __drain_recvmmsg(self, sock: soc.socket) -> list[memoryview]:
+        views = []
+        fd = sock.fileno()
+        while len(views) < self.slots:
+            # recvmmsg needs contiguous headers so stop at the end of the ring
+            # and continue from slot 0 on the next pass.
+            vlen = min(self.slots - self.__head, self.slots - len(views))
+            start = self.__msgvec_addr + self.__head * ct.sizeof(mmsghdr)
+            count = self.__recvmmsg(fd, start, vlen, soc.MSG_DONTWAIT, None)
+            if count < 0:
+                err = ct.get_errno()
+                if err in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                    break
+                raise OSError(err, "recvmmsg failed")
+            for i in range(self.__head, self.__head + count):
+                views.append(self.__slot_views[i][:self.__msgvec[i].msg_len])
+            self.__head = (self.__head + count) % self.slots
+            if count < vlen:
+                break
+        return views
@@ -1,60 +1,362 @@
+from __future__ import annotations
+
+import argparse
+import heapq
 import io
 import logging
-from multiprocessing.synchronize import Event
 import multiprocessing as mp
-from enum import Enum
+import os
+import struct
+from enum import IntEnum
+from multiprocessing.synchronize import Event
+from time import time_ns
+from typing import BinaryIO, Iterator
+
+import numpy as np
+
+from .Environment import CANLayLogger
+
+# Binary recording layout (little endian):
+#   File header  | magic, version, records per block, created
+#   Block header | magic, record count, record size, first and last timestamp
+#   Records      | fixed width, CAN_RECORD.size or RECORD.size bytes each
+#   ...more blocks...
+#   Index header | magic, number of blocks, first timestamp, last timestamp
+#   Block index  | one INDEX_ENTRY per block, written when recording stops
+#   Index footer | magic, number of blocks, offset of the index header
+# Classic CAN frames go into blocks of narrow records with an 8 byte payload
+# slot. CAN-FD and simulator frames go into blocks of wide records with a 64
+# byte slot. Records arrive out of time order (received frames carry the
+# sender's timestamp and members interleave), so each block is sorted by
+# timestamp before it is written and its header holds its first and last
+# timestamp after sorting. Blocks still overlap in time, within a kind and
+# between the two kinds, so readers merge them by timestamp.
+# Blocks are only ever appended, so a file whose recorder died before writing
+# the index can still be read by walking the block headers. The index and
+# footer reuse the block header layout so the walk can step over them.
+FILE_MAGIC = b"CANLAYR\x00"
+BLOCK_MAGIC = b"CLBK"
+INDEX_MAGIC = b"CLIX"
+FOOTER_MAGIC = b"CLFT"
+FORMAT_VERSION = 1
+RECORDS_PER_BLOCK = 4096
+PAYLOAD_SIZE = 64
+CAN_PAYLOAD_SIZE = 8
+
+FILE_HEADER = struct.Struct("<8sHxxIQ40x")
+BLOCK_HEADER = struct.Struct("<4sIH6xQQ")
+# timestamp, can_id, len, flags, direction, member index, payload
+RECORD = struct.Struct(f"<QIBBBB{PAYLOAD_SIZE}s")
+CAN_RECORD = struct.Struct(f"<QIBBBB{CAN_PAYLOAD_SIZE}s")
+# offset of the first record, record count, record size, first and last
+# timestamp
+INDEX_ENTRY = struct.Struct("<QIH2xQQ")
+
+RECORD_FIELDS = [
+    ("timestamp", "<u8"),
+    ("can_id", "<u4"),
+    ("len", "u1"),
+    ("flags", "u1"),
+    ("direction", "u1"),
+    ("index", "u1"),
+]
+RECORD_DTYPE = np.dtype(RECORD_FIELDS + [("data", "u1", (PAYLOAD_SIZE,))])
+CAN_RECORD_DTYPE = np.dtype(RECORD_FIELDS + [("data", "u1", (CAN_PAYLOAD_SIZE,))])
+assert RECORD_DTYPE.itemsize == RECORD.size
+assert CAN_RECORD_DTYPE.itemsize == CAN_RECORD.size
+
+# Record flags. The low bits hold the CAN-FD flags of the frame.
+FLAG_FD = 0x80
+FLAG_NEED_RESPONSE = 0x40
+FD_FLAGS_MASK = 0x3F
+
+
+class Direction(IntEnum):
+    RX = 0
+    TX = 1
+    # Simulator frame, the payload holds len float32 signals
+    SIM = 2
 
-from .Environment import CANLayLogger, OutputType as OT
 
 class Recorder:
-    def __init__(self, filename: str, mode: str = 'at') -> None:
+    def __init__(self, filename: str, mode: str = 'at', format: str = "text") -> None:
+        if format not in ("text", "binary"):
+            raise ValueError('Recording format must be either "text" or "binary".')
         self.filename = filename
+        self.format = format
+        if format == "binary" and "b" not in mode:
+            mode = mode.replace("t", "") + "b"
         self.mode = mode
 
     def start_recording(
         self,
-        msg_queue: mp.Queue,
+        ring_name: str,
+        consumer: int,
         stop_event: Event,
         log_queue: mp.Queue,
-        log_level: int
+        log_level: int,
+        poll_interval: float = 0.05
     ) -> None:
+        """Records the frames published on an output ring until stop_event is
+        set.
+
+        Args:
+            ring_name (str): Name of the OutputRing.
+            consumer (int): Consumer slot claimed for the recorder.
+            stop_event (Event): Set to stop recording.
+            log_queue (mp.Queue): Queue of the log listener.
+            log_level (int): Log level of the worker.
+            poll_interval (float, optional): Seconds between reads of the
+            ring. Defaults to 0.05.
+        """
+        # OutputRing packs the records defined here.
+        from .OutputRing import OutputRing
         try:
-            self.__msg_queue = msg_queue
-            self.__stop_event = stop_event
             CANLayLogger.worker_configure(log_queue, log_level)
-            with open(self.filename, self.mode, buffering=io.DEFAULT_BUFFER_SIZE) as file:
-                self.__record(file)
+            ring = OutputRing.attach(ring_name)
+            reader = ring.reader(consumer)
+            try:
+                with open(self.filename, self.mode, buffering=io.DEFAULT_BUFFER_SIZE) as file:
+                    if self.format == "binary":
+                        writer = BinaryRecordWriter(file)
+                        self.__record(writer, reader, stop_event, poll_interval)
+                        writer.close()
+                    else:
+                        self.__record(file, reader, stop_event, poll_interval)
+            finally:
+                if reader.lost:
+                    logging.warning(
+                        f"Recorder fell behind and lost {reader.lost} records.")
+                reader.close()
+                ring.close()
         except Exception as e:
             logging.error(e, exc_info=True)
             raise e
 
-    def __record(self, file) -> None:
-        while not self.__stop_event.is_set():
-            message = self.__msg_queue.get()
-            if message is not None:
-                self.__handle_record(file, message)
-            else:
+    def __record(self, file, reader, stop_event: Event, poll_interval: float) -> None:
+        while True:
+            stopping = stop_event.wait(poll_interval)
+            records = reader.read()
+            if len(records):
+                if self.format == "binary":
+                    file.write_records(records)
+                else:
+                    file.write(format_records(records))
+            if stopping:
                 break
         file.flush()
 
-    def __handle_record(self, file, record: tuple) -> None:
-        if record[0] == OT.CAN_MSG:
-            self.__handle_can_msg(file, record[1])
-        elif record[0] == OT.SIM_MSG:
-            self.__handle_sim_msg(file, record[1])
-        elif record[0] == OT.BUFFERED_CAN_SIM:
-            for msg in record[1]:
-                self.__handle_record(file, msg)
-        
-    def __handle_can_msg(self, file, msg: tuple) -> None:
-        file.write(f"({msg[0]}) {msg[1]}#{msg[3]}\n")
-    
-    def __handle_sim_msg(self, file, msg: tuple) -> None:
-        s = f"({msg[0]}) "
-        for i in range(1, len(msg)):
-            s += f"{msg[i]}"
-            if i == (len(msg) - 1):
-                s += "\n"
+
+def format_can_msg(timestamp: int, can_id: int, data: bytes) -> str:
+    return f"({timestamp}) {can_id:08X}#{data.hex().upper()}\n"
+
+
+def format_sim_msg(timestamp: int, signals) -> str:
+    return f"({timestamp}) " + " ".join(str(s) for s in signals) + "\n"
+
+
+def sim_signals(data, length: int) -> np.ndarray:
+    """The float32 signals held in the payload of a simulator record."""
+    return np.frombuffer(bytes(data[:4 * length]), "<f4")
+
+
+def format_records(records: np.ndarray) -> str:
+    """Formats RECORD_DTYPE records in the text recording format."""
+    lines = []
+    for timestamp, can_id, length, direction, data in zip(
+            records["timestamp"].tolist(), records["can_id"].tolist(),
+            records["len"].tolist(), records["direction"].tolist(),
+            records["data"]):
+        if direction == Direction.SIM:
+            lines.append(format_sim_msg(timestamp, sim_signals(data, length)))
+        else:
+            lines.append(format_can_msg(timestamp, can_id, data[:length].tobytes()))
+    return "".join(lines)
+
+
+class _Block:
+    def __init__(self, record: struct.Struct, records_per_block: int) -> None:
+        self.record = record
+        self.dtype = RECORD_DTYPE if record is RECORD else CAN_RECORD_DTYPE
+        self.buffer = bytearray(BLOCK_HEADER.size + record.size * records_per_block)
+        self.count = 0
+
+    def records(self) -> np.ndarray:
+        return np.ndarray((self.count,), self.dtype, buffer=self.buffer,
+                          offset=BLOCK_HEADER.size)
+
+
+class BinaryRecordWriter:
+    def __init__(self, file: BinaryIO, records_per_block=RECORDS_PER_BLOCK) -> None:
+        """Writes CAN and simulator frames as fixed width records into an
+        append-only file of blocks.
+
+        Records are packed into an in-memory block, which is sorted by
+        timestamp and written with a single call once it is full, so a block
+        on disk is always complete and in time order.
+
+        Args:
+            file (BinaryIO): File opened for appending in binary mode.
+            records_per_block (int, optional): Records per block. Defaults to
+            RECORDS_PER_BLOCK.
+        """
+        self.__file = file
+        self.__records_per_block = records_per_block
+        self.__can_block = _Block(CAN_RECORD, records_per_block)
+        self.__wide_block = _Block(RECORD, records_per_block)
+        self.__index: list[tuple[int, int, int, int, int]] = []
+        self.__position = file.seek(0, os.SEEK_END)
+        if self.__position == 0:
+            self.__position = file.write(FILE_HEADER.pack(
+                FILE_MAGIC, FORMAT_VERSION, records_per_block, time_ns() // 1000))
+
+    def write_can(self, timestamp: int, can_id: int, length: int, data: bytes,
+                  flags: int, direction: int, index: int) -> None:
+        if length <= CAN_PAYLOAD_SIZE and not flags & FLAG_FD:
+            block = self.__can_block
+        else:
+            block = self.__wide_block
+        self.__append(block, timestamp, can_id, length, flags, direction, index, data)
+
+    def write_sim(self, timestamp: int, signals) -> None:
+        n = min(len(signals), PAYLOAD_SIZE // 4)
+        data = struct.pack(f"<{n}f", *signals[:n])
+        self.__append(self.__wide_block, timestamp, 0, n, 0, Direction.SIM, 0, data)
+
+    def write_records(self, records: np.ndarray) -> None:
+        """Appends RECORD_DTYPE records, such as those read from an output
+        ring, a block at a time."""
+        narrow = ((records["len"] <= CAN_PAYLOAD_SIZE)
+                  & (records["flags"] & FLAG_FD == 0)
+                  & (records["direction"] != Direction.SIM))
+        self.__extend(self.__can_block, CAN_RECORD_DTYPE, records[narrow])
+        self.__extend(self.__wide_block, RECORD_DTYPE, records[~narrow])
+
+    def __extend(self, block: _Block, dtype: np.dtype, records: np.ndarray) -> None:
+        i = 0
+        while i < len(records):
+            n = min(len(records) - i, self.__records_per_block - block.count)
+            chunk = records[i:i + n]
+            dst = np.ndarray((n,), dtype, buffer=block.buffer,
+                             offset=BLOCK_HEADER.size + block.count * dtype.itemsize)
+            for name, _ in RECORD_FIELDS:
+                dst[name] = chunk[name]
+            width = dtype["data"].shape[0]
+            dst["data"] = chunk["data"][:, :width]
+            block.count += n
+            i += n
+            if block.count == self.__records_per_block:
+                self.__write_block(block)
+
+    def __append(self, block: _Block, timestamp: int, can_id: int, length: int,
+                 flags: int, direction: int, index: int, data: bytes) -> None:
+        block.record.pack_into(
+            block.buffer, BLOCK_HEADER.size + block.count * block.record.size,
+            timestamp, can_id, length, flags, direction, index, data)
+        block.count += 1
+        if block.count == self.__records_per_block:
+            self.__write_block(block)
+
+    def __write_block(self, block: _Block) -> None:
+        if block.count == 0:
+            return
+        records = block.records()
+        timestamps = records["timestamp"]
+        if np.any(timestamps[1:] < timestamps[:-1]):
+            records[:] = records[np.argsort(timestamps, kind="stable")]
+        first, last = int(timestamps[0]), int(timestamps[-1])
+        BLOCK_HEADER.pack_into(block.buffer, 0, BLOCK_MAGIC, block.count,
+                               block.record.size, first, last)
+        self.__index.append((self.__position + BLOCK_HEADER.size, block.count,
+                             block.record.size, first, last))
+        size = BLOCK_HEADER.size + block.count * block.record.size
+        self.__position += self.__file.write(memoryview(block.buffer)[:size])
+        block.count = 0
+
+    def flush(self) -> None:
+        self.__write_block(self.__can_block)
+        self.__write_block(self.__wide_block)
+        self.__file.flush()
+
+    def close(self) -> None:
+        """Writes the partial blocks followed by the block index."""
+        self.flush()
+        n = len(self.__index)
+        first = min((e[3] for e in self.__index), default=0)
+        last = max((e[4] for e in self.__index), default=0)
+        index = bytearray(BLOCK_HEADER.pack(INDEX_MAGIC, n, 0, first, last))
+        for entry in self.__index:
+            index += INDEX_ENTRY.pack(*entry)
+        index += BLOCK_HEADER.pack(FOOTER_MAGIC, n, 0, self.__position, 0)
+        self.__position += self.__file.write(index)
+        self.__file.flush()
+
+
+def iter_blocks(file: BinaryIO) -> Iterator[tuple[int, int, int, int, int]]:
+    """Yields (offset of the first record, record count, record size, first
+    timestamp, last timestamp) for every block by walking the block
+    headers."""
+    file.seek(0)
+    header = file.read(FILE_HEADER.size)
+    if len(header) < FILE_HEADER.size or header[:len(FILE_MAGIC)] != FILE_MAGIC:
+        raise ValueError("Not a CANLay binary recording.")
+    version = FILE_HEADER.unpack(header)[1]
+    if version != FORMAT_VERSION:
+        raise ValueError(f"Unsupported recording version {version}.")
+    position = FILE_HEADER.size
+    while True:
+        raw = file.read(BLOCK_HEADER.size)
+        if len(raw) < BLOCK_HEADER.size:
+            break
+        magic, count, record_size, first, last = BLOCK_HEADER.unpack(raw)
+        position += BLOCK_HEADER.size
+        if magic == BLOCK_MAGIC and record_size in (RECORD.size, CAN_RECORD.size):
+            yield position, count, record_size, first, last
+            position += count * record_size
+        elif magic == INDEX_MAGIC:
+            # Index of an earlier recording appended to the same file.
+            position += count * INDEX_ENTRY.size
+        elif magic != FOOTER_MAGIC:
+            logging.warning(f"Corrupt block header at offset {position}.")
+            break
+        file.seek(position)
+
+
+def _iter_block(file: BinaryIO, offset: int, count: int, record_size: int,
+                chunk_records=64) -> Iterator[tuple]:
+    """Unpacks the records of one block, reading chunk_records at a time.
+    Every read seeks first, so the iterators of many blocks can share file."""
+    record = RECORD if record_size == RECORD.size else CAN_RECORD
+    for start in range(0, count, chunk_records):
+        n = min(count - start, chunk_records)
+        file.seek(offset + start * record_size)
+        yield from record.iter_unpack(file.read(n * record_size))
+
+
+def binary_to_text(source: str, destination: str) -> int:
+    """Converts a binary recording into the text recording format and returns
+    the number of records converted.
+
+    Blocks are sorted by timestamp, so they are merged back into time order
+    with a k-way merge that holds one chunk of each block in memory."""
+    converted = 0
+    with open(source, "rb") as src, open(destination, "w") as dst:
+        blocks = [_iter_block(src, offset, count, record_size)
+                  for offset, count, record_size, _, _ in list(iter_blocks(src))]
+        for timestamp, can_id, length, _, direction, _, payload in heapq.merge(
+                *blocks, key=lambda r: r[0]):
+            if direction == Direction.SIM:
+                dst.write(format_sim_msg(timestamp, sim_signals(payload, length)))
             else:
-                s += " "
-        file.write(s)
\ No newline at end of file
+                dst.write(format_can_msg(timestamp, can_id, payload[:length]))
+            converted += 1
+    return converted
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Convert a binary CANLay recording to the text format.")
+    parser.add_argument("source", help="Binary recording.")
+    parser.add_argument("destination", help="Text file to write.")
+    args = parser.parse_args()
+    print(f"Converted {binary_to_text(args.source, args.destination)} records.")
@@ -0,0 +1,241 @@
+from __future__ import annotations
+
+import logging
+import mmap
+import os
+import struct
+from typing import Iterable, Iterator
+
+import numpy as np
+
+from .Recorder import (BLOCK_HEADER, CAN_RECORD_DTYPE, FILE_HEADER,
+                       FOOTER_MAGIC, INDEX_ENTRY, INDEX_MAGIC, RECORD,
+                       RECORD_DTYPE, RECORD_FIELDS, Direction, iter_blocks)
+
+# Same layout as the INDEX_ENTRY of the recording.
+BLOCK_DTYPE = np.dtype({
+    "names": ["offset", "count", "record_size", "first_timestamp", "last_timestamp"],
+    "formats": ["<u8", "<u4", "<u2", "<u8", "<u8"],
+    "offsets": [0, 8, 12, 16, 24],
+    "itemsize": 32,
+})
+assert BLOCK_DTYPE.itemsize == INDEX_ENTRY.size
+
+# Sidecar CAN id index, stored next to the recording as <recording>.idx:
+#   header | magic, version, block count, recording size, id count, hit count
+#   ids    | sorted unique CAN ids (u32)
+#   starts | start of each id's run in blocks, plus the total (u64)
+#   blocks | number of every block holding CAN records of the id, grouped by
+#          | id (u32)
+# Its size grows with the distinct ids per block, not with the records.
+INDEX_FILE_MAGIC = b"CLRIDX\x00\x00"
+INDEX_FILE_VERSION = 2
+INDEX_FILE_HEADER = struct.Struct("<8sHxxIQQQ")
+
+
+class Recording:
+    def __init__(self, filename: str, build_index=True) -> None:
+        """Reads a binary CANLay recording without loading it into memory.
+
+        The file is memory-mapped and records are returned as NumPy
+        structured arrays, either as zero-copy views of a block or as copies
+        in RECORD_DTYPE merged into time order. Each block's timestamp range
+        serves as a sparse time index and a sidecar file maps every CAN id to
+        the blocks holding its records.
+
+        Args:
+            filename (str): Path of the binary recording.
+            build_index (bool, optional): Build (or load) the CAN id index on
+            open instead of on the first filter. Defaults to True.
+        """
+        self.filename = filename
+        self.index_filename = f"{filename}.idx"
+        self.__file = open(filename, "rb")
+        self.__size = os.fstat(self.__file.fileno()).st_size
+        self.__mmap = mmap.mmap(self.__file.fileno(), 0, access=mmap.ACCESS_READ)
+        self.blocks = self.__read_blocks()
+        self.__ids: np.ndarray | None = None
+        self.__starts: np.ndarray
+        self.__id_blocks: np.ndarray
+        if build_index:
+            self.__load_id_index()
+
+    def __enter__(self) -> Recording:
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+    def __len__(self) -> int:
+        return int(self.blocks["count"].sum())
+
+    def close(self) -> None:
+        self.__ids = None
+        if not self.__mmap.closed:
+            self.__mmap.close()
+        self.__file.close()
+
+    @property
+    def start_time(self) -> int:
+        return int(self.blocks["first_timestamp"].min()) if len(self.blocks) else 0
+
+    @property
+    def end_time(self) -> int:
+        return int(self.blocks["last_timestamp"].max()) if len(self.blocks) else 0
+
+    def __read_blocks(self) -> np.ndarray:
+        # Use the index written when the recording stopped if it is the last
+        # thing in the file and covers it from the first block, otherwise
+        # (recorder died, or several recordings appended to one file) walk
+        # the block headers.
+        if self.__size >= FILE_HEADER.size + 2 * BLOCK_HEADER.size:
+            magic, n, _, index_offset, _ = BLOCK_HEADER.unpack_from(
+                self.__mmap, self.__size - BLOCK_HEADER.size)
+            head = index_offset + BLOCK_HEADER.size
+            if (magic == FOOTER_MAGIC
+                    and head + n * INDEX_ENTRY.size + BLOCK_HEADER.size == self.__size
+                    and self.__mmap[index_offset:index_offset + 4] == INDEX_MAGIC):
+                blocks = np.frombuffer(self.__mmap, BLOCK_DTYPE, n, head).copy()
+                first = FILE_HEADER.size + BLOCK_HEADER.size
+                if (n and blocks["offset"][0] == first) or index_offset == FILE_HEADER.size:
+                    return blocks
+        return np.array(list(iter_blocks(self.__file)), BLOCK_DTYPE)
+
+    def block(self, i: int) -> np.ndarray:
+        """Zero-copy view of the records of block i, in CAN_RECORD_DTYPE or
+        RECORD_DTYPE depending on the width of the block."""
+        b = self.blocks[i]
+        dtype = RECORD_DTYPE if b["record_size"] == RECORD.size else CAN_RECORD_DTYPE
+        return np.frombuffer(self.__mmap, dtype, int(b["count"]), int(b["offset"]))
+
+    def iter_blocks(self) -> Iterator[np.ndarray]:
+        for i in range(len(self.blocks)):
+            yield self.block(i)
+
+    def slice(self, t0: int, t1: int) -> np.ndarray:
+        """Returns every record with t0 <= timestamp < t1 in time order."""
+        hits = np.flatnonzero((self.blocks["last_timestamp"] >= t0)
+                              & (self.blocks["first_timestamp"] < t1))
+        parts = []
+        for i in hits:
+            records = self.block(i)
+            ts = records["timestamp"]
+            lo, hi = np.searchsorted(ts, t0, "left"), np.searchsorted(ts, t1, "left")
+            if hi > lo:
+                parts.append(records[lo:hi])
+        return _merge(parts)
+
+    def can_ids(self) -> np.ndarray:
+        self.__load_id_index()
+        return self.__ids.copy()  # type: ignore
+
+    def filter(self, can_ids: Iterable[int], t0: int | None = None, t1: int | None = None) -> np.ndarray:
+        """Returns the CAN records with one of can_ids, optionally limited to
+        t0 <= timestamp < t1, in time order. Only the blocks holding records
+        of can_ids are read from the file."""
+        self.__load_id_index()
+        ids = self.__ids
+        wanted = np.unique(np.asarray(list(can_ids), np.uint32))
+        pos = np.searchsorted(ids, wanted)  # type: ignore
+        found = pos < len(ids)  # type: ignore
+        found[found] = ids[pos[found]] == wanted[found]  # type: ignore
+        runs = [self.__id_blocks[self.__starts[p]:self.__starts[p + 1]]
+                for p in pos[found]]
+        if not runs:
+            return np.zeros(0, RECORD_DTYPE)
+        hits = np.zeros(len(self.blocks), bool)
+        hits[np.concatenate(runs)] = True
+        # Drop the blocks outside the time range before touching their pages.
+        if t0 is not None:
+            hits &= self.blocks["last_timestamp"] >= t0
+        if t1 is not None:
+            hits &= self.blocks["first_timestamp"] < t1
+        parts = []
+        for i in np.flatnonzero(hits):
+            records = self.block(i)
+            keep = (np.isin(records["can_id"], wanted)
+                    & (records["direction"] != Direction.SIM))
+            if t0 is not None or t1 is not None:
+                ts = records["timestamp"]
+                if t0 is not None:
+                    keep &= ts >= t0
+                if t1 is not None:
+                    keep &= ts < t1
+            parts.append(records[keep])
+        return _merge(parts)
+
+    def __load_id_index(self) -> None:
+        if self.__ids is not None:
+            return
+        if not self.__read_id_index():
+            self.__build_id_index()
+            self.__write_id_index()
+
+    def __read_id_index(self) -> bool:
+        try:
+            with open(self.index_filename, "rb") as file:
+                header = file.read(INDEX_FILE_HEADER.size)
+                if len(header) < INDEX_FILE_HEADER.size:
+                    return False
+                magic, version, n_blocks, size, n_ids, n_hits = \
+                    INDEX_FILE_HEADER.unpack(header)
+                if (magic != INDEX_FILE_MAGIC or version != INDEX_FILE_VERSION
+                        or size != self.__size or n_blocks != len(self.blocks)):
+                    return False
+                self.__ids = np.fromfile(file, np.uint32, n_ids)
+                self.__starts = np.fromfile(file, np.uint64, n_ids + 1)
+                self.__id_blocks = np.fromfile(file, np.uint32, n_hits)
+        except OSError:
+            return False
+        if len(self.__id_blocks) != n_hits:
+            self.__ids = None
+            return False
+        return True
+
+    def __build_id_index(self) -> None:
+        # The distinct ids of one block at a time, so memory grows with the
+        # index and not with the recording.
+        ids, blocks = [], []
+        for i in range(len(self.blocks)):
+            records = self.block(i)
+            block_ids = np.unique(records["can_id"][records["direction"] != Direction.SIM])
+            ids.append(block_ids)
+            blocks.append(np.full(len(block_ids), i, np.uint32))
+        all_ids = np.concatenate(ids) if ids else np.zeros(0, np.uint32)
+        all_blocks = np.concatenate(blocks) if blocks else np.zeros(0, np.uint32)
+        order = np.argsort(all_ids, kind="stable")
+        sorted_ids = all_ids[order]
+        self.__ids, first = np.unique(sorted_ids, return_index=True)
+        self.__starts = np.append(first, len(sorted_ids)).astype(np.uint64)
+        self.__id_blocks = all_blocks[order]
+
+    def __write_id_index(self) -> None:
+        tmp = f"{self.index_filename}.tmp"
+        try:
+            with open(tmp, "wb") as file:
+                file.write(INDEX_FILE_HEADER.pack(
+                    INDEX_FILE_MAGIC, INDEX_FILE_VERSION, len(self.blocks),
+                    self.__size, len(self.__ids), len(self.__id_blocks)))  # type: ignore
+                self.__ids.tofile(file)  # type: ignore
+                self.__starts.tofile(file)
+                self.__id_blocks.tofile(file)
+            os.replace(tmp, self.index_filename)
+        except OSError as e:
+            logging.debug(f"Could not write CAN id index {self.index_filename}: {e}")
+
+
+def _merge(parts: list[np.ndarray]) -> np.ndarray:
+    """Copies narrow and wide records into one RECORD_DTYPE array sorted by
+    timestamp."""
+    n = sum(len(p) for p in parts)
+    out = np.zeros(n, RECORD_DTYPE)
+    i = 0
+    for p in parts:
+        dst = out[i:i + len(p)]
+        for name, _ in RECORD_FIELDS:
+            dst[name] = p[name]
+        dst["data"][:, :p.dtype["data"].shape[0]] = p["data"]
+        i += len(p)
+    if len(parts) > 1:
+        out = out[np.argsort(out["timestamp"], kind="stable")]
+    return out
@@ -0,0 +1,233 @@
+from __future__ import annotations
+
+import ctypes as ct
+import logging
+import queue
+import threading as th
+from typing import Callable, Iterable
+
+import numpy as np
+
+from .CANNode import CAN_message, CANFD_message
+from .Environment import OutputType as OT
+from .Recorder import (FD_FLAGS_MASK, FLAG_FD, FLAG_NEED_RESPONSE,
+                       PAYLOAD_SIZE, Direction)
+from .Recording import Recording
+
+
+class Replay:
+    def __init__(self,
+                 node,
+                 recording: Recording | str,
+                 speed: float | None = 1.0,
+                 can_ids: Iterable[int] | None = None,
+                 directions: Iterable[Direction] = (Direction.RX, Direction.TX),
+                 start_time: int | None = None,
+                 end_time: int | None = None,
+                 spin_us=2000,
+                 max_batch=64,
+                 chunk_us=1000000) -> None:
+        """Re-sends the CAN frames of a binary recording into the session of
+        node with their recorded timing.
+
+        Frames are paced against node.time_us. The replay thread sleeps until
+        spin_us before a frame is due and then spins, so frames go out on
+        time without a thread sleeping through its deadline. Every frame that
+        is due (or late) when the thread wakes up is sent as one batch via
+        write_can_batch. The recording is read a chunk_us slice of recording
+        time at a time, so captures larger than memory can be replayed.
+
+        Args:
+            node (NetworkManager): Node in an active session to send from.
+            recording (Recording | str): Recording or path of one.
+            speed (float | None, optional): 1.0 replays in real time, 2.0 at
+            twice the recorded rate and so on. None sends the frames as fast as
+            possible. Defaults to 1.0.
+            can_ids (Iterable[int] | None, optional): Only replay these CAN
+            ids. Defaults to None (all).
+            directions (Iterable[Direction], optional): Which recorded frames
+            to replay. Defaults to received and sent frames.
+            start_time (int | None, optional): Recording timestamp to start
+            from. Defaults to the start of the recording.
+            end_time (int | None, optional): Recording timestamp to stop at
+            (exclusive). Defaults to the end of the recording.
+            spin_us (int, optional): How long before a frame is due to stop
+            sleeping and spin. Defaults to 2000.
+            max_batch (int, optional): Most frames sent in one batch. Defaults
+            to 64.
+            chunk_us (int, optional): Recording time read at once. Defaults to
+            1000000.
+        """
+        if speed is not None and speed <= 0:
+            raise ValueError("Speed must be positive or None.")
+        self.node = node
+        self.__owns_recording = isinstance(recording, str)
+        self.can_ids = None if can_ids is None else list(can_ids)
+        # The CAN id index is only read (or built) when filtering.
+        self.recording = (Recording(recording, build_index=self.can_ids is not None)
+                          if isinstance(recording, str) else recording)
+        self.speed = speed
+        self.directions = np.array([int(d) for d in directions], np.uint8)
+        self.start_time = self.recording.start_time if start_time is None else start_time
+        self.end_time = self.recording.end_time + 1 if end_time is None else end_time
+        self.spin_us = spin_us
+        self.max_batch = max_batch
+        self.chunk_us = chunk_us
+        self.frames_sent = 0
+        self.max_lateness_us = 0
+        self.elapsed_us = 0
+        self.__stop = th.Event()
+        self.__thread: th.Thread | None = None
+        self.__time_us: Callable[[], int] = node.time_us
+        # Reused for every batch, write_can_batch copies the frames out.
+        self.__can_msgs = [CAN_message() for _ in range(max_batch)]
+        self.__canfd_msgs = [CANFD_message() for _ in range(max_batch)]
+
+    def start(self) -> None:
+        self.__thread = th.Thread(target=self.run, name="CANLayReplay", daemon=True)
+        self.__thread.start()
+
+    def stop(self) -> None:
+        self.__stop.set()
+        self.join()
+
+    def join(self, timeout: float | None = None) -> None:
+        if self.__thread is not None and th.current_thread() is not self.__thread:
+            self.__thread.join(timeout)
+
+    def is_alive(self) -> bool:
+        return self.__thread is not None and self.__thread.is_alive()
+
+    def run(self) -> None:
+        """Replays the recording in the calling thread."""
+        chunks: queue.Queue = queue.Queue(maxsize=2)
+        loader = th.Thread(target=self.__load, args=(chunks,),
+                           name="CANLayReplayLoader", daemon=True)
+        try:
+            loader.start()
+            chunk = chunks.get()
+            started = self.__time_us()
+            while chunk is not None and not self.__stopped():
+                self.__replay_chunk(chunk, started)
+                chunk = chunks.get()
+            self.elapsed_us = self.__time_us() - started
+            self.node.output.put((OT.NOTIFY,
+                f"Replayed {self.frames_sent} CAN frames in "
+                f"{self.elapsed_us / 1000000:.3f} s "
+                f"(max lateness {self.max_lateness_us} us)."))
+        except Exception as e:
+            logging.error(e, exc_info=True)
+        finally:
+            self.__stop.set()
+            while loader.is_alive():
+                # Unblock the loader if it is waiting on a full queue.
+                try:
+                    chunks.get(timeout=0.1)
+                except queue.Empty:
+                    pass
+            if self.__owns_recording:
+                self.recording.close()
+
+    def __stopped(self) -> bool:
+        return self.__stop.is_set() or self.node.stop_event.is_set()
+
+    def __load(self, chunks: queue.Queue) -> None:
+        # Reads the recording ahead of the replay so a chunk boundary does not
+        # delay the frames after it.
+        try:
+            for chunk in self.__chunks():
+                while not self.__stopped():
+                    try:
+                        chunks.put(chunk, timeout=0.1)
+                        break
+                    except queue.Full:
+                        pass
+                if self.__stopped():
+                    break
+        except Exception as e:
+            logging.error(e, exc_info=True)
+        while True:
+            try:
+                chunks.put(None, timeout=0.1)
+                break
+            except queue.Full:
+                # The replay is not waiting for a chunk if the queue is full.
+                if self.__stopped():
+                    break
+
+    def __chunks(self):
+        t = self.start_time
+        while t < self.end_time:
+            t1 = min(t + self.chunk_us, self.end_time)
+            if self.can_ids is None:
+                records = self.recording.slice(t, t1)
+            else:
+                records = self.recording.filter(self.can_ids, t, t1)
+            records = records[np.isin(records["direction"], self.directions)]
+            # The due frames of a chunk are found by searchsorted.
+            timestamps = records["timestamp"]
+            if np.any(timestamps[1:] < timestamps[:-1]):
+                records = records[np.argsort(timestamps, kind="stable")]
+            if len(records):
+                yield records
+            t = t1
+
+    def __replay_chunk(self, records: np.ndarray, started: int) -> None:
+        n = len(records)
+        if self.speed is None:
+            targets = None
+        else:
+            offsets = (records["timestamp"] - np.uint64(self.start_time)).astype(np.float64)
+            targets = (started + offsets / self.speed).astype(np.int64)
+        can_ids = records["can_id"].tolist()
+        lengths = records["len"].tolist()
+        flags = records["flags"].tolist()
+        data = np.ascontiguousarray(records["data"])
+        base = data.ctypes.data
+        i = 0
+        while i < n and not self.__stopped():
+            if targets is None:
+                j = min(i + self.max_batch, n)
+            else:
+                self.__wait_until(int(targets[i]))
+                now = self.__time_us()
+                self.max_lateness_us = max(self.max_lateness_us, now - int(targets[i]))
+                # Everything already due goes out with this frame.
+                j = int(np.searchsorted(targets, now, "right"))
+                j = min(max(j, i + 1), i + self.max_batch, n)
+            self.__send(i, j, can_ids, lengths, flags, base)
+            i = j
+
+    def __wait_until(self, target: int) -> None:
+        remaining = target - self.__time_us()
+        if remaining > self.spin_us:
+            # Event.wait so stop() does not have to wait out a long gap.
+            self.__stop.wait((remaining - self.spin_us) / 1000000)
+        while self.__time_us() < target and not self.__stop.is_set():
+            pass
+
+    def __send(self, i: int, j: int, can_ids: list, lengths: list, flags: list, base: int) -> None:
+        # write_can_batch takes one fd/need_response setting, so split the
+        # batch into runs that share them.
+        start = i
+        while start < j:
+            f = flags[start] & (FLAG_FD | FLAG_NEED_RESPONSE)
+            end = start + 1
+            while end < j and flags[end] & (FLAG_FD | FLAG_NEED_RESPONSE) == f:
+                end += 1
+            fd = bool(f & FLAG_FD)
+            pool = self.__canfd_msgs if fd else self.__can_msgs
+            msgs = pool[:end - start]
+            for k, msg in enumerate(msgs):
+                r = start + k
+                length = min(lengths[r], len(msg.buf))
+                msg.can_id = can_ids[r]
+                msg.len = length
+                if fd:
+                    msg.flags = flags[r] & FD_FLAGS_MASK
+                ct.memmove(msg.buf, base + r * PAYLOAD_SIZE, length)
+            self.node.write_can_batch(bool(f & FLAG_NEED_RESPONSE), fd, msgs,
+                                      notify=False)
+            self.frames_sent += end - start
+            start = end
+
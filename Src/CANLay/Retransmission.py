@@ -0,0 +1,245 @@
+from __future__ import annotations
+
+from dataclasses import dataclass, field
+from typing import Iterable
+
+
+class TimerWheel:
+    def __init__(self, tick=0.005, slots=256) -> None:
+        """Hashed timer wheel.
+
+        Timers are hashed into slots by the tick their deadline falls in.
+        Deadlines further out than one revolution share a slot with nearer
+        ones and are simply skipped until their deadline has passed, so
+        schedule, cancel and advance are O(1) per timer.
+
+        Args:
+            tick (float, optional): Resolution of the wheel in seconds.
+            Defaults to 0.005.
+            slots (int, optional): Number of slots, must be a power of two.
+            Defaults to 256.
+        """
+        if slots <= 0 or slots & (slots - 1):
+            raise ValueError("Number of slots must be a power of two.")
+        self.tick = tick
+        self.__mask = slots - 1
+        self.__slots: list[dict] = [{} for _ in range(slots)]
+        self.__deadlines: dict = {}
+        self.__where: dict = {}
+        self.__current: int | None = None
+
+    def __len__(self) -> int:
+        return len(self.__deadlines)
+
+    def __contains__(self, key) -> bool:
+        return key in self.__deadlines
+
+    def schedule(self, key, deadline: float) -> None:
+        self.cancel(key)
+        t = int(deadline / self.tick)
+        if self.__current is not None and t < self.__current:
+            # Already overdue; put it in the slot the next advance starts at.
+            t = self.__current
+        slot = t & self.__mask
+        self.__slots[slot][key] = deadline
+        self.__where[key] = slot
+        self.__deadlines[key] = deadline
+
+    def cancel(self, key) -> None:
+        slot = self.__where.pop(key, None)
+        if slot is not None:
+            del self.__slots[slot][key]
+            del self.__deadlines[key]
+
+    def next_deadline(self) -> float | None:
+        if not self.__deadlines:
+            return None
+        return min(self.__deadlines.values())
+
+    def advance(self, now: float) -> list:
+        """Removes and returns the keys of every timer whose deadline is at or
+        before now, in deadline order."""
+        t_now = int(now / self.tick)
+        if self.__current is None:
+            self.__current = t_now
+        expired = []
+        if self.__deadlines:
+            # The current slot is visited again because timers can be added
+            # to it after it was last swept.
+            steps = min(t_now - self.__current + 1, self.__mask + 1)
+            for i in range(steps):
+                bucket = self.__slots[(self.__current + i) & self.__mask]
+                if not bucket:
+                    continue
+                for key, deadline in list(bucket.items()):
+                    if deadline <= now:
+                        expired.append((deadline, key))
+                        del bucket[key]
+                        del self.__where[key]
+                        del self.__deadlines[key]
+        self.__current = max(t_now, self.__current)
+        expired.sort(key=lambda e: e[0])
+        return [key for _, key in expired]
+
+
+class RTOEstimator:
+    def __init__(self, initial_rto: float, min_rto: float, max_rto: float) -> None:
+        """Jacobson/Karels retransmission timeout estimator (RFC 6298).
+
+        Round trip samples update the smoothed RTT and its variation. On a
+        timeout the RTO is doubled (exponential backoff) until the next valid
+        sample. Per Karn's algorithm callers must not feed samples from
+        frames that were retransmitted since the ack is ambiguous.
+        """
+        self.min_rto = min_rto
+        self.max_rto = max_rto
+        self.srtt: float | None = None
+        self.rttvar = 0.0
+        self.rto = min(max(initial_rto, min_rto), max_rto)
+
+    def sample(self, rtt: float) -> None:
+        if self.srtt is None:
+            self.srtt = rtt
+            self.rttvar = rtt / 2
+        else:
+            self.rttvar = 0.75 * self.rttvar + 0.25 * abs(self.srtt - rtt)
+            self.srtt = 0.875 * self.srtt + 0.125 * rtt
+        rto = self.srtt + max(self.min_rto, 4 * self.rttvar)
+        self.rto = min(max(rto, self.min_rto), self.max_rto)
+
+    def backoff(self) -> None:
+        self.rto = min(self.rto * 2, self.max_rto)
+
+
+@dataclass
+class InFlightFrame:
+    frame_number: int
+    datagram: bytes
+    sent_at: float
+    pending: set = field(default_factory=set)
+    attempts: int = 0
+
+
+class RetransmissionScheduler:
+    def __init__(self,
+                 max_retransmissions: int,
+                 initial_rto: float,
+                 max_in_flight=8,
+                 min_rto=0.005,
+                 max_rto=1.0,
+                 tick=0.005) -> None:
+        """Tracks sensor frames until every session member has acknowledged
+        them and decides when to retransmit.
+
+        Members acknowledge implicitly: every datagram a member sends carries
+        the number of the last sensor frame it received, which acknowledges
+        that frame and all earlier ones. Each member has its own adaptive
+        timeout and a frame times out after the longest timeout among the
+        members that have not acknowledged it yet.
+
+        Args:
+            max_retransmissions (int): Attempts before a frame is given up.
+            initial_rto (float): Timeout in seconds used until RTTs have been
+            measured.
+            max_in_flight (int, optional): Frames tracked at once. When
+            exceeded the oldest frame is given up. Defaults to 8.
+            min_rto (float, optional): Lower bound for the timeout in seconds.
+            Defaults to 0.005.
+            max_rto (float, optional): Upper bound for the timeout in seconds.
+            Defaults to 1.0.
+            tick (float, optional): Timer wheel resolution in seconds.
+            Defaults to 0.005.
+        """
+        self.max_retransmissions = max_retransmissions
+        self.max_in_flight = max_in_flight
+        self.__initial_rto = initial_rto
+        self.__min_rto = min_rto
+        self.__max_rto = max_rto
+        self.__wheel = TimerWheel(tick)
+        self.__frames: dict[int, InFlightFrame] = {}
+        self.__estimators: dict[int, RTOEstimator] = {}
+        self.retransmissions = 0
+        self.dropped = 0
+
+    def __len__(self) -> int:
+        return len(self.__frames)
+
+    def estimator(self, member: int) -> RTOEstimator:
+        est = self.__estimators.get(member)
+        if est is None:
+            est = RTOEstimator(self.__initial_rto, self.__min_rto, self.__max_rto)
+            self.__estimators[member] = est
+        return est
+
+    def reset(self) -> None:
+        for frame_number in list(self.__frames):
+            self.__wheel.cancel(frame_number)
+        self.__frames.clear()
+        self.__estimators.clear()
+        self.retransmissions = 0
+        self.dropped = 0
+
+    def __timeout(self, frame: InFlightFrame) -> float:
+        return max(self.estimator(m).rto for m in frame.pending)
+
+    def track(self, frame_number: int, datagram: bytes, members: Iterable[int], now: float) -> list[InFlightFrame]:
+        """Starts tracking a frame that was just sent. Returns any frames that
+        had to be given up to stay within max_in_flight."""
+        given_up = []
+        pending = set(members)
+        if self.max_retransmissions <= 0 or not pending:
+            return given_up
+        while len(self.__frames) >= self.max_in_flight:
+            oldest = next(iter(self.__frames))
+            given_up.append(self.__give_up(oldest))
+        frame = InFlightFrame(frame_number, bytes(datagram), now, pending)
+        self.__frames[frame_number] = frame
+        self.__wheel.schedule(frame_number, now + self.__timeout(frame))
+        return given_up
+
+    def ack(self, member: int, frame_number: int, now: float) -> None:
+        """Records that member has received every frame up to and including
+        frame_number."""
+        if not self.__frames:
+            return
+        for number in [n for n in self.__frames if n <= frame_number]:
+            frame = self.__frames[number]
+            if member not in frame.pending:
+                continue
+            frame.pending.discard(member)
+            if frame.attempts == 0:  # Karn: only unambiguous samples
+                self.estimator(member).sample(now - frame.sent_at)
+            if not frame.pending:
+                self.__wheel.cancel(number)
+                del self.__frames[number]
+
+    def expire(self, now: float) -> tuple[list[InFlightFrame], list[InFlightFrame]]:
+        """Returns the frames that need to be retransmitted now and the frames
+        that ran out of attempts and were given up."""
+        resend, given_up = [], []
+        for number in self.__wheel.advance(now):
+            frame = self.__frames.get(number)
+            if frame is None:
+                continue
+            if frame.attempts >= self.max_retransmissions:
+                given_up.append(self.__give_up(number))
+                continue
+            frame.attempts += 1
+            self.retransmissions += 1
+            for member in frame.pending:
+                self.estimator(member).backoff()
+            self.__wheel.schedule(number, now + self.__timeout(frame))
+            resend.append(frame)
+        return resend, given_up
+
+    def next_timeout(self, now: float, default: float) -> float:
+        """Seconds until the next frame times out, capped at default."""
+        deadline = self.__wheel.next_deadline()
+        if deadline is None:
+            return default
+        return min(max(deadline - now, 0.0), default)
+
+    def __give_up(self, frame_number: int) -> InFlightFrame:
+        self.__wheel.cancel(frame_number)
+        self.dropped += 1
+        return self.__frames.pop(frame_number)
@@ -1,8 +1,9 @@
 from __future__ import annotations
 
-from ctypes import POINTER, Array, Structure, c_char, c_float, c_uint8, memmove
+from ctypes import POINTER, Array, Structure, c_float, c_uint8
 from ipaddress import IPv4Address
 
+from . import Codec
 from .CANNode import CANNode
 
 
@@ -31,22 +32,9 @@ class SensorNode(CANNode):
         super().start_session(ip, port)
         self._signals_rx = (c_float * 16)()
         self._signals_tx = (c_float * 16)()
-        self._signals_temp_buf = (c_char * 64)()
-
-    def pack_sensorblock(self, block: WSenseBlock, buffer: bytearray) -> None:
-        buffer.extend(block.num_signals.to_bytes(1, 'little'))
-        if block.num_signals > 0:
-            if block.num_signals > 16:
-                block.num_signals = 16
-            memmove(self._signals_temp_buf,
-                    self._signals_tx, block.num_signals * 4)
-            buffer.extend(self._signals_temp_buf[:block.num_signals])
-
-    def unpack_sensorblock(self, block: WSenseBlock, buffer: bytes, offset: int) -> None:
-        block.num_signals = int.from_bytes(buffer[offset:offset + 1], 'little')
-        offset += 1
-        if block.num_signals > 0:
-            if block.num_signals > 16:
-                block.num_signals = 16
-            block.signals = self._signals_rx.from_buffer_copy(
-                buffer[offset:offset + block.num_signals * 4])
+
+    def pack_sensorblock(self, block: WSenseBlock, buffer: bytearray, offset=0) -> int:
+        return Codec.pack_sensorblock(block, self._signals_tx, buffer, offset)
+
+    def unpack_sensorblock(self, block: WSenseBlock, buffer: bytes, offset: int) -> int:
+        return Codec.unpack_sensorblock(block, self._signals_rx, buffer, offset)
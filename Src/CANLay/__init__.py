@@ -8,16 +8,20 @@ import threading as th
 from enum import Enum
 from io import BytesIO
 from pathlib import Path
-from time import sleep
+from time import monotonic, sleep
 from types import SimpleNamespace
 from multiprocessing.connection import Listener
 
+from .AsyncEngine import AsyncEngine
 from .Environment import (LOGTYPE_CONSOLE, LOGTYPE_FILE, LOGTYPE_OFF,
                           LOGTYPE_OUTPUT, CANLayLogger)
 from .Environment import OutputType as OT
 from .HealthReport import HealthReport as healthReport
+from .MetricsExporter import MetricsExporter
 from .NetworkManager import NetworkManager as networkManager
+from .OutputRing import OutputRing
 from .Recorder import Recorder as recorder
+from .Recording import Recording
 
 
 class CANLay(networkManager):
@@ -30,7 +34,11 @@ class CANLay(networkManager):
                  log_level=logging.INFO,
                  log_type=LOGTYPE_CONSOLE,
                  log_filename="CANLay.log",
-                 log_directory_path: str | None=None
+                 log_directory_path: str | None=None,
+                 engine="threaded",
+                 record_format="text",
+                 health_display=True,
+                 metrics_port: int | None=None
                  ) -> None:
         """CANLay - A powerful application for testing Electronic Control Units (ECUs)
 
@@ -60,6 +68,22 @@ class CANLay(networkManager):
             log_filename (str, optional): The name of the log file. Defaults to "CANLay.log".
             log_directory_path (str, optional): The directory to store the
             rotating log files. Defaults to None.
+            engine (str, optional): How the network work is scheduled.
+            "threaded" runs the sync, health and listen loops in three
+            threads. "asyncio" runs them on a single event loop using loop
+            timers and a reader on the selector. Defaults to "threaded".
+            record_format (str, optional): "text" writes one line per frame.
+            "binary" writes fixed width records in blocks, which is smaller and
+            keeps up with long runs; convert it with
+            python -m CANLay.Recorder. Defaults to "text".
+            health_display (bool, optional): Whether to show the network
+            statistics of a session in a window. Without it matplotlib and
+            seaborn are never imported, and the statistics are only read
+            through health_report.metrics(). Defaults to True.
+            metrics_port (int, optional): Serve the session health, frame
+            counts, queue depths and decode errors on
+            http://127.0.0.1:metrics_port/metrics in the OpenMetrics format
+            for Prometheus. Defaults to None (not served).
         """
         # Validate log_level value
         if not isinstance(log_level, int):
@@ -111,11 +135,28 @@ class CANLay(networkManager):
                     f"Invalid log_directory_path: {log_directory_path}")
             self.__log_directory_path = log_dir_path.resolve()
 
+        if engine not in ("threaded", "asyncio"):
+            raise ValueError('Engine must be either "threaded" or "asyncio".')
+        self.__engine_type = engine
+
+        if record_format not in ("text", "binary"):
+            raise ValueError('Record format must be either "text" or "binary".')
+        self.__record_format = record_format
+
+        if not isinstance(health_display, bool):
+            raise ValueError("Health display must be a boolean.")
+        self.__health_display = health_display
+
+        if metrics_port is not None and (
+                not isinstance(metrics_port, int) or not 0 < metrics_port < 65536):
+            raise ValueError("Metrics port must be an integer between 1 and 65535.")
+        self.__metrics_port = metrics_port
+        self.metrics_exporter: MetricsExporter | None = None
+
         if not isinstance(record, bool):
             raise ValueError("Record must be a boolean.")
         # Check if record_filename is a valid file name
         self.recording = record
-        self.recorder_output: mp.Queue
         logging.debug("The value of record when initializing is: %s", record)
         if record:
             if not isinstance(record_filename, str):
@@ -138,7 +179,7 @@ class CANLay(networkManager):
             if self.in_session.wait(1):
                 with self._sel_lock:
                     connection_events = self._sel.select(
-                        timeout=self._timeout_additive)
+                        timeout=self.retransmit_timeout())
                     for key, mask in connection_events:
                         callback = key.data.callback
                         callback(key)
@@ -179,20 +220,53 @@ class CANLay(networkManager):
         except Exception as e:
             logging.debug(e, exc_info=True)
 
-    def __send_output_buffer(self) -> None:
-        time_between_frames = round(1 / 13, 2)
-        try:
-            while not self.stop_event.is_set():
-                if self.in_session.wait(1):
-                    with self._output_buffer_lock:
-                        if self._output_buffer:
-                            self.output.put((OT.BUFFERED_CAN_SIM, self._output_buffer.copy()))
-                        if self.recording and self._output_buffer:
-                            self.recorder_output.put((OT.BUFFERED_CAN_SIM, self._output_buffer.copy()))
-                        self._output_buffer.clear()
-                    sleep(time_between_frames)
-        except Exception as e:
-            logging.debug(e, exc_info=True)
+    # Event loop engine
+    # ----------------------------------
+
+    def __start_async_engine(self) -> None:
+        self.__engine = AsyncEngine()
+        self.__sync_count_remaining = self.__init_sync_count
+        self.__engine.call_every(self.__next_sync_interval, self.__async_sync_tick)
+        self.__engine.call_every(1.0, self.__async_health_tick)
+        self.__engine.call_every(self.retransmit_timeout, self.__async_retransmit_tick)
+        self.__engine.start()
+
+    def __next_sync_interval(self) -> float:
+        # Burst a few syncs at the start of a session so the clocks converge
+        # quickly, then settle to one per second.
+        if self.__sync_count_remaining > 0:
+            return 0.2
+        return 1.0
+
+    def __async_sync_tick(self) -> None:
+        if not self.in_session.is_set():
+            self.__sync_count_remaining = self.__init_sync_count
+            return
+        self.write_sync()
+        if self.__sync_count_remaining > 0:
+            self.__sync_count_remaining -= 1
+
+    def __async_health_tick(self) -> None:
+        if not self.in_session.is_set():
+            return
+        if self._initial_health_report_wait:
+            # Wait for clocks to sync
+            if monotonic() - self.__session_started_at < 3.5:
+                return
+            self._initial_health_report_wait = False
+        self.publish_health()
+
+    def __async_retransmit_tick(self) -> None:
+        if self.in_session.is_set():
+            self.check_members(self.time_us() / 1000000)
+
+    def __async_dispatch(self) -> None:
+        if not self.in_session.is_set() or self.stop_event.is_set():
+            self.__engine.unwatch_selector()
+            return
+        for key, mask in self._sel.select(timeout=0):
+            key.data.callback(key)
+        self.check_members(self.time_us() / 1000000)
 
     def start(self,
               simulator=False,
@@ -221,29 +295,37 @@ class CANLay(networkManager):
         self.__log_queue = mp.Queue() if log_queue is None else log_queue
         self.output = mp.Queue() if output_queue is None else output_queue
         self.__log_output_queue = mp.Queue() if log_output_queue is None else log_output_queue
-        self.recorder_output = mp.Queue()
+        # CAN and simulator frames are published through the ring, the output
+        # queue only carries control messages and tells the TUI which
+        # consumer slot of the ring to read.
+        self._output_ring = OutputRing()
+        self._output_consumer = self._output_ring.add_consumer()
         self.stop_event = th.Event()
         self.in_session = th.Event()
         self.__stop_mp = mp.Event()
+        self.__init_sync_count = 5
         if not self.__log_type == LOGTYPE_OFF:
             self.__log_listener = mp.Process(
                 target=CANLayLogger.listen,
                 args=(self.__log_queue, self.__log_output_queue, self.__log_type))
             self.__log_listener.start()
         CANLayLogger.worker_configure(self.__log_queue, self.__log_level)
-        self.__ptp_thread = th.Thread(target=self.__send_sync_loop)
-        self.__health_thread = th.Thread(target=self.__request_health_loop)
-        self.__listen_thread = th.Thread(target=self.__listen)
-        self.__output_thread = th.Thread(target=self.__send_output_buffer)
         try:
+            if self.__metrics_port is not None:
+                self.__start_metrics()
             if simulator:
                 self.__sim_thread = th.Thread(
                     target=self.__accept_sim_conn, args=(sim_port, self.__auth_key))
                 self.__sim_thread.start()
-            self.__ptp_thread.start()
-            self.__health_thread.start()
-            self.__listen_thread.start()
-            self.__output_thread.start()
+            if self.__engine_type == "asyncio":
+                self.__start_async_engine()
+            else:
+                self.__ptp_thread = th.Thread(target=self.__send_sync_loop)
+                self.__health_thread = th.Thread(target=self.__request_health_loop)
+                self.__listen_thread = th.Thread(target=self.__listen)
+                self.__ptp_thread.start()
+                self.__health_thread.start()
+                self.__listen_thread.start()
             self.output.put((OT.NOTIFY, "Connecting..."))
             if self.connect():
                 self.output.put((OT.NOTIFY, "Registering..."))
@@ -257,6 +339,22 @@ class CANLay(networkManager):
         except Exception as e:
             logging.error(e, exc_info=True)
 
+    def __start_metrics(self) -> None:
+        exporter = MetricsExporter(self.__metrics_port)
+        exporter.add_gauge("canlay_output_queue_depth",
+                           "Messages waiting in the output queue.", self.output.qsize)
+        exporter.add_gauge("canlay_output_ring_backlog",
+                           "Frames the slowest output ring consumer has yet to read.",
+                           self._output_ring.backlog)
+        exporter.add_gauge("canlay_frames_in_flight",
+                           "Simulator frames waiting to be acknowledged.",
+                           lambda: len(self._retransmitter))
+        exporter.add_counter("canlay_decode_errors",
+                             "Received datagrams or batched CAN blocks too short to decode.",
+                             lambda: self.decode_errors)
+        self.metrics_exporter = exporter
+        exporter.start()
+
     def stop(self, notify_server=True):
         # Tell the user we are exiting
         self.output.put((OT.NOTIFY, "Exiting..."))
@@ -273,14 +371,12 @@ class CANLay(networkManager):
         # Check if we setup the health report, if so stop it
         if hasattr(self, 'health_report'):
             self.health_report.stop_display()
+        if self.metrics_exporter is not None:
+            self.metrics_exporter.stop()
         # Check if we setup the recording process, if so stop it
         if hasattr(self, "recorder"):
-            self.recorder_output.put(None)
             self.recorder.join()
             self.recorder.close()
-            while(not self.recorder_output.empty()):
-                self.recorder_output.get()
-        self.recorder_output.close()
         # Check if we still have a connection with the simulator. If so,
         # close it.
         if hasattr(self, '__sim_conn'):
@@ -291,14 +387,18 @@ class CANLay(networkManager):
         if hasattr(self, '__sim_thread'):
             if self.__sim_thread.is_alive():
                 self.__sim_thread.join()
-        if self.__ptp_thread.is_alive():
-            self.__ptp_thread.join()
-        if self.__output_thread.is_alive():
-            self.__output_thread.join()
-        if self.__health_thread.is_alive():
-            self.__health_thread.join()
-        if self.__listen_thread.is_alive():
-            self.__listen_thread.join()
+        if self.__engine_type == "asyncio":
+            self.__engine.stop()
+        else:
+            if self.__ptp_thread.is_alive():
+                self.__ptp_thread.join()
+            if self.__health_thread.is_alive():
+                self.__health_thread.join()
+            if self.__listen_thread.is_alive():
+                self.__listen_thread.join()
+        # Nothing publishes anymore. Consumers that are still attached keep
+        # their mapping until they close it.
+        self._output_ring.close()
         # If somehow we got here and the TUI is still up, tell it to exit
         self.output.put((OT.EXIT, ""))
         # Disconnect from the server
@@ -345,18 +445,28 @@ class CANLay(networkManager):
                 logging.debug(request_data)
                 super().start_session(ip, port, request_data)
                 self.health_report = healthReport(self.members)
-                self.health_report.start_display(
-                    self.__stop_mp, self.output, self.__log_queue, self.__log_level)
+                if self.metrics_exporter is not None:
+                    self.metrics_exporter.attach(self.health_report)
+                if self.__health_display:
+                    self.health_report.start_display(
+                        self.__stop_mp, self.output, self.__log_queue, self.__log_level)
                 logging.debug(f"The value for recording is: {self.recording}")
                 if self.recording:
                     logging.debug("Starting recording process.")
-                    rec = recorder(self.__record_filename)
+                    rec = recorder(self.__record_filename,
+                                   format=self.__record_format)
                     self.recorder = mp.Process(
                         target=rec.start_recording,
-                        args=(self.recorder_output, self.__stop_mp,
+                        args=(self._output_ring.name,
+                              self._output_ring.add_consumer(), self.__stop_mp,
                               self.__log_queue, self.__log_level))
                     self.recorder.start()
+                self.__session_started_at = monotonic()
                 self.in_session.set()
+                if self.__engine_type == "asyncio":
+                    self.__engine.watch_selector(
+                        self._sel, self._sel_lock, self.__async_dispatch,
+                        self._timeout_additive)
             else:
                 self.output.put(
                     (OT.ERROR, "Session could not be established."))
@@ -10,6 +10,7 @@ from pathlib import Path
 # ==============================================================================
 sys.path.insert(0, str(Path('../').resolve()))
 from CANLay.CANNode import CAN_message
+from CANLay.Replay import Replay
 from CANLay.Environment import CANLayLogger
 from CANLay.Environment import OutputType as OT
 from CANLay import LOGTYPE_FILE, LOGTYPE_OUTPUT
@@ -19,6 +20,7 @@ from CANLay import CANLay
 
 class Controller:
     def __init__(self) -> None:
+        self.__replay: Replay | None = None
         self._cansend_re = re.compile(
             r'^(?P<id>[0-9A-Fa-f]{3,8})(?:#|(?P<flags>#[RF]\d?|[\da-fA-F]{0,15}##[0-9A-Fa-f])?)(?P<data>(?:\.?[0-9A-Fa-f]{0,2}){0,8})$')
 
@@ -72,7 +74,11 @@ class Controller:
             self.output.put((OT.PROMPT,
                              "Enter the numbers corresponding to the ECUs you "
                              "would like to use (comma separated): "))
-            answer = self.__command.recv()  # Wait for user input
+            # Wait for user input, showing the devices again as they change
+            while not self.__command.poll(0.5):
+                if self.canlay.refresh_devices():
+                    self.output.put((OT.DEVICES, self.canlay.live_devices()))
+            answer = self.__command.recv()
             input_list = str(answer).split(',')
             return [int(i.strip()) for i in input_list]
         except (EOFError, BrokenPipeError, ValueError):
@@ -84,6 +90,10 @@ class Controller:
         requested = self.__print_devices(available)
         if requested == []:
             return []
+        if self.canlay.subscribed:
+            self.canlay.refresh_devices()
+            available = self.canlay.live_devices()
+            available_device_ids = [device["ID"] for device in available]
         if set(requested).issubset(available_device_ids):
             if self.canlay.request_devices(requested, available):
                 self.output.put(
@@ -101,7 +111,13 @@ class Controller:
             return self.__request_user_input(available)
 
     def provision_devices(self) -> List[int]:
-        available_devices = self.canlay.get_devices()
+        # Follow the available devices as the broker pushes changes, or take
+        # a snapshot if it can not.
+        if self.canlay.subscribed or self.canlay.subscribe_devices():
+            self.canlay.refresh_devices()
+            available_devices = self.canlay.live_devices()
+        else:
+            available_devices = self.canlay.get_devices()
         if len(available_devices) > 0:
             return self.__request_user_input(available_devices)
         else:
@@ -159,3 +175,29 @@ class Controller:
                 msg.buf[i] = ct.c_uint8(data[i])
             self.canlay.write_can(False, False, msg)
             return
+        elif command[0] == "replay":
+            self.__handle_replay(command[1:])
+
+    def __handle_replay(self, args: List[str]) -> None:
+        # replay <recording> [speed|max] or replay stop
+        if len(args) == 0:
+            self.output.put(
+                (OT.ERROR, "Usage: replay <recording> [speed|max] | replay stop"))
+            return
+        replay = self.__replay
+        if args[0] == "stop":
+            if replay is not None and replay.is_alive():
+                replay.stop()
+            return
+        if replay is not None and replay.is_alive():
+            self.output.put((OT.ERROR, "A replay is already running."))
+            return
+        try:
+            speed = None if len(args) > 1 and args[1] == "max" else (
+                float(args[1]) if len(args) > 1 else 1.0)
+            self.__replay = Replay(self.canlay, args[0], speed=speed)
+        except (OSError, ValueError) as e:
+            self.output.put((OT.ERROR, f"Could not replay {args[0]}: {e}"))
+            return
+        self.output.put((OT.NOTIFY, f"Replaying {args[0]}."))
+        self.__replay.start()
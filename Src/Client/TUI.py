@@ -1,11 +1,14 @@
 import threading as th
 from CANLay.Environment import OutputType as OT
+from CANLay.OutputRing import OutputRing
+from CANLay.Recorder import Direction, sim_signals
 import asyncio
 import multiprocessing as mp
 from multiprocessing.connection import PipeConnection
 from concurrent.futures import ThreadPoolExecutor
 import logging
 
+import numpy as np
 from rich.pretty import pprint
 from rich import print as rp
 from rich.text import Text
@@ -41,6 +44,9 @@ class LiveView(Container):
 
 live_can_data = []
 
+# How often the live view reads the output ring
+TIME_BETWEEN_FRAMES = round(1 / 13, 2)
+
 class CANLayTUI(App):
 
     CSS_PATH = "client.css"
@@ -62,6 +68,7 @@ class CANLayTUI(App):
         self._tui_stop = mp.Event()
         self._executors = ThreadPoolExecutor(max_workers=2)
         self._event_loop = asyncio.get_event_loop()
+        self._ring_task = None
 
     async def monitor_log_queue(self) -> None:
         logs: TextLog = self.query_one("#logViewer", TextLog)
@@ -75,7 +82,6 @@ class CANLayTUI(App):
 
     async def monitor_output_queue(self) -> None:
         results: TextLog = self.query_one("#results", TextLog)
-        simlogs: Static = self.query_one("#simLogs", Static)
         totalStats: Static = self.query_one("#totalStats", Static)
         while not self._tui_stop.is_set():
             msg = await self._event_loop.run_in_executor(
@@ -96,15 +102,13 @@ class CANLayTUI(App):
                         f"[b red]{msg[1]}[/b red]"))
                 elif msg[0] == OT.DEVICES:
                     self.__print_devices(results, msg[1])
-                elif msg[0] == OT.CAN_MSG:
-                    self.__print_can_msg(msg[1])
-                elif msg[0] == OT.SIM_MSG:
-                    simlogs.update(
-                        Text.from_markup(self.__print_sim_msg(msg[1])))
                 elif msg[0] == OT.TOTAL_STATS:
                     totalStats.update(
                         Text.from_markup(self.__print_total_stats(msg[1])))
                 elif (msg[0] == OT.START_SESSION) or (msg[0] == OT.STOP_SESSION):
+                    if msg[0] == OT.START_SESSION and self._ring_task is None:
+                        self._ring_task = asyncio.create_task(
+                            self.monitor_output_ring(*msg[1]))
                     result = self.query_one(Results)
                     liveView = self.query_one(LiveView)
                     if result.has_class("-in-session"):
@@ -118,17 +122,38 @@ class CANLayTUI(App):
                 elif msg[0] == OT.EXIT:
                     await asyncio.sleep(5)
                     self.exit()
-                elif msg[0] == OT.BUFFERED_CAN_SIM:
-                    self.__print_buffered_can_sim(simlogs, msg[1])
                 else:
                     results.write(Text.from_markup(msg))
 
-    def __print_buffered_can_sim(self, simlogs: Static, buffer: list) -> None:
-        for msg in buffer:
-            if msg[0] == OT.SIM_MSG:
-                simlogs.update(Text.from_markup(self.__print_sim_msg(msg[1])))
-            elif msg[0] == OT.CAN_MSG:
-                self.__print_can_msg(msg[1])
+    async def monitor_output_ring(self, name: str, consumer: int) -> None:
+        simlogs: Static = self.query_one("#simLogs", Static)
+        ring = OutputRing.attach(name)
+        reader = ring.reader(consumer)
+        try:
+            while not self._tui_stop.is_set():
+                records = reader.read()
+                if len(records):
+                    self.__print_records(simlogs, records)
+                await asyncio.sleep(TIME_BETWEEN_FRAMES)
+        finally:
+            ring.close()
+
+    def __print_records(self, simlogs: Static, records: np.ndarray) -> None:
+        # Only the latest frame of each CAN id and the latest simulator frame
+        # are visible, skip the rest.
+        sim = records["direction"] == Direction.SIM
+        if sim.any():
+            last = records[np.flatnonzero(sim)[-1]]
+            signals = sim_signals(last["data"], int(last["len"])).tolist()
+            simlogs.update(Text.from_markup(
+                self.__print_sim_msg((int(last["timestamp"]), *signals))))
+        can = records[~sim]
+        ids = can["can_id"][::-1]
+        _, latest = np.unique(ids, return_index=True)
+        for record in can[len(can) - 1 - np.sort(latest)[::-1]]:
+            length = int(record["len"])
+            self.__print_can_msg((int(record["timestamp"]), int(record["can_id"]),
+                                  length, record["data"][:length].tobytes()))
 
     def __print_total_stats(self, msg) -> str:
         return (f"[b white]Simulator Messages:[/]\tSent: [green]{msg[0]}[/]\t\t"
@@ -140,18 +165,21 @@ class CANLayTUI(App):
         return (f"[b white]Throttle:[/] {msg[1]:0<4.4}\t"
                 f"[b white]Steering:[/] {msg[2]:0<4.4}\t"
                 f"[b white]Brake:[/] {int(msg[3])}\t"
-                f"[b white]Hand Brake:[/] {msg[4]}\t"
-                f"[b white]Reverse:[/] {msg[5]}\t"
-                f"[b white]Gear:[/] {msg[7]}")
+                f"[b white]Hand Brake:[/] {bool(msg[4])}\t"
+                f"[b white]Reverse:[/] {bool(msg[5])}\t"
+                f"[b white]Gear:[/] {int(msg[7])}")
 
     def __print_can_msg(self, msg):
-        if msg[1] in self.can_table._data.keys():
-            if msg[2] != self.can_table._data[msg[1]][self._keys[1]]: # if length doesn't match
-                self.can_table.update_cell(msg[1], self._keys[1], msg[2])
-            if msg[3] != self.can_table._data[msg[1]][self._keys[2]]: # if data doesn't match
-                self.can_table.update_cell(msg[1], self._keys[2], msg[3])
+        # msg is (timestamp, can_id, len, data)
+        can_id = f"{msg[1]:08X}"
+        data = msg[3].hex().upper()
+        if can_id in self.can_table._data.keys():
+            if msg[2] != self.can_table._data[can_id][self._keys[1]]: # if length doesn't match
+                self.can_table.update_cell(can_id, self._keys[1], msg[2])
+            if data != self.can_table._data[can_id][self._keys[2]]: # if data doesn't match
+                self.can_table.update_cell(can_id, self._keys[2], data)
         else:
-            self.can_table.add_row(*msg[1:], key=msg[1])
+            self.can_table.add_row(can_id, msg[2], data, key=can_id)
 
     def __print_devices(self, results: TextLog, devices: list) -> None:
         results.write(Rule("[green]Network Designer[/green]"))
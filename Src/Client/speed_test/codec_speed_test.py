@@ -0,0 +1,110 @@
+"""Compares the original int.to_bytes/int.from_bytes COMMBlock packing with the
+precompiled struct codec in CANLay.Codec.
+
+Run from this directory: python codec_speed_test.py
+"""
+import ctypes as ct
+import sys
+import timeit
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[2]))
+from CANLay import Codec
+from CANLay.NetworkManager import COMMBlock
+
+
+def legacy_pack_canblock(frame, buffer):
+    buffer.extend(frame.sequence_number.to_bytes(4, "little"))
+    buffer.extend(frame.need_response.to_bytes(1, "little"))
+    buffer.extend(frame.fd.to_bytes(1, "little"))
+    buffer.extend(frame.can.can_id.to_bytes(4, "little"))
+    buffer.extend(frame.can.len.to_bytes(1, "little"))
+    for i in range(frame.can.len):
+        buffer.extend(frame.can.buf[i].to_bytes(1, "little"))
+
+
+def legacy_pack_commblock(msg, buffer):
+    buffer.extend(msg.index.to_bytes(1, "little"))
+    buffer.extend(msg.type.to_bytes(1, "little"))
+    buffer.extend(msg.frame_number.to_bytes(4, "little"))
+    buffer.extend(msg.timestamp.to_bytes(8, "little"))
+    legacy_pack_canblock(msg.frame.canFrame, buffer)
+
+
+def legacy_unpack_commblock(msg, buffer, msg_len):
+    offset = 0
+    msg.index = int.from_bytes(buffer[offset:offset + 1], "little")
+    offset += 1
+    msg.type = int.from_bytes(buffer[offset:offset + 1], "little")
+    offset += 1
+    msg.frame_number = int.from_bytes(buffer[offset:offset + 4], "little")
+    offset += 4
+    msg.timestamp = int.from_bytes(buffer[offset:offset + 8], "little")
+    offset += 8
+    frame = msg.frame.canFrame
+    frame.sequence_number = int.from_bytes(buffer[offset:offset + 4], "little")
+    offset += 4
+    frame.need_response = bool.from_bytes(buffer[offset:offset + 1], "little")
+    offset += 1
+    frame.fd = bool.from_bytes(buffer[offset:offset + 1], "little")
+    offset += 1
+    frame.can.can_id = int.from_bytes(buffer[offset:offset + 4], "little")
+    offset += 4
+    frame.can.len = int.from_bytes(buffer[offset:offset + 1], "little")
+    offset += 1
+    ct.memmove(frame.can.buf, buffer[offset:offset + frame.can.len],
+               frame.can.len)
+
+
+def build_message() -> COMMBlock:
+    msg = COMMBlock()
+    msg.index = 3
+    msg.type = 1
+    msg.frame_number = 1234
+    msg.timestamp = 1681234567890123
+    msg.frame.canFrame.sequence_number = 98765
+    msg.frame.canFrame.can.can_id = 0x18FEF100
+    msg.frame.canFrame.can.len = 8
+    for i in range(8):
+        msg.frame.canFrame.can.buf[i] = i * 17
+    return msg
+
+
+def main():
+    number = 200000
+    msg = build_message()
+    out = COMMBlock()
+    reusable = bytearray(Codec.MAX_DATAGRAM_SIZE)
+
+    legacy = bytearray()
+    legacy_pack_commblock(msg, legacy)
+    length = Codec.pack_into(msg, reusable)
+    assert bytes(legacy) == bytes(reusable[:length]), "Codec output differs."
+    datagram = bytes(legacy)
+
+    def legacy_pack():
+        legacy_pack_commblock(msg, bytearray())
+
+    def codec_pack():
+        Codec.pack_into(msg, reusable)
+
+    def legacy_unpack():
+        legacy_unpack_commblock(out, datagram, len(datagram))
+
+    def codec_unpack():
+        Codec.unpack_from(out, datagram, len(datagram))
+
+    results = [
+        ("pack (legacy)", timeit.timeit(legacy_pack, number=number)),
+        ("pack (codec)", timeit.timeit(codec_pack, number=number)),
+        ("unpack (legacy)", timeit.timeit(legacy_unpack, number=number)),
+        ("unpack (codec)", timeit.timeit(codec_unpack, number=number)),
+    ]
+    for name, seconds in results:
+        print(f"{name:<16} {seconds / number * 1e6:8.3f} usec/frame")
+    print(f"Pack speedup:   {results[0][1] / results[1][1]:.2f}x")
+    print(f"Unpack speedup: {results[2][1] / results[3][1]:.2f}x")
+
+
+if __name__ == "__main__":
+    main()
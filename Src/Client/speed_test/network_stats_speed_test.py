@@ -0,0 +1,92 @@
+"""Compares the original per frame ctypes Welford update of NetworkStats with
+the batched NumPy version in CANLay.HealthReport.
+
+Run from this directory: python network_stats_speed_test.py
+"""
+import ctypes as ct
+import random
+import sys
+import timeit
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[2]))
+from CANLay.HealthReport import LatencyHistogram, NetworkStats, NodeReport
+
+
+class LegacyNetworkStats:
+    def __init__(self, num_members):
+        self.health_report = (NodeReport * num_members)()
+        self.last_message_time = [0] * num_members
+        self.last_sequence_number = [0] * num_members
+
+    def update(self, i, packet_size, timestamp, sequence_number, now):
+        delay = (now - timestamp) // 1000
+        if self.last_message_time[i] != 0 and self.last_sequence_number[i] != 0:
+            self.calculate(self.health_report[i].latency, abs(delay))
+            self.calculate(self.health_report[i].jitter,
+                           self.health_report[i].latency.variance)
+            packets_lost = sequence_number - (self.last_sequence_number[i] + 1)
+            self.health_report[i].packetLoss += packets_lost if packets_lost > 0 else 0
+            self.health_report[i].goodput += packet_size
+        self.last_message_time[i] = now
+        self.last_sequence_number[i] = sequence_number
+
+    def calculate(self, edge, n):
+        edge.min = min(edge.min, n)
+        edge.max = max(edge.max, n)
+        edge.count += 1
+        delta = n - edge.mean
+        edge.mean += delta / edge.count
+        delta2 = n - edge.mean
+        edge.sumOfSquaredDifferences += delta * delta2
+        edge.variance = edge.sumOfSquaredDifferences / edge.count
+
+
+def build_samples(num_members, count):
+    random.seed(0)
+    sequence = [0] * num_members
+    now = 10 ** 12
+    samples = []
+    for _ in range(count):
+        i = random.randrange(num_members)
+        sequence[i] += 1
+        now += random.randrange(100, 2000)
+        samples.append((i, 25, now - random.randrange(500000, 3000000),
+                        sequence[i], now))
+    return samples
+
+
+def main():
+    num_members = 8
+    number = 20
+    samples = build_samples(num_members, 20000)
+
+    def legacy():
+        stats = LegacyNetworkStats(num_members)
+        for sample in samples:
+            stats.update(*sample)
+        return stats.health_report
+
+    def vectorized():
+        stats = NetworkStats(num_members)
+        for sample in samples:
+            stats.update(*sample)
+        return stats.health_report
+
+    for a, b in zip(legacy(), vectorized()):
+        assert a.packetLoss == b.packetLoss and a.goodput == b.goodput
+        assert abs(a.latency.mean - b.latency.mean) < 1e-2, "Latency differs."
+
+    results = [
+        ("update (legacy)", timeit.timeit(legacy, number=number)),
+        ("update (numpy)", timeit.timeit(vectorized, number=number)),
+    ]
+    for name, seconds in results:
+        print(f"{name:<16} {seconds / (number * len(samples)) * 1e6:8.3f} usec/frame")
+    print(f"Speedup: {results[0][1] / results[1][1]:.2f}x")
+    print(f"Report size: {ct.sizeof(NodeReport) * num_members} bytes")
+    print(f"Latency histograms size: {ct.sizeof(LatencyHistogram) * num_members} bytes")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,60 @@
+"""Compares validating an SSSF registration with a Draft7Validator against the
+validator generated by fastjsonschema, as picked by the Broker's
+SchemaRegistry.
+
+Run from this directory: python schema_speed_test.py
+"""
+import sys
+import timeit
+from pathlib import Path
+
+import jsonschema
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[2] / "Schemas"))
+import SchemaRegistry
+
+SCHEMA_DIR = str(Path(__file__).resolve().parents[2] / "Schemas")
+SCHEMA_NAME = "SSSFRegistration.json"
+
+REGISTRATION = {
+    "MAC": "04:e9:e5:4f:00:01",
+    "AttachedDevices": [{
+        "Type": ["ECM", "Engine Control Module"],
+        "Year": 2000,
+        "Make": "Cummins",
+        "Model": "ISB",
+        "SN": "12345"
+    }]
+}
+
+
+def main():
+    number = 20000
+    registry = SchemaRegistry.SchemaRegistry(SCHEMA_DIR)
+    generated = registry.validator(SCHEMA_NAME)
+    schema = registry.schema(SCHEMA_NAME)
+    resolver = jsonschema.RefResolver(
+        'file:///' + SCHEMA_DIR.replace("\\", "/") + '/', schema)
+    draft7 = jsonschema.Draft7Validator(schema, resolver=resolver)
+    if not isinstance(generated, SchemaRegistry.GeneratedValidator):
+        print("fastjsonschema is not installed, both use Draft7Validator.")
+
+    def compile_each_time():
+        SchemaRegistry.SchemaRegistry(SCHEMA_DIR).validator(SCHEMA_NAME)
+
+    results = [
+        ("validate (draft7)", timeit.timeit(
+            lambda: draft7.validate(REGISTRATION), number=number)),
+        ("validate (registry)", timeit.timeit(
+            lambda: generated.validate(REGISTRATION), number=number)),
+    ]
+    for name, seconds in results:
+        print(f"{name:<20} {seconds / number * 1e6:8.3f} usec/request")
+    print(f"Validation speedup: {results[0][1] / results[1][1]:.2f}x")
+    compile_number = 20
+    seconds = timeit.timeit(compile_each_time, number=compile_number)
+    print(f"{'compile':<20} {seconds / compile_number * 1e3:8.3f} msec/schema")
+
+
+if __name__ == "__main__":
+    main()
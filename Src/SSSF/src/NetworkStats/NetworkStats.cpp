@@ -9,13 +9,15 @@ NetworkStats::NetworkStats(size_t _size, PTPClient* _timeClient):
     timeClient(_timeClient),
     size(_size),
     Basics(new HealthBasics [_size]),
-    HealthReport(new NodeReport [_size])
+    HealthReport(new NodeReport [_size]),
+    LatencyHistograms(new LatencyHistogram [_size]())
 {}
 
 NetworkStats::~NetworkStats()
 {
     delete[] HealthReport;
     delete[] Basics;
+    delete[] LatencyHistograms;
 }
 
 void NetworkStats::update(uint16_t i, int packetSize, uint64_t timestamp, uint32_t sequenceNumber, int64_t now)
@@ -32,6 +34,11 @@ void NetworkStats::update(uint16_t i, int packetSize, uint64_t timestamp, uint32
         // Serial.println(delay);
         calculate(HealthReport[i].latency, abs(delay));
         calculate(HealthReport[i].jitter, HealthReport[i].latency.variance);
+        uint16_t &bucket = LatencyHistograms[i][latencyBucket(abs(int64_t(now - timestamp)))];
+        if (bucket < UINT16_MAX)
+        {
+            bucket++;
+        }
         // If no packet loss then sequence number = last sequence number + 1
         int32_t packetsLost = int64_t(sequenceNumber) - (Basics[i].lastSequenceNumber + 1);
         // If packetsLost is negative then this usually indicates duplicate or
@@ -48,6 +55,19 @@ void NetworkStats::reset()
 {
     delete[] HealthReport;
     HealthReport = new NodeReport[size];
+    memset(LatencyHistograms, 0, size * sizeof(LatencyHistogram));
+}
+
+size_t NetworkStats::latencyBucket(uint64_t latency)
+{
+    if (latency < (1ULL << latencyMinExponent))
+    {
+        return 0;
+    }
+    int exponent = 63 - __builtin_clzll(latency);
+    size_t sub = (latency >> (exponent - latencySubBucketBits)) & ((1 << latencySubBucketBits) - 1);
+    size_t bucket = 1 + ((exponent - latencyMinExponent) << latencySubBucketBits) + sub;
+    return min(bucket, latencyBuckets - 1);
 }
 
 void NetworkStats::calculate(struct HealthCore &edge, float n)
@@ -40,9 +40,19 @@ public:
         struct HealthCore jitter;
     };
 
+    // Log bucketed latency histogram in microseconds. Bucket 0 holds
+    // latencies below 2^latencyMinExponent, then every power of two is split
+    // into 2^latencySubBucketBits buckets and the last bucket holds the rest.
+    // Sent after the NodeReports when they fit, see SSSF::start.
+    static const uint8_t latencyMinExponent = 7;
+    static const uint8_t latencySubBucketBits = 1;
+    static const size_t latencyBuckets = 32;
+    typedef uint16_t LatencyHistogram[latencyBuckets];
+
     size_t size = 0;
     struct HealthBasics *Basics;
     struct NodeReport *HealthReport;
+    LatencyHistogram *LatencyHistograms;
 
     NetworkStats(size_t _size, PTPClient* _timeClient);
     ~NetworkStats();
@@ -51,6 +61,7 @@ public:
 
 private:
     void calculate(struct HealthCore &edge, float n);
+    size_t latencyBucket(uint64_t latency);
 };
 
 #endif /* network_stats_h_ */
\ No newline at end of file
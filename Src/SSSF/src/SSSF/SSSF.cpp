@@ -217,6 +217,8 @@ size_t SSSF::packCOMMBlock(struct COMMBlock &msg)
     {
         memcpy(&msgBuffer[size], networkHealth->HealthReport, reportSize);
         size += reportSize;
+        memcpy(&msgBuffer[size], networkHealth->LatencyHistograms, histogramsSize);
+        size += histogramsSize;
     }
     return size;
 }
@@ -327,7 +329,12 @@ void SSSF::start(struct Request *request)
     index = request->json["Index"];
     size_t membersSize = request->json["Devices"].size();
     reportSize = membersSize * sizeof(NetworkStats::NodeReport);
-    comPackedMaxSize = max(comPackedMaxSize, comPackedHeadSize + reportSize);
+    histogramsSize = membersSize * sizeof(NetworkStats::LatencyHistogram);
+    if (comPackedHeadSize + reportSize + histogramsSize > maxDatagramSize)
+    {
+        histogramsSize = 0;
+    }
+    comPackedMaxSize = max(comPackedMaxSize, comPackedHeadSize + reportSize + histogramsSize);
     msgBuffer = new uint8_t[comPackedMaxSize]();
     frameNumber = 0;
     ptpClient.start(membersSize, index);
@@ -25,6 +25,10 @@ private:
 
     int comPackedHeadSize = 14;
     int reportSize = 0;
+    // Zero when the latency histograms do not fit in a datagram.
+    int histogramsSize = 0;
+    // Receive buffer size of the controller.
+    int maxDatagramSize = 1024;
     int comPackedMaxSize = 90u;
 
     // For Testing
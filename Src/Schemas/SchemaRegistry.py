@@ -0,0 +1,128 @@
+import json
+import logging
+import os
+import threading as th
+from typing import Dict, Tuple
+
+import jsonschema
+from jsonschema import ValidationError
+
+try:
+    import fastjsonschema
+except ImportError:
+    fastjsonschema = None
+
+# Keywords holding maps of subschemas and ones holding instance data, which
+# are copied as they are.
+SCHEMA_MAPS = ("properties", "patternProperties", "definitions", "dependencies")
+DATA_KEYWORDS = ("enum", "const", "default")
+
+
+def without_examples(schema):
+    """The schema without its "examples" annotations. They do not change what
+    validates, but some hold $refs that do not resolve, which the generated
+    validators would expand for their error messages."""
+    if isinstance(schema, list):
+        return [without_examples(s) for s in schema]
+    if not isinstance(schema, dict):
+        return schema
+    stripped = {}
+    for keyword, value in schema.items():
+        if keyword == "examples":
+            continue
+        if keyword in SCHEMA_MAPS and isinstance(value, dict):
+            stripped[keyword] = {k: without_examples(v) for k, v in value.items()}
+        elif keyword in DATA_KEYWORDS:
+            stripped[keyword] = value
+        else:
+            stripped[keyword] = without_examples(value)
+    return stripped
+
+
+class GeneratedValidator:
+    def __init__(self, validate, schema: Dict) -> None:
+        """A validation function generated by fastjsonschema, raising
+        ValidationError like the jsonschema validators it replaces."""
+        self.schema = schema
+        self.__validate = validate
+
+    def validate(self, instance) -> None:
+        try:
+            self.__validate(instance)
+        except fastjsonschema.JsonSchemaValueException as e:
+            raise ValidationError(e.message)
+
+
+class SchemaRegistry:
+    __registries: Dict[str, "SchemaRegistry"] = {}
+    __registries_lock = th.Lock()
+
+    def __init__(self, schema_dir: str) -> None:
+        """Loads each schema in schema_dir once and compiles its validator
+        once.
+
+        Validators are generated Python functions when fastjsonschema is
+        installed and Draft7Validators otherwise (or when a schema can not be
+        generated), so both accept the same documents.
+
+        Args:
+            schema_dir (str): Folder of the schemas, which $refs are relative
+            to.
+        """
+        self.schema_dir = schema_dir
+        self.__lock = th.Lock()
+        self.__schemas: Dict[str, Dict] = {}
+        self.__validators: Dict[str, object] = {}
+
+    @classmethod
+    def of(cls, schema_dir: str) -> "SchemaRegistry":
+        """The registry shared by everything using schema_dir."""
+        with cls.__registries_lock:
+            registry = cls.__registries.get(schema_dir)
+            if registry is None:
+                registry = cls.__registries[schema_dir] = cls(schema_dir)
+            return registry
+
+    def schema(self, schema_name: str) -> Dict:
+        with self.__lock:
+            return self.__load(schema_name)
+
+    def validator(self, schema_name: str):
+        with self.__lock:
+            validator = self.__validators.get(schema_name)
+            if validator is None:
+                validator = self.__compile(schema_name)
+                self.__validators[schema_name] = validator
+            return validator
+
+    def compile(self, schema_name: str) -> Tuple[object, Dict]:
+        return self.validator(schema_name), self.schema(schema_name)
+
+    def __load(self, schema_name: str) -> Dict:
+        schema = self.__schemas.get(schema_name)
+        if schema is None:
+            schema_path = os.path.join(self.schema_dir, schema_name)
+            with open(schema_path, 'rb') as schema_file:
+                schema = json.load(schema_file)
+            self.__schemas[schema_name] = schema
+        return schema
+
+    def __load_ref(self, uri: str) -> Dict:
+        # Refs are written as "Name.json" or "Name.json/#/..."
+        schema_name = os.path.basename(uri.rstrip("/"))
+        return without_examples(self.__load(schema_name))
+
+    def __compile(self, schema_name: str):
+        schema = self.__load(schema_name)
+        if fastjsonschema is not None:
+            definition = without_examples(schema)
+            definition["$id"] = "file://" + os.path.join(self.schema_dir, schema_name)
+            try:
+                validate = fastjsonschema.compile(
+                    definition, handlers={"file": self.__load_ref})
+                return GeneratedValidator(validate, schema)
+            except (fastjsonschema.JsonSchemaDefinitionException, OSError) as e:
+                logging.warning(f'Could not generate a validator for {schema_name}: {e}')
+        resolver = jsonschema.RefResolver(
+            'file:///' + self.schema_dir.replace("\\", "/") + '/', schema)
+        return jsonschema.Draft7Validator(schema, resolver=resolver)
@@ -6,14 +6,16 @@ from jsonschema.protocols import Validator
 
 import Routes
 from DeviceCollection import DeviceCollection
+from DeviceRegistry import DeviceRegistry
+from MulticastGroups import MulticastGroups
 
 SELECTOR = sel.DefaultSelector
 KEY = sel.SelectorKey
 
 
 class CANNodes(DeviceCollection):
-    def __init__(self, _sel: SELECTOR, _multicast_ips: list) -> None:
-        super().__init__(_sel, _multicast_ips)
+    def __init__(self, _sel: SELECTOR, _multicast_groups: MulticastGroups, _registry: DeviceRegistry) -> None:
+        super().__init__(_sel, _multicast_groups, _registry)
         self.reg_schema, _ = self.compile_schema("SSSFRegistration.json")
         self.session_schema, _ = self.compile_schema("SessionInformation.json")
 
@@ -43,6 +45,16 @@ class CANNodes(DeviceCollection):
     def get_devices(self, key: KEY, rfile: BytesIO, wfile: BytesIO) -> HTTPStatus:
         return super().get_devices(key, rfile, wfile)
 
+    @Routes.add("/SSSF/SUBSCRIBE", "POST")
+    @DeviceCollection.type_required("CONTROLLER")
+    def subscribe(self, key: KEY, rfile: BytesIO, wfile: BytesIO) -> HTTPStatus:
+        return super().subscribe(key, rfile, wfile)
+
+    @Routes.add("/SSSF/SUBSCRIBE", "DELETE")
+    @DeviceCollection.type_required("CONTROLLER")
+    def unsubscribe(self, key: KEY, rfile: BytesIO, wfile: BytesIO) -> HTTPStatus:
+        return super().unsubscribe(key, rfile, wfile)
+
     @Routes.add("/SSSF/REGISTER", "GET")
     def get_registration_schema(self, key: KEY, rfile: BytesIO, wfile: BytesIO) -> HTTPStatus:
         return super().get_registration_schema(key, rfile, wfile)
@@ -1,8 +1,10 @@
 import queue
 import selectors as sel
 import time
-from types import FunctionType
-from typing import List, Tuple
+from collections import deque
+from typing import Callable, Deque, Dict, Optional, Tuple
+
+from HTTPParser import HTTPParser
 
 SELECTOR = sel.DefaultSelector
 KEY = sel.SelectorKey
@@ -19,13 +21,24 @@ class Device:
         self.MAC = None
         self.type = "unknown"
         self.in_use = False
+        # Session the connection is in, see DeviceRegistry.new_session.
+        self.session: Optional[int] = None
         self.outgoing_messages = queue.SimpleQueue()
+        # Taken from outgoing_messages but not fully sent yet.
+        self.unsent: Deque[memoryview] = deque()
         self.rate = 100.0  # 100 messages per second
         self.allowance = self.rate
         self.last_check = time.time()
         self.logged_rate_limit = False
         self.expecting_response = False
-        self.response = None
+        self.parser = HTTPParser()
+        self.close_connection = False
+        # Headers of the request being handled and extra headers of its
+        # response.
+        self.request_headers = None
+        self.response_headers: Dict[str, str] = {}
+        # Set by the broker, sends outgoing_messages to the connection.
+        self.wake: Optional[Callable[[KEY], None]] = None
 
     def rate_limit(self, log_error) -> bool:
         # Token Bucket algorithm
@@ -80,21 +93,3 @@ class Device:
             return hasattr(key.data, "type") and key.data.type == "SSSF"
         else:
             return False
-
-    @staticmethod
-    def is_available(key: KEY, is_type: FunctionType) -> bool:
-        if Device.is_not_listening_socket(key):
-            return is_type(key) and not key.data.in_use
-
-    @staticmethod
-    def get_available_devices(sel: SELECTOR, is_type: FunctionType) -> List:
-        available = []
-        sel_map = sel.get_map()
-        for fd in sel_map:
-            key = sel_map[fd]
-            if Device.is_available(key, is_type):
-                available.append({
-                    "ID": fd,
-                    "Devices": key.data.devices
-                })
-        return available
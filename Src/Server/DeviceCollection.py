@@ -3,6 +3,7 @@ import json
 import logging
 import os
 import selectors as sel
+import sys
 from functools import wraps
 from http import HTTPStatus
 from io import BytesIO
@@ -11,11 +12,16 @@ from json.decoder import JSONDecodeError
 from types import FunctionType
 from typing import List, Tuple
 
-import jsonschema
 from jsonschema import ValidationError
 from jsonschema.protocols import Validator
 
 from Device import Device
+from DeviceRegistry import DeviceRegistry
+from MulticastGroups import MulticastGroups
+
+# The SchemaRegistry lives with the schemas, it is shared with CANLay.
+sys.path.append(os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "Schemas"))
+from SchemaRegistry import SchemaRegistry  # noqa: E402
 
 SELECTOR = sel.DefaultSelector
 KEY = sel.SelectorKey
@@ -24,10 +30,12 @@ KEY = sel.SelectorKey
 class DeviceCollection:
     __metaclass__ = abc.ABCMeta
 
-    def __init__(self, _sel: SELECTOR, _multicast_ips: List) -> None:
+    def __init__(self, _sel: SELECTOR, _multicast_groups: MulticastGroups, _registry: DeviceRegistry) -> None:
         self.sel = _sel
-        self.multicast_ips = _multicast_ips
+        self.multicast_groups = _multicast_groups
+        self.registry = _registry
         self.schema_dir = self.__find_schema_folder()
+        self.schemas = SchemaRegistry.of(self.schema_dir)
         self.key = KEY
         self.can_port = 41665
 
@@ -41,12 +49,9 @@ class DeviceCollection:
         return os.path.join(base_dir, "Schemas")
 
     def compile_schema(self, schema_name) -> Tuple[Validator, object]:
-        schema_path = os.path.join(self.schema_dir, schema_name)
-        with open(schema_path, 'rb') as schema_file:
-            schema = json.load(schema_file)
-        resolver = jsonschema.RefResolver(
-            'file:///' + self.schema_dir.replace("\\", "/") + '/', schema)
-        return jsonschema.Draft7Validator(schema, resolver=resolver), schema
+        """The validator and schema of schema_name, shared by every
+        collection."""
+        return self.schemas.compile(schema_name)
 
     def set_key(func: FunctionType) -> FunctionType:
         @wraps(func)
@@ -105,70 +110,92 @@ class DeviceCollection:
     @registration_required
     def get_devices(self, key: KEY, rfile: BytesIO, wfile: BytesIO) -> HTTPStatus:
         self.info(f"Requested available {__name__}.")
-        is_type = getattr(Device, "is_" + self.device_type)
-        devices = json.dumps(Device.get_available_devices(self.sel, is_type))
-        wfile.write(bytes(devices, "UTF-8"))
+        etag, devices = self.registry.available_devices(self.device_type)
+        key.data.response_headers["ETag"] = etag
+        if self.__etag_matches(etag):
+            # The device list has not changed since the last poll.
+            return HTTPStatus.NOT_MODIFIED
+        wfile.write(devices)
         return HTTPStatus.FOUND
 
+    @set_key
+    @registration_required
+    def subscribe(self, key: KEY, rfile: BytesIO, wfile: BytesIO) -> HTTPStatus:
+        if key.data.in_use:
+            self.error("Cannot subscribe while in a session.")
+            return HTTPStatus.CONFLICT
+        self.info(f"Subscribed to available {self.device_type}s.")
+        devices = self.registry.subscribe(key, self.device_type)
+        wfile.write(bytes(json.dumps(devices), "UTF-8"))
+        return HTTPStatus.OK
+
+    @set_key
+    @registration_required
+    def unsubscribe(self, key: KEY, rfile: BytesIO, wfile: BytesIO) -> HTTPStatus:
+        if self.registry.unsubscribe(key):
+            self.info(f"Unsubscribed from available {self.device_type}s.")
+            return HTTPStatus.OK
+        self.error("Tried to end a non-existent subscription.")
+        return HTTPStatus.EXPECTATION_FAILED
+
+    def __etag_matches(self, etag: str) -> bool:
+        headers = self.key.data.request_headers
+        if_none_match = headers.get("If-None-Match") if headers else None
+        if if_none_match is None:
+            return False
+        tags = [t.strip() for t in if_none_match.split(",")]
+        return etag in tags or "*" in tags
+
     @set_key
     def get_registration_schema(self, key: KEY, rfile: BytesIO, wfile: BytesIO) -> HTTPStatus:
         self.info("Requested Reqistration schema.")
         wfile.write(self.registration_schema)
         return HTTPStatus.FOUND
 
-    def __check_number_duplicates(self, duplicates: List[KEY]) -> HTTPStatus:
+    def __check_number_duplicates(self, duplicates: List[int]) -> HTTPStatus:
         if len(duplicates) > 5:
             return HTTPStatus.CONFLICT
         else:
             return HTTPStatus.ACCEPTED
 
-    def __check_duplicates(self, old_key: KEY) -> HTTPStatus:
-        if old_key.data.MAC == self.key.data.MAC:
-            if self.device_type == "SSSF":
-                # Without a way to determine which connection is a real SSSF we don't
-                # know which one to ban at this time. So just drop it for now.
-                self.error("Already is registered.")
-                self.key.data.close_connection = True
-                return HTTPStatus.CONFLICT
-            elif old_key.addr[0] == self.key.addr[0]:
-                self.duplicates.append(old_key)
-                return self.__check_number_duplicates(self.duplicates)
-            else:
-                self.error("Tried to change MAC. Banning device.")
-                return HTTPStatus.FORBIDDEN
-        else:
-            # If its a different connection and different MAC we assume its a
-            # different device.
+    def __check_duplicates(self, mac: str) -> HTTPStatus:
+        own_id = self.registry.id_of(self.key)
+        others = [(i, ip) for i, ip in self.registry.with_mac(mac) if i != own_id]
+        if not others:
+            # If its a different MAC we assume its a different device.
             return HTTPStatus.ACCEPTED
-
-    def __check_already_registered(self, old_key: KEY) -> HTTPStatus:
-        if old_key.fd == self.key.fd:
-            # Trying to change MAC address is not allowed and connection will be
-            # dropped and device will be banned.
-            if old_key.data.MAC != self.key.data.MAC:
+        if self.device_type == "SSSF":
+            # Without a way to determine which connection is a real SSSF we don't
+            # know which one to ban at this time. So just drop it for now.
+            self.error("Already is registered.")
+            self.key.data.close_connection = True
+            return HTTPStatus.CONFLICT
+        duplicates = [own_id]
+        for old_id, ip in others:
+            if ip != self.key.data.addr[0]:
                 self.error("Tried to change MAC. Banning device.")
                 return HTTPStatus.FORBIDDEN
-            else:
-                return HTTPStatus.ACCEPTED
-        else:
-            return self.__check_duplicates(old_key)
+            duplicates.append(old_id)
+        return self.__check_number_duplicates(duplicates)
 
-    def __check_registration(self) -> HTTPStatus:
+    def __check_registration(self, mac: str) -> HTTPStatus:
         self.info("Checking registration.")
-        sel_map = self.sel.get_map()
-        if self.device_type == "CONTROLLER":
-            self.duplicates = [self.key]
-        for fd in sel_map:
-            if Device.is_not_listening_socket(sel_map[fd]):
-                return self.__check_already_registered(sel_map[fd])
+        registered_mac = self.registry.mac_of(self.key)
+        if registered_mac is not None and registered_mac != mac:
+            # Trying to change MAC address is not allowed and connection will be
+            # dropped and device will be banned.
+            self.error("Tried to change MAC. Banning device.")
+            return HTTPStatus.FORBIDDEN
+        return self.__check_duplicates(mac)
 
     def __register(self, data: Device) -> HTTPStatus:
-        self.key.data.MAC = data["MAC"]
-        self.key.data.type = self.device_type
-        if self.device_type == "SSSF":
-            self.key.data.devices = data["AttachedDevices"]
-        registration_check = self.__check_registration()
+        registration_check = self.__check_registration(data["MAC"])
         if registration_check == HTTPStatus.ACCEPTED:
+            self.key.data.MAC = data["MAC"]
+            self.key.data.type = self.device_type
+            if self.device_type == "SSSF":
+                self.key.data.devices = data["AttachedDevices"]
+            self.registry.register(self.key)
             self.info(self.log_registration())
         return registration_check
 
@@ -202,31 +229,32 @@ class DeviceCollection:
         return session_information
 
     def notify_session_members(self, members: List, message: bytes, IP=None):
-        self.key.data.in_use = not self.key.data.in_use
+        # Sessions start with the session information and end without it.
+        in_use = IP is not None
+        if in_use:
+            self.key.data.session = self.registry.new_session(self.key)
+        session = self.key.data.session
+        self.registry.set_in_use(self.key, in_use)
         self.info(f'Notifying devices.')
-        mapping = self.sel.get_map()
         for i in range(1, len(members)):
             msg = message
             if IP:
                 msg += self.create_session_information(i, IP, members)
-            key = mapping[members[i]["ID"]]
-            key.data.callback = key.data.write
-            key.data.outgoing_messages.put(msg)
-            key.data.expecting_response = True
-            key.data.in_use = not key.data.in_use
-            self.sel.modify(key.fileobj, sel.EVENT_WRITE, key.data)
-            self.info(f'Successfully notified {key.data.addr[0]}.')
+            # The device may be connected to another worker of the broker.
+            if self.registry.push(members[i]["ID"], msg, session, in_use):
+                self.info(f'Successfully notified device {members[i]["ID"]}.')
+        if not in_use:
+            self.key.data.session = None
 
     def handle_end_session(self):
         message = "DELETE * HTTP/1.1\r\n"
         message += "Connection: keep-alive\r\n"
         message += "Content-Length: 0\r\n\r\n"
         message = bytes(message, "iso-8859-1")
-        for ip in self.multicast_ips:
-            members = len(ip["sockets"]) > 0
-            if members and self.key.fd == ip["sockets"][0]["ID"]:
-                ip["available"] = True
-                self.notify_session_members(ip["sockets"], message)
+        # Sessions are keyed by the fd of the controller that started them.
+        members = self.multicast_groups.release(self.registry.id_of(self.key))
+        if members:
+            self.notify_session_members(members, message)
 
     @set_key
     @registration_required
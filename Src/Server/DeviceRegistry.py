@@ -0,0 +1,218 @@
+import heapq
+import json
+import selectors as sel
+from itertools import count
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
+
+from DeviceStore import DEVICE_TYPES, DeviceStore
+
+SELECTOR = sel.DefaultSelector
+KEY = sel.SelectorKey
+
+# Device IDs are shard * ID_STRIDE + fd, which is just the fd for a single
+# broker. IDs are 16 bit in the session schemas, so a sharded broker has at
+# most MAX_SHARDS workers of ID_STRIDE connections each.
+ID_STRIDE = 1 << 12
+MAX_SHARDS = (1 << 16) // ID_STRIDE
+
+
+class DeviceRegistry:
+    def __init__(self,
+                 store: Optional[DeviceStore] = None,
+                 shard=0,
+                 forward: Optional[Callable[[int, int, bytes, int, bool], None]] = None) -> None:
+        """Indexes of the connections of the Broker, so requests and the
+        loop tick never have to walk the selector map.
+
+        Connections of this broker are indexed by file descriptor and the
+        ones that have not registered yet by the deadline they have to
+        register by. The deadlines are kept in a heap whose stale entries
+        (the connection registered or closed) are dropped when they reach the
+        top. Registered devices are kept in the store, indexed by MAC, type
+        and availability, which the workers of a sharded broker share.
+
+        Args:
+            store (DeviceStore, optional): Registered devices. Defaults to
+            None (a store of this broker only).
+            shard (int, optional): Index of this broker among the workers of
+            a sharded broker. Defaults to 0.
+            forward (Callable, optional): Called with (shard, device ID,
+            message, session, in use) to push a message to a device
+            connected to another worker. Defaults to None.
+        """
+        self.store = DeviceStore() if store is None else store
+        self.shard = shard
+        self.__forward = forward
+        self.__connections: Dict[int, KEY] = {}
+        self.__macs: Dict[int, str] = {}
+        self.__deadlines: List[Tuple[float, int, int, KEY]] = []
+        self.__tiebreak = count()
+        self.__session_numbers = count(1)
+        self.__epoch = self.store.epoch()
+        # device type -> (version, ETag, serialized available devices)
+        self.__listings: Dict[str, Tuple[int, str, bytes]] = {}
+        # device type -> fd -> connections subscribed to its availability
+        self.__subscribers: Dict[str, Dict[int, KEY]] = {t: {} for t in DEVICE_TYPES}
+        # device type -> version the subscribers were last sent
+        self.__published: Dict[str, int] = {}
+
+    def id_of(self, key: KEY) -> int:
+        return self.shard * ID_STRIDE + key.fd
+
+    def fits(self, fd: int) -> bool:
+        """Whether a connection on fd can be given an ID."""
+        return self.__forward is None or fd < ID_STRIDE
+
+    def __shard_of(self, device_id: int) -> int:
+        if self.__forward is None:
+            return self.shard
+        return device_id // ID_STRIDE
+
+    def connect(self, key: KEY) -> None:
+        self.__connections[key.fd] = key
+        heapq.heappush(self.__deadlines,
+                       (key.data.accept_by, next(self.__tiebreak), key.fd, key))
+
+    def get(self, device_id: int) -> Optional[KEY]:
+        """The connection of device_id if it is connected to this broker."""
+        if self.__shard_of(device_id) != self.shard:
+            return None
+        return self.__connections.get(device_id - self.shard * ID_STRIDE)
+
+    def mac_of(self, key: KEY) -> Optional[str]:
+        """The MAC the connection registered with, None if it has not."""
+        return self.__macs.get(key.fd)
+
+    def with_mac(self, mac: str) -> List[Tuple[int, str]]:
+        return self.store.with_mac(mac)
+
+    def device(self, device_id: int) -> Optional[Dict]:
+        return self.store.device(device_id)
+
+    def register(self, key: KEY) -> None:
+        """Adds key to the store by its MAC and type, replacing an earlier
+        registration of the same connection."""
+        self.__connections[key.fd] = key
+        self.__macs[key.fd] = key.data.MAC
+        self.store.register(
+            self.id_of(key), key.data.MAC, key.data.type, key.data.addr[0],
+            getattr(key.data, "devices", None), key.data.in_use)
+
+    def set_in_use(self, key: KEY, in_use: bool) -> None:
+        key.data.in_use = in_use
+        if key.fd in self.__macs:
+            self.store.set_in_use(self.id_of(key), in_use)
+
+    def claim(self, device_ids: List[int], device_type: str) -> bool:
+        return self.store.claim(device_ids, device_type)
+
+    def release(self, device_ids: List[int]) -> None:
+        self.store.release(device_ids)
+
+    def available_devices(self, device_type: str) -> Tuple[str, bytes]:
+        """ETag and JSON of the available devices of device_type. The JSON
+        is only built again after the store's listing changed."""
+        version, etag, listing = self.__listings.get(device_type, (None, "", b""))
+        changed = self.store.available_devices(device_type, version)
+        if changed is not None:
+            version, devices = changed
+            etag = f'"{self.__epoch}-{version}"'
+            listing = bytes(json.dumps(devices), "UTF-8")
+            self.__listings[device_type] = (version, etag, listing)
+        return etag, listing
+
+    def subscribe(self, key: KEY, device_type: str) -> Dict:
+        """Sends key the changes in availability of device_type from now on.
+        Returns the available devices and their version to start from."""
+        subscribers = self.__subscribers[device_type]
+        # Catch up the others first so they share the version published.
+        self.publish_changes()
+        version, devices = self.store.available_devices(device_type)
+        if not subscribers:
+            self.__published[device_type] = version
+        subscribers[key.fd] = key
+        return {"Version": version, "Devices": devices}
+
+    def unsubscribe(self, key: KEY) -> bool:
+        """Ends every subscription of key. Returns False if it had none."""
+        subscribed = False
+        for subscribers in self.__subscribers.values():
+            if subscribers.pop(key.fd, None) is not None:
+                subscribed = True
+        return subscribed
+
+    def publish_changes(self) -> None:
+        """Queues what changed in availability since the last call for the
+        subscribers of each device type."""
+        for device_type, subscribers in self.__subscribers.items():
+            if not subscribers:
+                continue
+            changes = self.store.changes(device_type, self.__published[device_type])
+            if changes is None:
+                continue
+            self.__published[device_type] = changes["Version"]
+            body = bytes(json.dumps(changes), "UTF-8")
+            message = bytes(
+                f'PATCH /{device_type.lower()} HTTP/1.1\r\n'
+                f'Connection: keep-alive\r\n'
+                f'Content-Type: application/json\r\n'
+                f'Content-Length: {len(body)}\r\n'
+                "\r\n", "iso-8859-1") + body
+            for key in subscribers.values():
+                key.data.outgoing_messages.put(message)
+                key.data.wake(key)
+
+    def new_session(self, key: KEY) -> int:
+        """ID of a session started by the controller key. Device IDs are
+        reused with file descriptors, session IDs are not, so the ID of the
+        controller is combined with a count of the sessions of this worker."""
+        return next(self.__session_numbers) * ID_STRIDE * MAX_SHARDS + self.id_of(key)
+
+    def push(self, device_id: int, message: bytes, session: int, in_use: bool) -> bool:
+        """Queues a session notification for device_id, on whichever worker
+        it is connected to, and moves it into session or, if in_use is False,
+        out of it. Returns False if the device is gone or, since device IDs
+        are reused, its ID now belongs to a connection that is not in (or for
+        a start, is not free to join) session."""
+        shard = self.__shard_of(device_id)
+        if shard != self.shard:
+            self.__forward(shard, device_id, message, session, in_use)
+            return True
+        key = self.get(device_id)
+        if key is None:
+            return False
+        if in_use:
+            if key.data.session is not None or key.data.type != "SSSF":
+                return False
+            key.data.session = session
+        else:
+            if key.data.session != session:
+                return False
+            key.data.session = None
+        key.data.outgoing_messages.put(message)
+        key.data.expecting_response = True
+        self.set_in_use(key, in_use)
+        key.data.wake(key)
+        return True
+
+    def remove(self, key: KEY) -> None:
+        if self.__is_current(key):
+            self.unsubscribe(key)
+            if self.__macs.pop(key.fd, None) is not None:
+                self.store.remove(self.id_of(key))
+            del self.__connections[key.fd]
+
+    def expired(self, current_time: float) -> Iterator[KEY]:
+        """Pops the connections that did not register before their
+        accept_by deadline."""
+        deadlines = self.__deadlines
+        while deadlines and deadlines[0][0] <= current_time:
+            _, _, fd, key = heapq.heappop(deadlines)
+            if self.__is_current(key) and fd not in self.__macs:
+                yield key
+
+    def __is_current(self, key: KEY) -> bool:
+        # Selector keys are replaced on every modify, but their data is not.
+        # The fd may also have been closed and reused by a new connection.
+        current = self.__connections.get(key.fd)
+        return current is not None and current.data is key.data
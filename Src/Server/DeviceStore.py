@@ -0,0 +1,166 @@
+import os
+import threading as th
+from collections import deque
+from typing import Deque, Dict, Iterable, List, Optional, Set, Tuple
+
+DEVICE_TYPES = ("SSSF", "CONTROLLER")
+# Availability changes kept for subscribers that are behind.
+CHANGE_LOG_SIZE = 4096
+
+
+class DeviceStore:
+    def __init__(self) -> None:
+        """The registered devices of the Broker, indexed by MAC, by type and
+        by availability.
+
+        Devices are plain records keyed by their device ID, so the store can
+        be shared by the workers of a sharded broker (served from the parent
+        process by a multiprocessing manager) as well as used in process by
+        a single broker. Every method holds a lock since a manager serves
+        each worker from its own thread.
+
+        The available devices of each type carry a version, changed whenever
+        a device of that type registers, unregisters or joins or leaves a
+        session, so their serialized listing only has to be rebuilt then. The
+        IDs whose availability changed are logged with the version, so
+        subscribers can be sent only what changed since the version they
+        have.
+        """
+        self.__lock = th.Lock()
+        # Tells listings of this store apart from ones of an earlier broker.
+        self.__epoch = os.urandom(4).hex()
+        self.__versions: Dict[str, int] = {t: 0 for t in DEVICE_TYPES}
+        # device type -> (version, device ID) of availability changes
+        self.__changes: Dict[str, Deque[Tuple[int, int]]] = {
+            t: deque(maxlen=CHANGE_LOG_SIZE) for t in DEVICE_TYPES}
+        # device type -> newest version dropped from the change log
+        self.__forgotten: Dict[str, int] = {t: 0 for t in DEVICE_TYPES}
+        self.__devices: Dict[int, Dict] = {}
+        self.__by_mac: Dict[str, Set[int]] = {}
+        self.__by_type: Dict[str, Set[int]] = {t: set() for t in DEVICE_TYPES}
+        # Insertion ordered, so listings keep a stable order.
+        self.__available: Dict[str, Dict[int, None]] = {t: {} for t in DEVICE_TYPES}
+
+    def register(self, device_id: int, mac: str, device_type: str, ip: str,
+                 devices: Optional[List], in_use: bool) -> None:
+        """Adds the device, replacing an earlier registration of the same
+        ID."""
+        with self.__lock:
+            self.__remove(device_id)
+            self.__devices[device_id] = {
+                "MAC": mac, "Type": device_type, "IP": ip,
+                "Devices": devices, "InUse": in_use}
+            self.__by_mac.setdefault(mac, set()).add(device_id)
+            self.__by_type[device_type].add(device_id)
+            if not in_use:
+                self.__available[device_type][device_id] = None
+                self.__changed(device_type, (device_id,))
+
+    def remove(self, device_id: int) -> None:
+        with self.__lock:
+            self.__remove(device_id)
+
+    def __remove(self, device_id: int) -> None:
+        device = self.__devices.pop(device_id, None)
+        if device is None:
+            return
+        ids = self.__by_mac[device["MAC"]]
+        ids.discard(device_id)
+        if not ids:
+            del self.__by_mac[device["MAC"]]
+        self.__by_type[device["Type"]].discard(device_id)
+        available = self.__available[device["Type"]]
+        if device_id in available:
+            del available[device_id]
+            self.__changed(device["Type"], (device_id,))
+
+    def set_in_use(self, device_id: int, in_use: bool) -> None:
+        with self.__lock:
+            device = self.__devices.get(device_id)
+            if device is None or device["InUse"] == in_use:
+                return
+            device["InUse"] = in_use
+            if in_use:
+                self.__available[device["Type"]].pop(device_id, None)
+            else:
+                self.__available[device["Type"]][device_id] = None
+            self.__changed(device["Type"], (device_id,))
+
+    def claim(self, device_ids: Iterable[int], device_type: str) -> bool:
+        """Marks the devices in use if all of them are available, so two
+        controllers can not be given the same device."""
+        with self.__lock:
+            available = self.__available[device_type]
+            device_ids = list(device_ids)
+            if not all(i in available for i in device_ids):
+                return False
+            for i in device_ids:
+                del available[i]
+                self.__devices[i]["InUse"] = True
+            if device_ids:
+                self.__changed(device_type, device_ids)
+            return True
+
+    def release(self, device_ids: Iterable[int]) -> None:
+        """Makes claimed devices available again."""
+        for i in device_ids:
+            self.set_in_use(i, False)
+
+    def device(self, device_id: int) -> Optional[Dict]:
+        with self.__lock:
+            device = self.__devices.get(device_id)
+            return None if device is None else dict(device)
+
+    def with_mac(self, mac: str) -> List[Tuple[int, str]]:
+        """(ID, IP address) of the devices registered with mac."""
+        with self.__lock:
+            return [(i, self.__devices[i]["IP"]) for i in self.__by_mac.get(mac, ())]
+
+    def __changed(self, device_type: str, device_ids: Iterable[int]) -> None:
+        self.__versions[device_type] += 1
+        version = self.__versions[device_type]
+        changes = self.__changes[device_type]
+        for i in device_ids:
+            if len(changes) == changes.maxlen:
+                self.__forgotten[device_type] = changes[0][0]
+            changes.append((version, i))
+
+    def epoch(self) -> str:
+        return self.__epoch
+
+    def available_devices(self, device_type: str,
+                          known_version: Optional[int] = None) -> Optional[Tuple[int, List[Dict]]]:
+        """The version and available devices of device_type as listed by
+        GET /<type>, None if they are still at known_version."""
+        with self.__lock:
+            version = self.__versions[device_type]
+            if version == known_version:
+                return None
+            return version, [{"ID": i, "Devices": self.__devices[i]["Devices"]}
+                             for i in self.__available[device_type]]
+
+    def changes(self, device_type: str, known_version: int) -> Optional[Dict]:
+        """What changed in the available devices of device_type since
+        known_version, None if nothing did. Devices that became available are
+        listed with their attached devices and ones that did not stay
+        available by ID. When the changes since known_version are no longer
+        logged, every available device is listed as a snapshot instead."""
+        with self.__lock:
+            version = self.__versions[device_type]
+            if version == known_version:
+                return None
+            available = self.__available[device_type]
+            if known_version < self.__forgotten[device_type]:
+                return {"Version": version, "Snapshot": True,
+                        "Available": [{"ID": i, "Devices": self.__devices[i]["Devices"]}
+                                      for i in available],
+                        "Unavailable": []}
+            changed: Dict[int, None] = {}
+            for change_version, i in reversed(self.__changes[device_type]):
+                if change_version <= known_version:
+                    break
+                changed[i] = None
+            return {"Version": version, "Snapshot": False,
+                    "Available": [{"ID": i, "Devices": self.__devices[i]["Devices"]}
+                                  for i in changed if i in available],
+                    "Unavailable": [i for i in changed if i not in available]}
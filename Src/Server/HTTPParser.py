@@ -0,0 +1,108 @@
+import socket as soc
+from typing import List, Optional
+
+MAX_HEADER_SIZE = 65536
+MAX_BODY_SIZE = 1 << 20
+RECV_SIZE = 65536
+
+
+class HTTPParseError(ValueError):
+    pass
+
+
+class HTTPParser:
+    def __init__(self,
+                 max_header_size=MAX_HEADER_SIZE,
+                 max_body_size=MAX_BODY_SIZE) -> None:
+        """Splits the byte stream of a connection into HTTP messages.
+
+        Received data is appended to one buffer per connection. Messages are
+        framed by their Content-Length (no Content-Length means no body), so
+        requests split across reads are kept until they are complete and
+        pipelined requests are all returned from the same read. Requests and
+        responses (devices answering a session notification) are framed the
+        same way.
+
+        Args:
+            max_header_size (int, optional): Largest request line and headers
+            accepted. Defaults to MAX_HEADER_SIZE.
+            max_body_size (int, optional): Largest body accepted. Defaults to
+            MAX_BODY_SIZE.
+        """
+        self.max_header_size = max_header_size
+        self.max_body_size = max_body_size
+        self.__buffer = bytearray()
+        self.__chunk = bytearray(RECV_SIZE)
+        # Start of the unparsed data in the buffer
+        self.__start = 0
+        # Where the search for the end of the headers resumes
+        self.__scanned = 0
+        # End of the message being received, once its headers are complete
+        self.__end: Optional[int] = None
+
+    def __len__(self) -> int:
+        """Bytes received that are not part of a returned message yet."""
+        return len(self.__buffer) - self.__start
+
+    def recv(self, sock: soc.socket) -> int:
+        """Receives what is available on sock into the buffer. Returns 0
+        when the peer closed the connection."""
+        n = sock.recv_into(self.__chunk)
+        if n:
+            self.__buffer += memoryview(self.__chunk)[:n]
+        return n
+
+    def feed(self, data: bytes) -> None:
+        self.__buffer += data
+
+    def messages(self) -> List[bytes]:
+        """Returns every complete message in the buffer and keeps the rest
+        for the next read."""
+        complete = []
+        buffer = self.__buffer
+        while True:
+            if self.__end is None:
+                head_end = buffer.find(b"\r\n\r\n", max(self.__scanned, self.__start))
+                if head_end == -1:
+                    if len(buffer) - self.__start > self.max_header_size:
+                        raise HTTPParseError("Headers too large.")
+                    # The terminator may straddle the next read.
+                    self.__scanned = max(len(buffer) - 3, self.__start)
+                    break
+                head_end += 4
+                if head_end - self.__start > self.max_header_size:
+                    raise HTTPParseError("Headers too large.")
+                self.__end = head_end + self.__content_length(self.__start, head_end)
+            if len(buffer) < self.__end:
+                break
+            complete.append(bytes(buffer[self.__start:self.__end]))
+            self.__start = self.__scanned = self.__end
+            self.__end = None
+        if self.__start == len(buffer):
+            buffer.clear()
+            self.__start = self.__scanned = 0
+        elif self.__start > RECV_SIZE:
+            # Drop the parsed messages, keeping the partial one.
+            del buffer[:self.__start]
+            self.__scanned -= self.__start
+            if self.__end is not None:
+                self.__end -= self.__start
+            self.__start = 0
+        return complete
+
+    def __content_length(self, start: int, head_end: int) -> int:
+        length = 0
+        headers = bytes(self.__buffer[start:head_end]).split(b"\r\n")[1:]
+        for line in headers:
+            name, _, value = line.partition(b":")
+            name = name.strip().lower()
+            if name == b"content-length":
+                try:
+                    length = int(value)
+                except ValueError:
+                    raise HTTPParseError(f"Invalid Content-Length {value!r}.")
+            elif name == b"transfer-encoding":
+                raise HTTPParseError("Transfer-Encoding is not supported.")
+        if length < 0 or length > self.max_body_size:
+            raise HTTPParseError(f"Invalid Content-Length {length}.")
+        return length
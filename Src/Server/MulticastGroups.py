@@ -0,0 +1,82 @@
+import threading as th
+from bisect import bisect_right
+from ipaddress import IPv4Address, IPv4Network, ip_network
+from typing import Dict, Iterable, List, Optional, Tuple
+
+DEFAULT_NETWORKS = ("239.255.0.0/16",)
+
+
+class MulticastGroups:
+    def __init__(self, networks: Iterable[str] = DEFAULT_NETWORKS) -> None:
+        """Allocates a multicast group to each session.
+
+        Groups are handed out from the configured networks in order. Addresses
+        that were never used are taken from a counter and released ones from
+        a free list, so nothing is built per address up front and allocating,
+        releasing and looking up a session are constant time. Every method
+        holds a lock, so the workers of a sharded broker can share one
+        allocator through a multiprocessing manager.
+
+        Args:
+            networks (Iterable[str], optional): Multicast networks to allocate
+            from. Defaults to 239.255.0.0/16.
+        """
+        self.networks: List[IPv4Network] = []
+        self.__bases: List[int] = []
+        self.__starts: List[int] = []
+        self.size = 0
+        for network in networks:
+            network = ip_network(network)
+            if not network.is_multicast or network.version != 4:
+                raise ValueError(f"{network} is not an IPv4 multicast network.")
+            self.networks.append(network)
+            self.__bases.append(int(network.network_address))
+            self.__starts.append(self.size)
+            self.size += network.num_addresses
+        self.__lock = th.Lock()
+        self.__next = 0
+        self.__free: List[int] = []
+        # session id -> (group offset, session members)
+        self.__sessions: Dict[int, Tuple[int, List]] = {}
+
+    def __len__(self) -> int:
+        """Number of groups in use."""
+        return len(self.__sessions)
+
+    def __address(self, offset: int) -> IPv4Address:
+        i = bisect_right(self.__starts, offset) - 1
+        return IPv4Address(self.__bases[i] + offset - self.__starts[i])
+
+    def allocate(self, session_id: int, members: List) -> Optional[IPv4Address]:
+        """Assigns a free group to session_id, None if all are in use."""
+        with self.__lock:
+            if session_id in self.__sessions:
+                raise ValueError(f"Session {session_id} already has a group.")
+            if self.__free:
+                offset = self.__free.pop()
+            elif self.__next < self.size:
+                offset = self.__next
+                self.__next += 1
+            else:
+                return None
+            self.__sessions[session_id] = (offset, members)
+            return self.__address(offset)
+
+    def release(self, session_id: int) -> Optional[List]:
+        """Frees the group of session_id and returns the session members,
+        None if the session has no group."""
+        with self.__lock:
+            session = self.__sessions.pop(session_id, None)
+            if session is None:
+                return None
+            offset, members = session
+            self.__free.append(offset)
+            return members
+
+    def group_of(self, session_id: int) -> Optional[IPv4Address]:
+        session = self.__sessions.get(session_id)
+        return None if session is None else self.__address(session[0])
+
+    def members_of(self, session_id: int) -> Optional[List]:
+        session = self.__sessions.get(session_id)
+        return None if session is None else session[1]
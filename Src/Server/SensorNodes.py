@@ -4,22 +4,23 @@ from http import HTTPStatus
 from io import BytesIO
 from ipaddress import IPv4Address
 from json.decoder import JSONDecodeError
-from typing import Dict, List
+from typing import Dict, List, Optional
 
 from jsonschema import ValidationError
 from jsonschema.protocols import Validator
 
 import Routes
-from Device import Device
 from DeviceCollection import DeviceCollection
+from DeviceRegistry import DeviceRegistry
+from MulticastGroups import MulticastGroups
 
 SELECTOR = sel.DefaultSelector
 KEY = sel.SelectorKey
 
 
 class SensorNodes(DeviceCollection):
-    def __init__(self, _sel: SELECTOR, _multicast_ips: List) -> None:
-        super().__init__(_sel, _multicast_ips)
+    def __init__(self, _sel: SELECTOR, _multicast_groups: MulticastGroups, _registry: DeviceRegistry) -> None:
+        super().__init__(_sel, _multicast_groups, _registry)
         self.reg_schema, _ = self.compile_schema("ControllerRegistration.json")
         self.request_schema, _ = self.compile_schema("ControllerRequest.json")
         self.session_schema, _ = self.compile_schema("SessionInformation.json")
@@ -71,32 +72,37 @@ class SensorNodes(DeviceCollection):
         session_message = bytes(session_message, "iso-8859-1")
         return session_message
 
-    def __find_mcast_IP(self, members: List) -> IPv4Address:
-        for ip in self.multicast_ips:
-            if ip["available"]:
-                self.info(f'Found available multicast IP address: {ip["ip"]}.')
-                ip["available"] = False
-                ip["sockets"] = members
-                return ip["ip"]
+    def __find_mcast_IP(self, members: List) -> Optional[IPv4Address]:
+        ip = self.multicast_groups.allocate(self.registry.id_of(self.key), members)
+        if ip is not None:
+            self.info(f'Found available multicast IP address: {ip}.')
+        return ip
 
     def __gather_requested_devices(self, requested: List) -> List:
         self.info("Gathering requested devices.")
-        available = Device.get_available_devices(self.sel, Device.is_SSSF)
-        members = [{"ID": self.key.fd, "Index": 0, "Devices": ["Controller"]}]
-        mapping = self.sel.get_map()
+        members = [{
+            "ID": self.registry.id_of(self.key), "Index": 0, "Devices": ["Controller"]}]
         for i in range(len(requested)):
             device = requested[i]
-            key = mapping[device["ID"]]
-            if device in available:
-                self.info(f'{key.data.addr[0]} is available.')
+            registered = self.registry.device(device["ID"])
+            if registered is None:
+                self.error(f'Device {device["ID"]} is not connected.')
+                return []
+            available = registered["Type"] == "SSSF" and not registered["InUse"]
+            if available and registered["Devices"] == device["Devices"]:
+                self.info(f'{registered["IP"]} is available.')
                 members.append({
                     "ID": device["ID"],
                     "Index": i + 1,
                     "Devices": device["Devices"]
                 })
             else:
-                self.error(f'{key.data.addr[0]} is not available.')
+                self.error(f'{registered["IP"]} is not available.')
                 return []
+        # Another controller may have taken one of them in the meantime.
+        if not self.registry.claim([m["ID"] for m in members[1:]], "SSSF"):
+            self.error("Requested devices were taken by another controller.")
+            return []
         return members
 
     def __initiate_session_request(self, requested: Dict, wfile: BytesIO):
@@ -106,12 +112,21 @@ class SensorNodes(DeviceCollection):
                 "different controller. Banning this controller."
             )
             return HTTPStatus.FORBIDDEN
+        elif self.key.data.in_use:
+            self.error("Already is in a session.")
+            return HTTPStatus.CONFLICT
         else:
             members = self.__gather_requested_devices(requested["Devices"])
             if len(members) > 1:
                 self.info("Successfully allocated requested devices.")
                 ip = self.__find_mcast_IP(members)
+                if ip is None:
+                    self.error("No multicast IP addresses are available.")
+                    self.registry.release([m["ID"] for m in members[1:]])
+                    return HTTPStatus.SERVICE_UNAVAILABLE
                 wfile.write(self.create_session_information(0, ip, members))
+                # Availability is not pushed to controllers in a session.
+                self.registry.unsubscribe(self.key)
                 message = self.__create_start_message()
                 self.notify_session_members(members, message, ip)
                 return HTTPStatus.CREATED
@@ -125,7 +140,7 @@ class SensorNodes(DeviceCollection):
     def start_session(self, key: KEY, rfile: BytesIO, wfile: BytesIO) -> HTTPStatus:
         self.info("Initiated session request.")
         try:
-            data = json.loads(rfile.read(4096))
+            data = json.load(rfile)
             self.request_schema.validate(data)
             return self.__initiate_session_request(data, wfile)
         except (ValidationError, JSONDecodeError) as jde:
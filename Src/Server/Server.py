@@ -1,29 +1,41 @@
+import argparse
 import asyncio
 import atexit
-import http.client
 import logging
 import os
 import queue
 import selectors as sel
 import socket as soc
 from copy import copy
+from itertools import islice
 from http import HTTPStatus
 from io import BytesIO
-from ipaddress import IPv4Address, ip_network
+from ipaddress import IPv4Address
 from logging.handlers import TimedRotatingFileHandler
 from time import time
 from types import SimpleNamespace
-from typing import Dict, List
+from typing import Iterable, List, Optional
 
 import Routes
 from CANNodes import CANNodes
 from Device import Device
+from HTTPParser import RECV_SIZE, HTTPParseError
+from DeviceRegistry import DeviceRegistry
+from MulticastGroups import DEFAULT_NETWORKS, MulticastGroups
 from SensorNodes import SensorNodes
+from Shards import Shard, serve
 from Wrap_HTTPRequestHandler import Wrap_HTTPRequestHandler
 
 SELECTOR = sel.DefaultSelector
 KEY = sel.SelectorKey
 
+SERVER_MODES = ("selectors", "asyncio")
+# Most buffers handed to one sendmsg call.
+try:
+    MAX_IOV = os.sysconf("SC_IOV_MAX")
+except (AttributeError, ValueError, OSError):
+    MAX_IOV = 1024
+
 """TODO Notes:
     - When recving or sending timeout should be calculated dynamically.
         - From:
@@ -59,18 +71,31 @@ class ColoredConsoleHandler(logging.StreamHandler):
 
 class Broker(Wrap_HTTPRequestHandler):
 
-    def __init__(self, _keepalive_interval=300) -> None:
+    def __init__(self,
+                 _keepalive_interval=300,
+                 _multicast_networks: Iterable[str] = DEFAULT_NETWORKS,
+                 _shard: Optional[Shard] = None) -> None:
         self.client_address = None
         self.keepalive_interval = _keepalive_interval
         self.protocol_version = "HTTP/1.1"
+        self.shard = _shard
         atexit.register(self.__exit)
         self.__setup_logging()
         self.log_message("Broker Initializing.")
         self.sel = sel.DefaultSelector()
-        self.multicast_ips: List[Dict] = self.__init_multicast_ips()
         self.blacklist_ips: List[IPv4Address] = []
-        self.SSSFs = CANNodes(self.sel, self.multicast_ips)
-        self.CONTROLLERs = SensorNodes(self.sel, self.multicast_ips)
+        if _shard is None:
+            self.multicast_groups = MulticastGroups(_multicast_networks)
+            self.registry = DeviceRegistry()
+        else:
+            # One of the workers of Shards.serve, sharing the registered
+            # devices and multicast groups with the others.
+            _shard.connect()
+            self.multicast_groups = _shard.multicast_groups
+            self.registry = DeviceRegistry(
+                _shard.store, _shard.index, _shard.link.forward)
+        self.SSSFs = CANNodes(self.sel, self.multicast_groups, self.registry)
+        self.CONTROLLERs = SensorNodes(self.sel, self.multicast_groups, self.registry)
         self.__setup()
 
     def __findpath(self, log_name: str) -> str:
@@ -84,7 +109,10 @@ class Broker(Wrap_HTTPRequestHandler):
         return os.path.join(log_path, log_name)
 
     def __setup_logging(self) -> None:
-        filename = self.__findpath("broker_log")
+        log_name = "broker_log"
+        if self.shard is not None:
+            log_name += f"_{self.shard.index}"
+        filename = self.__findpath(log_name)
         logging.basicConfig(
             format='%(asctime)-15s %(module)-10.10s %(levelname)s %(message)s',
             level=logging.DEBUG,
@@ -100,31 +128,46 @@ class Broker(Wrap_HTTPRequestHandler):
             ]
         )
 
-    def __init_multicast_ips(self) -> List[Dict]:
-        ips = []
-        for ip in ip_network('239.255.0.0/16'):
-            ips.append({
-                "ip": ip,
-                "available": True,
-                "sockets": []
-            })
-        return ips
-
     def __setup(self):
         self.lsock = soc.socket(soc.AF_INET, soc.SOCK_STREAM)
         self.lsock.setsockopt(soc.SOL_SOCKET, soc.SO_REUSEADDR, 1)
+        if self.shard is not None:
+            # The kernel spreads new connections over the workers.
+            self.lsock.setsockopt(soc.SOL_SOCKET, soc.SO_REUSEPORT, 1)
         self.lsock.setblocking(False)
         data = SimpleNamespace(callback=self.__accept)
         self.sel.register(self.lsock, sel.EVENT_READ, data=data)
-
-    def listen(self) -> None:
+        if self.shard is not None:
+            data = SimpleNamespace(callback=self.__receive_forwarded)
+            self.sel.register(self.shard.link, sel.EVENT_READ, data=data)
+
+    def listen(self, mode: str = "selectors") -> None:
+        """Serves requests until interrupted.
+
+        Args:
+            mode (str, optional): "selectors" serves every connection from one
+            selector loop. "asyncio" runs an asyncio server with a task per
+            connection, so a slow or rate limited device only delays itself.
+            Defaults to "selectors".
+        """
+        if mode not in SERVER_MODES:
+            raise ValueError(f'Mode must be one of {", ".join(SERVER_MODES)}.')
         device_address = soc.gethostbyname_ex(soc.gethostname())[2]
         self.lsock.bind(('', 80))
         self.lsock.listen()
         self.log_message(
             f'Listening on these interfaces: {device_address}:80'
         )
-        asyncio.run(self.__listening_loop())
+        if mode == "asyncio":
+            self.sel.unregister(self.lsock)
+            if self.shard is not None:
+                self.sel.unregister(self.shard.link)
+            try:
+                asyncio.run(self.__serve())
+            except KeyboardInterrupt:
+                return
+        else:
+            asyncio.run(self.__listening_loop())
 
     async def __listening_loop(self) -> None:
         while True:
@@ -140,12 +183,10 @@ class Broker(Wrap_HTTPRequestHandler):
                 self.__prune_connections()
 
     async def __events(self, key: KEY, mask):
-        if mask == sel.EVENT_READ and key.data.callback != self.__accept:
-            if not key.data.rate_limit(self.log_error):
+        if mask == sel.EVENT_READ and isinstance(key.data, Device):
+            if key.data.rate_limit(self.log_error):
                 await asyncio.sleep(0.2)
-                self.__call_callback(key)
-        else:
-            self.__call_callback(key)
+        self.__call_callback(key)
 
     def __call_callback(self, key: KEY):
         if hasattr(key.data, "addr"):
@@ -158,13 +199,12 @@ class Broker(Wrap_HTTPRequestHandler):
         """Loose connections are accepted connections from devices that don't
         register within 30 seconds of connecting."""
         current_time = time()
-        sel_map = self.sel.get_map()
-        for fd in sel_map:
-            key = sel_map[fd]
-            not_lsock = hasattr(key.data, "MAC")
-            if not_lsock and key.data.is_loose(current_time, self.log_error):
+        for key in self.registry.expired(current_time):
+            if key.data.is_loose(current_time, self.log_error):
                 key.data.close_connection = True
-                self.sel.modify(key.fileobj, sel.EVENT_WRITE, key.data)
+                key.data.wake(key)
+        # Also picks up changes made by the other workers of a sharded broker.
+        self.registry.publish_changes()
 
     def __accept(self, key: KEY) -> None:
         """Takes a new connection from the listening socket and assigns it its
@@ -177,11 +217,27 @@ class Broker(Wrap_HTTPRequestHandler):
                 f'Blacklisted IP address: {addr[0]} tried to connect.')
             conn.shutdown(soc.SHUT_RDWR)
             conn.close()
+        elif not self.registry.fits(conn.fileno()):
+            self.log_error(f'Too many connections, refused {addr[0]}.')
+            conn.close()
         else:
             self.log_message(f'New connection from: {addr[0]}:{str(addr[1])}')
             self.__set_keepalive(conn)
             data = Device(self.__read, self.__write, addr)
-            self.sel.register(conn, sel.EVENT_READ, data=data)
+            data.wake = self.__wake_writer
+            self.registry.connect(self.sel.register(conn, sel.EVENT_READ, data=data))
+
+    def __receive_forwarded(self, key: KEY = None) -> None:
+        """Queues the session notifications other workers forwarded for
+        devices connected to this one."""
+        for device_id, message, session, in_use in self.shard.link.receive():
+            if not self.registry.push(device_id, message, session, in_use):
+                self.log_error(f'Device {device_id} closed or left the session '
+                               'before it was notified.')
+
+    def __wake_writer(self, key: KEY) -> None:
+        key.data.callback = key.data.write
+        self.sel.modify(key.fileobj, sel.EVENT_WRITE, key.data)
 
     def __set_keepalive(self, conn: soc.SocketType) -> None:
         conn.setsockopt(soc.SOL_SOCKET, soc.SO_KEEPALIVE, 1)
@@ -192,19 +248,40 @@ class Broker(Wrap_HTTPRequestHandler):
         conn.setsockopt(soc.IPPROTO_TCP, soc.TCP_KEEPCNT, 3)
 
     def __read(self, key: KEY):
-        if key.data.expecting_response:
-            self.__handle_response(key)
-        else:
-            try:
-                message = key.fileobj.recv(4096)
-            except OSError as ose:
-                self.log_error(f'{ose}')
-                key.data.close_connection = True
-                self.__shutdown_connection(key)
-            else:
-                self.__handle_request(key, message)
+        parser = key.data.parser
+        try:
+            received = parser.recv(key.fileobj)
+            messages = parser.messages()
+        except BlockingIOError:
+            return
+        except (OSError, HTTPParseError) as e:
+            self.log_error(f'{e}')
+            key.data.close_connection = True
+            self.__shutdown_connection(key)
+            return
+        if not received:
+            self.__shutdown_connection(key)
+        elif self.__handle_messages(key, messages):
+            key.data.wake(key)
+
+    def __handle_messages(self, key: KEY, messages: List[bytes]) -> bool:
+        """Handles the complete messages read from a connection in order.
+        Returns True if responses were queued."""
+        responded = False
+        for message in messages:
+            if message.startswith(b"HTTP/"):
+                # The device answering a session notification.
+                key.data.expecting_response = False
+                continue
+            responded = self.__respond(key, message) or responded
+            if key.data.close_connection:
+                break
+        self.registry.publish_changes()
+        return responded
 
-    def __handle_request(self, key: KEY, message: bytes) -> None:
+    def __respond(self, key: KEY, message: bytes) -> bool:
+        """Handles the request in message and queues the response on the
+        connection. Returns False if there is nothing to send back."""
         with BytesIO() as self.wfile, BytesIO(message) as self.rfile:
             self.key = key
             self.handle_one_request()
@@ -213,25 +290,11 @@ class Broker(Wrap_HTTPRequestHandler):
             outgoing = self.wfile.read()
             if len(outgoing) > 0:
                 key.data.outgoing_messages.put(outgoing)
-                key.data.callback = self.__write
-                key.data.close_connection = self.close_connection
-                self.sel.modify(key.fileobj, sel.EVENT_WRITE, key.data)
-            else:
-                self.__shutdown_connection(key)
-
-    def __handle_response(self, key: KEY):
-        key.data.response = http.client.HTTPResponse(key.fileobj)
-        try:
-            key.data.response.begin()
-            key.data.expecting_response = False
-        except (
-            http.client.HTTPException,
-            http.client.BadStatusLine,
-            OSError
-        ) as ose:
-            self.log_error(f'{ose}')
-            key.data.close_connection = True
-            self.__shutdown_connection(key)
+                # A route may already have decided to drop the connection.
+                key.data.close_connection = (
+                    key.data.close_connection or self.close_connection)
+                return True
+            return False
 
     def do_GET(self):
         self.__method_proxy()
@@ -269,11 +332,15 @@ class Broker(Wrap_HTTPRequestHandler):
         try:
             device_list = getattr(self, self.__parse_path())
             func = Routes.routes[self.path.upper() + self.command.upper()]
+            self.key.data.request_headers = self.headers
+            self.key.data.response_headers = {}
             response = func(device_list, self.key, self.rfile, self.wfile)
             if response == HTTPStatus.FORBIDDEN:
                 self.blacklist_ips.append(self.key.addr[0])
                 self.key.data.close_connection = True
             self.send_response(response)
+            for name, value in self.key.data.response_headers.items():
+                self.send_header(name, value)
         except (KeyError, AttributeError) as ae:
             logging.warning(ae)
             self.log_error(
@@ -283,21 +350,50 @@ class Broker(Wrap_HTTPRequestHandler):
             self.send_error(HTTPStatus.NOT_FOUND)
 
     def __write(self, key: KEY):
+        """Sends the queued messages of a connection, as many as the socket
+        takes in one sendmsg call each. The connection stays registered for
+        EVENT_WRITE until everything is sent."""
+        unsent = key.data.unsent
         try:
             while True:
-                message = key.data.outgoing_messages.get_nowait()
-                key.fileobj.sendall(message)
+                unsent.append(memoryview(key.data.outgoing_messages.get_nowait()))
         except queue.Empty:
-            key.data.callback = self.__read
-            self.sel.modify(key.fileobj, sel.EVENT_READ, key.data)
+            pass
+        try:
+            while unsent:
+                sent = key.fileobj.sendmsg(
+                    unsent if len(unsent) <= MAX_IOV else list(islice(unsent, MAX_IOV)))
+                while sent:
+                    if sent >= len(unsent[0]):
+                        sent -= len(unsent.popleft())
+                    else:
+                        unsent[0] = unsent[0][sent:]
+                        sent = 0
+        except BlockingIOError:
+            # The socket buffer is full, wait for the next EVENT_WRITE.
+            return
         except OSError as ose:
             self.log_error(f'{ose}')
             key.data.close_connection = True
-        finally:
-            if key.data.close_connection:
-                self.__shutdown_connection(key)
+        if key.data.close_connection:
+            self.__shutdown_connection(key)
+        else:
+            key.data.callback = self.__read
+            self.sel.modify(key.fileobj, sel.EVENT_READ, key.data)
 
     def __shutdown_connection(self, key: KEY) -> None:
+        self.__end_connection(key)
+        self.sel.unregister(key.fileobj)
+        try:
+            key.fileobj.shutdown(soc.SHUT_RDWR)
+        except OSError:
+            # The peer already reset the connection.
+            pass
+        key.fileobj.close()
+
+    def __end_connection(self, key: KEY) -> None:
+        """Ends the session and registration of a connection that is about
+        to be closed."""
         logging.info(f'{key.data.addr[0]} - Closing connection.')
         try:
             valid_type = hasattr(
@@ -313,17 +409,120 @@ class Broker(Wrap_HTTPRequestHandler):
                     )
         except (KeyError, AttributeError) as ae:
             logging.error(ae)
-        self.sel.unregister(key.fileobj)
-        key.fileobj.shutdown(soc.SHUT_RDWR)
-        key.fileobj.close()
+        self.registry.remove(key)
+        self.registry.publish_changes()
+
+    # asyncio server mode
+    # ----------------------------------
+
+    async def __serve(self) -> None:
+        server = await asyncio.start_server(self.__serve_connection, sock=self.lsock)
+        if self.shard is not None:
+            asyncio.get_running_loop().add_reader(
+                self.shard.link.fileno(), self.__receive_forwarded)
+        async with server:
+            pruner = asyncio.create_task(self.__prune_loop())
+            try:
+                await server.serve_forever()
+            finally:
+                pruner.cancel()
+
+    async def __prune_loop(self) -> None:
+        while True:
+            await asyncio.sleep(1)
+            self.__prune_connections()
+
+    async def __serve_connection(self, reader: asyncio.StreamReader,
+                                 writer: asyncio.StreamWriter) -> None:
+        addr = writer.get_extra_info("peername")
+        sock = writer.get_extra_info("socket")
+        if addr[0] in self.blacklist_ips:
+            self.log_error(
+                f'Blacklisted IP address: {addr[0]} tried to connect.')
+            writer.close()
+            return
+        if not self.registry.fits(sock.fileno()):
+            self.log_error(f'Too many connections, refused {addr[0]}.')
+            writer.close()
+            return
+        self.log_message(f'New connection from: {addr[0]}:{str(addr[1])}')
+        self.__set_keepalive(sock)
+        data = Device(self.__read, self.__write, addr)
+        data.writable = asyncio.Event()
+        data.wake = lambda key: key.data.writable.set()
+        key = KEY(sock, sock.fileno(), sel.EVENT_READ, data)
+        self.registry.connect(key)
+        writing = asyncio.create_task(self.__stream_writes(key, writer))
+        try:
+            while not data.close_connection:
+                received = await reader.read(RECV_SIZE)
+                if not received:
+                    break
+                data.parser.feed(received)
+                messages = data.parser.messages()
+                if not messages:
+                    continue
+                if data.rate_limit(self.log_error):
+                    # Only delays this connection.
+                    await asyncio.sleep(0.2)
+                self.client_address = addr
+                responded = self.__handle_messages(key, messages)
+                self.client_address = None
+                if responded:
+                    data.wake(key)
+        except (HTTPParseError, OSError) as e:
+            self.log_error(f'{e}')
+        finally:
+            data.close_connection = True
+            data.wake(key)
+            await writing
+            self.__end_connection(key)
+            writer.close()
+            try:
+                await writer.wait_closed()
+            except OSError:
+                pass
+
+    async def __stream_writes(self, key: KEY, writer: asyncio.StreamWriter) -> None:
+        data = key.data
+        try:
+            while True:
+                await data.writable.wait()
+                data.writable.clear()
+                messages = []
+                try:
+                    while True:
+                        messages.append(data.outgoing_messages.get_nowait())
+                except queue.Empty:
+                    pass
+                writer.writelines(messages)
+                await writer.drain()
+                if data.close_connection:
+                    break
+        except OSError as ose:
+            self.log_error(f'{ose}')
+            data.close_connection = True
+        # Also ends a read that is waiting on the connection.
+        writer.close()
 
     def __exit(self) -> None:
         self.sel.close()
+        if self.shard is not None:
+            self.shard.link.close()
 
 
 def main():
-    broker = Broker(5)
-    broker.listen()
+    parser = argparse.ArgumentParser(description="CANLay broker.")
+    parser.add_argument("--mode", choices=SERVER_MODES, default="selectors",
+                        help="How connections are served.")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="Broker processes sharing the port.")
+    args = parser.parse_args()
+    if args.workers > 1:
+        serve(args.workers, args.mode, 5)
+    else:
+        broker = Broker(5)
+        broker.listen(args.mode)
 
 
 if __name__ == "__main__":
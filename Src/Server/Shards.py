@@ -0,0 +1,175 @@
+import logging
+import multiprocessing as mp
+import os
+import shutil
+import socket as soc
+import struct
+import tempfile
+import threading as th
+from multiprocessing.managers import BaseManager
+from typing import Iterable, List, Tuple
+
+from DeviceRegistry import MAX_SHARDS
+from DeviceStore import DeviceStore
+from MulticastGroups import DEFAULT_NETWORKS, MulticastGroups
+
+# device ID, session, in use
+FORWARD_HEADER = struct.Struct("<QQ?")
+LINK_BUFFER_SIZE = 1 << 22
+
+
+class StoreManager(BaseManager):
+    """Proxies to the DeviceStore and MulticastGroups served by the parent of
+    the broker workers."""
+
+
+StoreManager.register("DeviceStore")
+StoreManager.register("MulticastGroups")
+
+
+class ShardLink:
+    def __init__(self, shard: int, paths: List[str]) -> None:
+        """Datagram sockets between the workers of a sharded broker, used to
+        queue session notifications for devices connected to another worker.
+
+        Each worker binds a Unix datagram socket at its own path. Every
+        notification is one datagram, so it is never split or merged with
+        another.
+
+        Args:
+            shard (int): Index of this worker.
+            paths (List[str]): Socket path of every worker, by index.
+        """
+        self.paths = paths
+        self.sock = soc.socket(soc.AF_UNIX, soc.SOCK_DGRAM)
+        self.sock.setsockopt(soc.SOL_SOCKET, soc.SO_RCVBUF, LINK_BUFFER_SIZE)
+        self.sock.bind(paths[shard])
+        self.sock.setblocking(False)
+        # Sends block rather than drop a notification when a worker is busy.
+        self.__sender = soc.socket(soc.AF_UNIX, soc.SOCK_DGRAM)
+        self.__sender.setsockopt(soc.SOL_SOCKET, soc.SO_SNDBUF, LINK_BUFFER_SIZE)
+
+    def fileno(self) -> int:
+        return self.sock.fileno()
+
+    def forward(self, shard: int, device_id: int, message: bytes, session: int,
+                in_use: bool) -> None:
+        try:
+            self.__sender.sendto(
+                FORWARD_HEADER.pack(device_id, session, in_use) + message, self.paths[shard])
+        except OSError as ose:
+            logging.error(f'Could not forward to worker {shard}: {ose}')
+
+    def receive(self) -> List[Tuple[int, bytes, int, bool]]:
+        """(device ID, message, session, in use) of every notification
+        waiting."""
+        received = []
+        while True:
+            try:
+                datagram = self.sock.recv(LINK_BUFFER_SIZE)
+            except BlockingIOError:
+                return received
+            device_id, session, in_use = FORWARD_HEADER.unpack_from(datagram)
+            received.append((device_id, datagram[FORWARD_HEADER.size:], session, in_use))
+
+    def close(self) -> None:
+        self.sock.close()
+        self.__sender.close()
+
+
+class Shard:
+    def __init__(self, index: int, count: int, directory: str,
+                 authkey: bytes) -> None:
+        """What a broker worker needs to reach the shared state and the other
+        workers. Only plain values are kept until connect, so it can be passed
+        to a new process.
+
+        Args:
+            index (int): Index of this worker.
+            count (int): Number of workers.
+            directory (str): Where the store manager and worker sockets are.
+            authkey (bytes): Key of the store manager.
+        """
+        self.index = index
+        self.count = count
+        self.directory = directory
+        self.authkey = authkey
+        self.store = None
+        self.multicast_groups = None
+        self.link = None
+
+    def connect(self) -> None:
+        manager = StoreManager(address=store_address(self.directory),
+                               authkey=self.authkey)
+        manager.connect()
+        self.store = manager.DeviceStore()
+        self.multicast_groups = manager.MulticastGroups()
+        self.link = ShardLink(self.index, link_paths(self.directory, self.count))
+
+
+def store_address(directory: str) -> str:
+    return os.path.join(directory, "store")
+
+
+def link_paths(directory: str, count: int) -> List[str]:
+    return [os.path.join(directory, f"shard{i}") for i in range(count)]
+
+
+def _run_worker(shard: Shard, mode: str, keepalive_interval: int) -> None:
+    # Imported here so the Broker and its routes load in the worker only.
+    from Server import Broker
+    Broker(keepalive_interval, _shard=shard).listen(mode)
+
+
+def serve(workers: int, mode: str = "selectors", keepalive_interval=300,
+          multicast_networks: Iterable[str] = DEFAULT_NETWORKS) -> None:
+    """Runs workers brokers sharing port 80 through SO_REUSEPORT, so the
+    kernel spreads connections over them.
+
+    The registered devices and multicast groups live in this process and are
+    served to the workers by a StoreManager, so a controller can start a
+    session with devices connected to any worker. Blacklisted IPs are kept
+    per worker.
+
+    Args:
+        workers (int): Number of broker processes.
+        mode (str, optional): Server mode of each worker. Defaults to
+        "selectors".
+        keepalive_interval (int, optional): TCP keepalive of the connections
+        in seconds. Defaults to 300.
+        multicast_networks (Iterable[str], optional): Multicast networks to
+        allocate session groups from. Defaults to DEFAULT_NETWORKS.
+    """
+    if not 1 <= workers <= MAX_SHARDS:
+        raise ValueError(f"Workers must be between 1 and {MAX_SHARDS}.")
+    store = DeviceStore()
+    multicast_groups = MulticastGroups(multicast_networks)
+
+    class _StoreServer(BaseManager):
+        pass
+
+    _StoreServer.register("DeviceStore", callable=lambda: store)
+    _StoreServer.register("MulticastGroups", callable=lambda: multicast_groups)
+    directory = tempfile.mkdtemp(prefix="canlay-broker-")
+    authkey = os.urandom(16)
+    server = _StoreServer(address=store_address(directory),
+                          authkey=authkey).get_server()
+    th.Thread(target=server.serve_forever, daemon=True).start()
+    processes = [
+        mp.Process(target=_run_worker,
+                   args=(Shard(i, workers, directory, authkey), mode, keepalive_interval))
+        for i in range(workers)
+    ]
+    try:
+        for process in processes:
+            process.start()
+        for process in processes:
+            process.join()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for process in processes:
+            if process.is_alive():
+                process.terminate()
+            process.join()
+        shutil.rmtree(directory, ignore_errors=True)
@@ -0,0 +1,421 @@
+"""Load test for the Broker.
+
+Simulates SSSFs and controllers over loopback. SSSFs register and answer
+session notifications. Controllers register, list the available SSSFs, start
+sessions with some of them and stop them again. Clients reconnect after a
+random lifetime to churn connections. At the end the p50/p99 latency of each
+route is reported along with the CPU and memory used by the broker.
+
+Starts its own broker on port 80 (Linux only, for the /proc statistics)
+unless --broker-pid is given. Run from Src/Server:
+
+    python test/broker-load-test.py --sssfs 2000 --controllers 200 --duration 60
+"""
+import argparse
+import asyncio
+import json
+import multiprocessing as mp
+import os
+import queue
+import random
+import resource
+import signal
+import socket
+import subprocess
+import sys
+import time
+from collections import defaultdict
+from typing import Dict, List, Optional, Tuple
+
+HOST = "127.0.0.1"
+PORT = 80
+SERVER_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+ECU_TYPES = [
+    ["ECM", "Engine Control Module"],
+    ["BCM", "Body Control Module"],
+    ["CCM", "Climate Control Module"],
+]
+OK_RESPONSE = b"HTTP/1.1 200 OK\r\nConnection: keep-alive\r\nContent-Length: 0\r\n\r\n"
+
+
+class Results:
+    def __init__(self) -> None:
+        # route -> latencies in seconds, route -> status -> count
+        self.latencies: Dict[str, List[float]] = defaultdict(list)
+        self.statuses: Dict[str, Dict[str, int]] = defaultdict(lambda: defaultdict(int))
+        self.notifications = 0
+        # CPU seconds the clients used, to tell if they were the bottleneck.
+        self.client_cpu = 0.0
+
+    def record(self, route: str, status: str, seconds: float) -> None:
+        self.latencies[route].append(seconds)
+        self.statuses[route][status] += 1
+
+    def as_dict(self) -> dict:
+        return {"latencies": dict(self.latencies),
+                "statuses": {r: dict(s) for r, s in self.statuses.items()},
+                "notifications": self.notifications,
+                "client_cpu": self.client_cpu}
+
+    def merge(self, other: dict) -> None:
+        for route, latencies in other["latencies"].items():
+            self.latencies[route].extend(latencies)
+        for route, statuses in other["statuses"].items():
+            for status, count in statuses.items():
+                self.statuses[route][status] += count
+        self.notifications += other["notifications"]
+        self.client_cpu += other["client_cpu"]
+
+
+async def read_message(reader: asyncio.StreamReader) -> Tuple[str, bytes]:
+    """Start line and body of the next message. Session notifications have
+    no Content-Length, their JSON body is read until it is complete, the way
+    the SSSF firmware reads everything available."""
+    head = await reader.readuntil(b"\r\n\r\n")
+    lines = head.decode("iso-8859-1").split("\r\n")
+    length = None
+    for line in lines[1:]:
+        name, _, value = line.partition(":")
+        if name.strip().lower() == "content-length":
+            length = int(value)
+    if length is not None:
+        return lines[0], await reader.readexactly(length)
+    if not lines[0].startswith("POST"):
+        return lines[0], b""
+    body = b""
+    while True:
+        chunk = await reader.read(65536)
+        if not chunk:
+            raise ConnectionError("Closed in the middle of a message.")
+        body += chunk
+        try:
+            json.loads(body)
+            return lines[0], body
+        except json.JSONDecodeError:
+            continue
+
+
+class Client:
+    def __init__(self, results: Results, stop: asyncio.Event, lifetime: float) -> None:
+        self.results = results
+        self.stop = stop
+        self.lifetime = lifetime
+        self.reader: Optional[asyncio.StreamReader] = None
+        self.writer: Optional[asyncio.StreamWriter] = None
+
+    async def connect(self) -> None:
+        start = time.perf_counter()
+        try:
+            self.reader, self.writer = await asyncio.open_connection(HOST, PORT)
+        except OSError as e:
+            self.results.record("CONNECT", type(e).__name__, time.perf_counter() - start)
+            raise
+        self.results.record("CONNECT", "ok", time.perf_counter() - start)
+
+    async def close(self) -> None:
+        if self.writer is not None:
+            self.writer.close()
+            try:
+                await self.writer.wait_closed()
+            except OSError:
+                pass
+            self.writer = None
+
+    def until(self) -> float:
+        """When to reconnect, never if lifetime is 0."""
+        if self.lifetime <= 0:
+            return float("inf")
+        return time.monotonic() + random.expovariate(1 / self.lifetime)
+
+    async def request(self, method: str, path: str, body=None) -> Tuple[str, bytes]:
+        data = b"" if body is None else json.dumps(body).encode()
+        message = (f"{method} {path} HTTP/1.1\r\nHost: broker\r\n"
+                   f"Connection: keep-alive\r\n"
+                   f"Content-Type: application/json\r\n"
+                   f"Content-Length: {len(data)}\r\n\r\n").encode() + data
+        route = f"{method} {path}"
+        start = time.perf_counter()
+        try:
+            self.writer.write(message)
+            await self.writer.drain()
+            status_line, response = await read_message(self.reader)
+        except (OSError, asyncio.IncompleteReadError, ConnectionError):
+            self.results.record(route, "closed", time.perf_counter() - start)
+            raise
+        status = status_line.split(" ")[1]
+        self.results.record(route, status, time.perf_counter() - start)
+        return status, response
+
+
+class SSSF(Client):
+    def __init__(self, index: int, *args) -> None:
+        super().__init__(*args)
+        self.mac = f"04:e9:e5:{(index >> 16) & 255:02x}:{(index >> 8) & 255:02x}:{index & 255:02x}"
+        self.registration = {
+            "MAC": self.mac,
+            "AttachedDevices": [{
+                "Type": ECU_TYPES[index % len(ECU_TYPES)],
+                "Year": 2000 + index % 20,
+                "Make": "Cummins",
+                "Model": "LoadTest",
+                "SN": f"SN{index}"
+            }]
+        }
+
+    async def run(self) -> None:
+        while not self.stop.is_set():
+            try:
+                await self.connect()
+                status, _ = await self.request("POST", "/sssf/register", self.registration)
+                if status == "202":
+                    await self.__answer_notifications(self.until())
+                else:
+                    # A sharded broker may not have closed our last
+                    # connection yet, try again like the firmware does.
+                    await asyncio.sleep(1)
+            except (OSError, asyncio.IncompleteReadError, ConnectionError):
+                await asyncio.sleep(1)
+            finally:
+                await self.close()
+
+    async def __answer_notifications(self, until: float) -> None:
+        while not self.stop.is_set():
+            remaining = until - time.monotonic()
+            if remaining <= 0:
+                return
+            try:
+                start_line, _ = await asyncio.wait_for(
+                    read_message(self.reader), min(remaining, 1.0))
+            except asyncio.TimeoutError:
+                continue
+            if not start_line.startswith("HTTP/"):
+                self.results.notifications += 1
+                self.writer.write(OK_RESPONSE)
+
+
+class Controller(Client):
+    def __init__(self, index: int, session_size: int, hold: float, *args) -> None:
+        super().__init__(*args)
+        self.mac = f"00:0c:29:{(index >> 16) & 255:02x}:{(index >> 8) & 255:02x}:{index & 255:02x}"
+        self.session_size = session_size
+        self.hold = hold
+
+    async def run(self) -> None:
+        while not self.stop.is_set():
+            try:
+                await self.connect()
+                status, _ = await self.request("POST", "/controller/register", {"MAC": self.mac})
+                if status == "202":
+                    await self.__run_sessions(self.until())
+                else:
+                    await asyncio.sleep(1)
+            except (OSError, asyncio.IncompleteReadError, ConnectionError):
+                await asyncio.sleep(1)
+            finally:
+                await self.close()
+
+    async def __run_sessions(self, until: float) -> None:
+        while not self.stop.is_set() and time.monotonic() < until:
+            status, body = await self.request("GET", "/sssf")
+            devices = json.loads(body) if body else []
+            if len(devices) < self.session_size:
+                await asyncio.sleep(random.uniform(0.5, 1.5))
+                continue
+            requested = random.sample(devices, self.session_size)
+            status, _ = await self.request(
+                "POST", "/controller/session", {"MAC": self.mac, "Devices": requested})
+            if status == "201":
+                await asyncio.sleep(random.uniform(0.5, 1.5) * self.hold)
+                await self.request("DELETE", "/controller/session")
+            else:
+                # Lost the devices to another controller.
+                await asyncio.sleep(random.uniform(0.1, 0.5))
+
+
+async def run_clients(args: argparse.Namespace, sssfs: range, controllers: range) -> dict:
+    results = Results()
+    stop = asyncio.Event()
+    clients = [SSSF(i, results, stop, args.lifetime) for i in sssfs]
+    clients += [Controller(i, args.session_size, args.hold, results, stop, args.lifetime)
+                for i in controllers]
+    # SSSFs first, so controllers find devices to start sessions with.
+    tasks = []
+    for client in clients:
+        tasks.append(asyncio.create_task(client.run()))
+        await asyncio.sleep(1 / args.ramp)
+    await asyncio.sleep(args.duration)
+    stop.set()
+    await asyncio.wait(tasks, timeout=5)
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    results.client_cpu = time.process_time()
+    return results.as_dict()
+
+
+def client_process(args: argparse.Namespace, sssfs: range, controllers: range,
+                   queue: mp.Queue) -> None:
+    queue.put(asyncio.run(run_clients(args, sssfs, controllers)))
+
+
+class BrokerStats:
+    def __init__(self, pid: int) -> None:
+        """Samples the CPU time and resident memory of the broker process and
+        its workers from /proc."""
+        self.pid = pid
+        self.ticks = os.sysconf("SC_CLK_TCK")
+        self.page_size = os.sysconf("SC_PAGE_SIZE")
+        self.samples: List[Tuple[float, float, int]] = []
+
+    def __processes(self) -> List[int]:
+        pids = [self.pid]
+        for pid in pids:
+            try:
+                for task in os.listdir(f"/proc/{pid}/task"):
+                    with open(f"/proc/{pid}/task/{task}/children") as children:
+                        pids.extend(int(p) for p in children.read().split())
+            except OSError:
+                continue
+        return pids
+
+    def sample(self) -> None:
+        cpu = 0.0
+        rss = 0
+        for pid in self.__processes():
+            try:
+                with open(f"/proc/{pid}/stat") as stat:
+                    # Fields after the parenthesized command name.
+                    fields = stat.read().rpartition(")")[2].split()
+                with open(f"/proc/{pid}/statm") as statm:
+                    rss += int(statm.read().split()[1]) * self.page_size
+            except OSError:
+                continue
+            cpu += (int(fields[11]) + int(fields[12])) / self.ticks
+        self.samples.append((time.monotonic(), cpu, rss))
+
+    def report(self) -> str:
+        if len(self.samples) < 2:
+            return "Broker: not enough samples."
+        usage = [(c1 - c0) / (t1 - t0) * 100
+                 for (t0, c0, _), (t1, c1, _) in zip(self.samples, self.samples[1:])]
+        (t0, c0, _), (t1, c1, _) = self.samples[0], self.samples[-1]
+        peak_rss = max(rss for _, _, rss in self.samples)
+        return (f"Broker CPU: {(c1 - c0) / (t1 - t0) * 100:.1f}% average, "
+                f"{max(usage):.1f}% peak (100% = one core). "
+                f"RSS: {self.samples[-1][2] / 2**20:.1f} MiB at the end, "
+                f"{peak_rss / 2**20:.1f} MiB peak.")
+
+
+def percentile(ordered: List[float], fraction: float) -> float:
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def print_report(results: Results, stats: BrokerStats, seconds: float) -> None:
+    print(f"{'Route':<28} {'count':>8} {'req/s':>8} {'p50 ms':>8} "
+          f"{'p99 ms':>8} {'max ms':>8}  statuses")
+    for route in sorted(results.latencies):
+        ordered = sorted(results.latencies[route])
+        statuses = ", ".join(f"{s}: {n}" for s, n in sorted(results.statuses[route].items()))
+        print(f"{route:<28} {len(ordered):>8} {len(ordered) / seconds:>8.1f} "
+              f"{percentile(ordered, 0.5) * 1e3:>8.2f} {percentile(ordered, 0.99) * 1e3:>8.2f} "
+              f"{ordered[-1] * 1e3:>8.2f}  {statuses}")
+    print(f"Session notifications answered: {results.notifications}")
+    print(stats.report())
+    print(f"Client CPU: {results.client_cpu / seconds * 100:.1f}% average over all "
+          f"client processes, latencies are inflated when they are saturated.")
+
+
+def raise_file_limit() -> None:
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+
+def start_broker(args: argparse.Namespace) -> subprocess.Popen:
+    broker = subprocess.Popen(
+        [sys.executable, "Server.py", "--mode", args.mode, "--workers", str(args.workers)],
+        cwd=SERVER_DIR, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    deadline = time.monotonic() + 10
+    while time.monotonic() < deadline and broker.poll() is None:
+        try:
+            socket.create_connection((HOST, PORT), timeout=1).close()
+        except OSError:
+            time.sleep(0.1)
+            continue
+        # Another broker may be listening on the port, which this one
+        # failed to bind.
+        time.sleep(0.5)
+        if broker.poll() is None:
+            return broker
+    if broker.poll() is None:
+        broker.send_signal(signal.SIGINT)
+    raise RuntimeError(f"The broker did not start listening on port {PORT}.")
+
+
+def split(count: int, parts: int, part: int) -> range:
+    return range(count * part // parts, count * (part + 1) // parts)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Broker load test.")
+    parser.add_argument("--sssfs", type=int, default=1000)
+    parser.add_argument("--controllers", type=int, default=100)
+    parser.add_argument("--duration", type=float, default=30,
+                        help="Seconds to run once every client started.")
+    parser.add_argument("--session-size", type=int, default=2,
+                        help="SSSFs requested per session.")
+    parser.add_argument("--hold", type=float, default=2,
+                        help="Average seconds a session lasts.")
+    parser.add_argument("--lifetime", type=float, default=20,
+                        help="Average seconds before a client reconnects, 0 to never.")
+    parser.add_argument("--ramp", type=float, default=500,
+                        help="Clients started per second in each process.")
+    parser.add_argument("--processes", type=int, default=max(1, (os.cpu_count() or 2) // 2),
+                        help="Client processes.")
+    parser.add_argument("--mode", choices=("selectors", "asyncio"), default="selectors")
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--broker-pid", type=int,
+                        help="Measure an already running broker instead of starting one.")
+    args = parser.parse_args()
+    if args.session_size > 20:
+        parser.error("Sessions have at most 20 SSSFs.")
+
+    raise_file_limit()
+    broker = None if args.broker_pid else start_broker(args)
+    stats = BrokerStats(args.broker_pid or broker.pid)
+    finished = mp.Queue()
+    processes = [
+        mp.Process(target=client_process, args=(
+            args, split(args.sssfs, args.processes, p),
+            split(args.controllers, args.processes, p), finished))
+        for p in range(args.processes)
+    ]
+    started = time.monotonic()
+    try:
+        for process in processes:
+            process.start()
+        results = Results()
+        remaining = len(processes)
+        while remaining:
+            stats.sample()
+            try:
+                results.merge(finished.get(timeout=1))
+                remaining -= 1
+            except queue.Empty:
+                if not any(p.is_alive() for p in processes):
+                    break
+        for process in processes:
+            process.join()
+    finally:
+        if broker is not None:
+            # Like Ctrl+C, so a sharded broker stops its workers too.
+            broker.send_signal(signal.SIGINT)
+            try:
+                broker.wait(10)
+            except subprocess.TimeoutExpired:
+                broker.kill()
+    print_report(results, stats, time.monotonic() - started)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,92 @@
+import numpy as np
+
+from CANLay.Recorder import FLAG_FD, BinaryRecordWriter, Direction, binary_to_text
+from CANLay.Recording import Recording
+
+
+def write_recording(path, records_per_block=16):
+    """Writes received frames from three members whose clocks disagree,
+    interleaved in arrival order, along with local TX, CAN-FD and simulator
+    frames. Returns (timestamp, can_id) of every record written."""
+    rng = np.random.default_rng(0)
+    written = []
+    with open(path, "ab") as file:
+        writer = BinaryRecordWriter(file, records_per_block)
+        now = 1_000_000
+        for i in range(500):
+            now += int(rng.integers(100, 1000))
+            member = int(rng.integers(1, 4))
+            # Each sender's timestamp is off from the local clock by up to
+            # ±50 ms, so received records are far out of order.
+            sent = now + member * 50_000 - 100_000 + int(rng.integers(0, 5000))
+            kind = i % 5
+            if kind == 0:
+                writer.write_can(now, 0x100, 8, bytes(8), 0, Direction.TX, 0)
+                written.append((now, 0x100))
+            elif kind == 1:
+                writer.write_can(sent, 0x200 + member, 16, bytes(16), FLAG_FD,
+                                 Direction.RX, member)
+                written.append((sent, 0x200 + member))
+            elif kind == 2:
+                writer.write_sim(now, [1.0, 2.0])
+                written.append((now, 0))
+            else:
+                writer.write_can(sent, 0x300 + member, 4, bytes(4), 0, Direction.RX, member)
+                written.append((sent, 0x300 + member))
+        writer.close()
+    return written
+
+
+def test_blocks_sorted_with_true_bounds(tmp_path):
+    path = tmp_path / "out_of_order.bin"
+    write_recording(path)
+    with Recording(str(path), build_index=False) as recording:
+        assert len(recording.blocks) > 2
+        for i in range(len(recording.blocks)):
+            # Copied, the mmap cannot close while block views are alive.
+            ts = recording.block(i)["timestamp"].copy()
+            assert np.all(ts[1:] >= ts[:-1])
+            assert recording.blocks[i]["first_timestamp"] == ts.min()
+            assert recording.blocks[i]["last_timestamp"] == ts.max()
+
+
+def test_slice_round_trip(tmp_path):
+    path = tmp_path / "out_of_order.bin"
+    written = write_recording(path)
+    timestamps = np.array(sorted(t for t, _ in written))
+    with Recording(str(path), build_index=False) as recording:
+        assert len(recording) == len(written)
+        assert recording.start_time == timestamps[0]
+        assert recording.end_time == timestamps[-1]
+        everything = recording.slice(0, 2 ** 63)
+        assert np.array_equal(everything["timestamp"], timestamps)
+        for t0, t1 in ((timestamps[10], timestamps[60]), (timestamps[200], timestamps[201]),
+                       (timestamps[-50], timestamps[-1] + 1)):
+            records = recording.slice(int(t0), int(t1))
+            expected = timestamps[(timestamps >= t0) & (timestamps < t1)]
+            assert np.array_equal(records["timestamp"], expected)
+
+
+def test_filter_round_trip(tmp_path):
+    path = tmp_path / "out_of_order.bin"
+    written = write_recording(path)
+    wanted = {0x202, 0x301}
+    t0, t1 = written[100][0], written[400][0]
+    with Recording(str(path)) as recording:
+        records = recording.filter(wanted, t0, t1)
+        expected = sorted((t, c) for t, c in written
+                          if c in wanted and t0 <= t < t1)
+        assert list(zip(records["timestamp"].tolist(), records["can_id"].tolist())) \
+            == expected
+    # The sidecar index written on the first open gives the same answer.
+    with Recording(str(path)) as recording:
+        assert np.array_equal(recording.filter(wanted, t0, t1), records)
+
+
+def test_binary_to_text_in_time_order(tmp_path):
+    path = tmp_path / "out_of_order.bin"
+    written = write_recording(path)
+    assert binary_to_text(str(path), str(tmp_path / "out.txt")) == len(written)
+    with open(tmp_path / "out.txt") as text:
+        timestamps = [int(line[1:line.index(")")]) for line in text]
+    assert timestamps == sorted(t for t, _ in written)